@@ -0,0 +1,98 @@
+import logging
+from agents import Agent, ItemHelpers, RunContextWrapper, Runner, function_tool
+from agents.tool import FunctionTool
+from cache import TieredCache, SQLiteCacheTier, make_cache_key
+from telemetry import Counter, metrics
+
+logger = logging.getLogger(__name__)
+
+agent_memo_lookups = Counter("medassistant_agent_memo_lookups_total", "Agent tool calls by memoization result")
+metrics.append(agent_memo_lookups)
+
+
+class AgentToolMemo:
+    """Memoizes agent-as-tool calls on the agent's configuration and input.
+
+    The key covers the agent name, model, the instructions as resolved for
+    the caller's context (doctor and patient variants differ), the model
+    settings, the agent's tool names and the input text. Each agent gets its
+    own LRU so hit rates are reported per agent, all of them share the disk
+    tier. Agents sampling above max_temperature are not memoized unless
+    pinned.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 21600,
+                 max_temperature: float = 0.7, disk: SQLiteCacheTier | None = None,
+                 pinned: set[str] | None = None, enabled: bool = True):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_temperature = max_temperature
+        self.disk = disk
+        self.pinned = pinned or set()
+        self.enabled = enabled
+        self._caches: dict[str, TieredCache] = {}
+        self._bypassed: dict[str, int] = {}
+
+    def cache_for(self, tool_name: str) -> TieredCache:
+        cache = self._caches.get(tool_name)
+        if cache is None:
+            cache = TieredCache(f"agent_tool:{tool_name}", self.max_entries, self.ttl_seconds, self.disk)
+            self._caches[tool_name] = cache
+        return cache
+
+    def memoizable(self, agent: Agent, tool_name: str) -> bool:
+        if not self.enabled:
+            return False
+        if tool_name in self.pinned:
+            return True
+        temperature = agent.model_settings.temperature
+        return temperature is None or temperature <= self.max_temperature
+
+    async def key(self, agent: Agent, context: RunContextWrapper, input: str) -> str:
+        return make_cache_key(
+            agent.name,
+            getattr(agent.model, "model", agent.model),
+            await agent.get_system_prompt(context),
+            agent.model_settings.to_json_dict(),
+            sorted(tool.name for tool in agent.tools),
+            input.strip(),
+        )
+
+    async def run(self, agent: Agent, tool_name: str, context: RunContextWrapper, input: str) -> str:
+        async def call() -> str:
+            result = await Runner.run(starting_agent=agent, input=input, context=context.context)
+            return ItemHelpers.text_message_outputs(result.new_items)
+
+        if not self.memoizable(agent, tool_name):
+            self._bypassed[tool_name] = self._bypassed.get(tool_name, 0) + 1
+            agent_memo_lookups.inc(agent=tool_name, result="bypass")
+            return await call()
+
+        cache = self.cache_for(tool_name)
+        misses = cache.stats.misses
+        output = await cache.get_or_fetch(await self.key(agent, context, input), call)
+        result = "miss" if cache.stats.misses > misses else "hit"
+        agent_memo_lookups.inc(agent=tool_name, result=result)
+        logger.debug("%s memo %s", tool_name, result)
+        return output
+
+    def tool(self, agent: Agent, tool_name: str, tool_description: str) -> FunctionTool:
+        """Same tool as agent.as_tool, with its calls going through the memo"""
+        @function_tool(name_override=tool_name, description_override=tool_description)
+        async def run_agent(context: RunContextWrapper, input: str) -> str:
+            return await self.run(agent, tool_name, context, input)
+        return run_agent
+
+    def stats(self) -> dict:
+        agents = {}
+        for tool_name in sorted(set(self._caches) | set(self._bypassed)):
+            cache = self._caches.get(tool_name)
+            data = cache.snapshot() if cache is not None else {"hits": 0, "hit_rate": 0.0}
+            data["bypassed"] = self._bypassed.get(tool_name, 0)
+            agents[tool_name] = data
+        return {
+            "enabled": self.enabled,
+            "max_temperature": self.max_temperature,
+            "pinned": sorted(self.pinned),
+            "agents": agents,
+        }
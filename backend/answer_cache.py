@@ -0,0 +1,313 @@
+import logging
+import math
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+import numpy as np
+from compaction import tokenize
+
+logger = logging.getLogger(__name__)
+
+NUMBER = re.compile(r"\d+(?:\.\d+)?")
+# Question phrasing that does not change what is asked, on top of the stopwords dropped by tokenize
+BOILERPLATE = frozenset(
+    "can could would should do does did you please tell me i want know about explain describe give".split()
+)
+
+
+@lru_cache(maxsize=1 << 18)
+def _slot(feature: str, dim: int) -> tuple[int, float]:
+    h = zlib.crc32(feature.encode("utf-8"))
+    return h % dim, 1.0 if h & 0x80000000 else -1.0
+
+
+def _words(text: str) -> list[str]:
+    words = tokenize(text)
+    return [word for word in words if word not in BOILERPLATE] or words
+
+
+class HashingVectorizer:
+    """Local query embedding: hashed word and character 3-gram features with
+    sublinear TF and an IDF learned from the cached queries. No network calls.
+
+    Stopwords and question boilerplate are dropped first, so "Causes and
+    treatment of paralysis?" and "What are the causes and treatment of
+    paralysis?" get the same vector. Stored vectors are plain TF, the IDF
+    keeps changing as queries are added and is applied to both sides of a
+    comparison at lookup time.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.documents = 0
+        self.df = np.zeros(dim, dtype=np.float32)
+
+    def _features(self, text: str) -> Counter:
+        features: Counter = Counter()
+        for word in _words(text):
+            features[f"w:{word}"] += 1
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                features[f"c:{padded[i:i + 3]}"] += 1
+        return features
+
+    def _hashed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        features = self._features(text)
+        if not features:
+            return vector
+        slots = [_slot(feature, self.dim) for feature in features]
+        index = np.fromiter((slot for slot, _ in slots), dtype=np.int64, count=len(slots))
+        weights = np.fromiter(
+            (sign * (1.0 + math.log(count)) for (_, sign), count in zip(slots, features.values())),
+            dtype=np.float32, count=len(slots))
+        np.add.at(vector, index, weights)
+        return vector
+
+    def fit_one(self, text: str) -> None:
+        self.documents += 1
+        self.df += self._hashed(text) != 0
+
+    def tf(self, text: str) -> np.ndarray:
+        vector = self._hashed(text)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def idf(self) -> np.ndarray:
+        return np.log((1 + self.documents) / (1 + self.df)) + 1
+
+
+@dataclass
+class CachedAnswer:
+    query: str
+    answer: str
+    similarity: float
+    age_seconds: float
+
+
+class _Shard:
+    """LSH buckets of the rows of one (doctor, deepsearch) combination.
+
+    Each table maps a random-hyperplane signature to the rows that have it,
+    a lookup only scores the rows that share a bucket with the query.
+    """
+
+    def __init__(self, tables: int):
+        self.buckets: list[dict[int, list[int]]] = [{} for _ in range(tables)]
+
+    @classmethod
+    def build(cls, rows: np.ndarray, signatures: np.ndarray) -> "_Shard":
+        """Buckets for rows and their (rows, tables) signatures, grouped with one sort per table"""
+        shard = cls(signatures.shape[1])
+        if not len(rows):
+            return shard
+        for table, column in zip(shard.buckets, signatures.T):
+            order = np.argsort(column, kind="stable")
+            keys = column[order]
+            bounds = np.flatnonzero(np.diff(keys)) + 1
+            starts = np.concatenate(([0], bounds))
+            table.update(zip(keys[starts].tolist(), (group.tolist() for group in np.split(rows[order], bounds))))
+        return shard
+
+    def add(self, row: int, signatures: list[int]) -> None:
+        for table, signature in zip(self.buckets, signatures):
+            table.setdefault(signature, []).append(row)
+
+    def candidates(self, signatures: list[int]) -> set[int]:
+        rows = set()
+        for table, signature in zip(self.buckets, signatures):
+            rows.update(table.get(signature, ()))
+        return rows
+
+
+class AnswerCache:
+    """Final answers keyed by query vector, doctor/patient and deepsearch flag.
+
+    A lookup returns a stored answer when a cached query is at least
+    `threshold` cosine-similar and has not expired. Rows live in arrays
+    preallocated to max_entries. Vectors are scaled to int8 per row, which
+    a cosine does not see, so a million entries take about 256 MB once
+    written. At 90% full a background thread copies
+    the live rows (only the newest half when most are still live) into
+    fresh arrays and swaps them in, lookups and stores carry on meanwhile.
+    """
+
+    def __init__(self, threshold: float = 0.9, ttl_seconds: float = 24 * 3600,
+                 max_entries: int = 1_000_000, dim: int = 256, tables: int = 12, bits: int = 12):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.dim = dim
+        self.tables = tables
+        self.vectorizer = HashingVectorizer(dim)
+        self._planes = np.random.default_rng(7).standard_normal((dim, tables * bits)).astype(np.float32)
+        self._weights = 1 << np.arange(bits, dtype=np.int64)
+        # np.zeros pages are only backed by memory once a row is written
+        self.vectors = np.zeros((max_entries, dim), dtype=np.int8)
+        self.signatures = np.zeros((max_entries, tables), dtype=np.int32)
+        self.expires_at = np.zeros(max_entries, dtype=np.float64)
+        self.created_at = np.zeros(max_entries, dtype=np.float64)
+        self.shard_keys = np.zeros(max_entries, dtype=np.int8)
+        self.queries: list[str] = []
+        self.answers: list[str] = []
+        self._shards: dict[int, _Shard] = {}
+        self._lock = threading.Lock()
+        self._compaction: threading.Thread | None = None
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        self.compactions = 0
+        self.lookup_seconds = 0.0
+
+    @staticmethod
+    def _shard_key(doctor: bool, deepsearch: bool) -> int:
+        return 2 * bool(doctor) + bool(deepsearch)
+
+    def _signatures(self, vectors: np.ndarray) -> np.ndarray:
+        bits = (vectors @ self._planes > 0).reshape(*vectors.shape[:-1], self.tables, -1)
+        return bits @ self._weights
+
+    def _search(self, shard: _Shard, vector: np.ndarray, k: int) -> list[tuple[int, float]]:
+        candidates = shard.candidates(self._signatures(vector).tolist())
+        if not candidates:
+            return []
+        rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        rows = rows[self.expires_at[rows] > time.time()]
+        if not len(rows):
+            return []
+        # Cosines of the IDF-weighted vectors, without materializing the weighted rows
+        squared_idf = np.square(self.vectorizer.idf(), dtype=np.float32)
+        stored = self.vectors[rows].astype(np.float32)
+        norms = np.sqrt(np.square(stored) @ squared_idf) * np.sqrt(np.square(vector) @ squared_idf)
+        scores = np.divide(stored @ (vector * squared_idf), norms,
+                           out=np.zeros(len(rows), dtype=np.float32), where=norms > 0)
+        if len(rows) > k:
+            top = np.argpartition(-scores, k)[:k]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores)
+        return [(int(rows[i]), float(scores[i])) for i in order]
+
+    def lookup(self, query: str, doctor: bool, deepsearch: bool) -> CachedAnswer | None:
+        started = time.perf_counter()
+        vector = self.vectorizer.tf(query)
+        numbers = set(NUMBER.findall(query))
+        match = None
+        with self._lock:
+            shard = self._shards.get(self._shard_key(doctor, deepsearch))
+            for row, similarity in self._search(shard, vector, k=3) if shard is not None else []:
+                # "type 1" and "type 2" diabetes are close in n-gram space but are different questions
+                if similarity < self.threshold or set(NUMBER.findall(self.queries[row])) != numbers:
+                    continue
+                match = CachedAnswer(
+                    query=self.queries[row],
+                    answer=self.answers[row],
+                    similarity=round(similarity, 4),
+                    age_seconds=round(time.time() - self.created_at[row], 1),
+                )
+                break
+        self.lookup_seconds += time.perf_counter() - started
+        if match is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return match
+
+    def store(self, query: str, answer: str, doctor: bool, deepsearch: bool) -> None:
+        if self.max_entries <= 0:
+            return
+        vector = self.vectorizer.tf(query)
+        signatures = self._signatures(vector)
+        key = self._shard_key(doctor, deepsearch)
+        with self._lock:
+            row = len(self.answers)
+            if row >= self.max_entries * 0.9 and self._compaction is None:
+                self._compaction = threading.Thread(target=self._compact, name="answer-cache-compaction", daemon=True)
+                self._compaction.start()
+            if row == self.max_entries:
+                # Full until the running compaction swaps in the live rows
+                self.dropped += 1
+                return
+            now = time.time()
+            self.vectorizer.fit_one(query)
+            peak = np.abs(vector).max()
+            self.vectors[row] = np.rint(vector * (127 / peak)) if peak else 0
+            self.signatures[row] = signatures
+            self.expires_at[row] = now + self.ttl_seconds
+            self.created_at[row] = now
+            self.shard_keys[row] = key
+            self.queries.append(query)
+            self.answers.append(answer)
+            self._shards.setdefault(key, _Shard(self.tables)).add(row, signatures.tolist())
+
+    def _compact(self) -> None:
+        """Copy the live rows into fresh arrays, rebuild their buckets and swap them in.
+
+        Rows below the snapshot taken at the start never change, so they are
+        copied without the lock. Rows stored meanwhile are appended under the
+        lock right before the swap.
+        """
+        started = time.perf_counter()
+        try:
+            with self._lock:
+                end = len(self.answers)
+                queries, answers = self.queries, self.answers
+            # Rows are in insertion order, so the newest half is the second half of the live rows
+            rows = np.flatnonzero(self.expires_at[:end] > time.time())
+            if len(rows) > self.max_entries * 3 // 4:
+                rows = rows[len(rows) // 2:]
+            size = len(rows)
+            vectors = np.zeros_like(self.vectors)
+            signatures = np.zeros_like(self.signatures)
+            expires_at = np.zeros_like(self.expires_at)
+            created_at = np.zeros_like(self.created_at)
+            shard_keys = np.zeros_like(self.shard_keys)
+            for target, source in ((vectors, self.vectors), (signatures, self.signatures), (expires_at, self.expires_at),
+                                   (created_at, self.created_at), (shard_keys, self.shard_keys)):
+                target[:size] = source[rows]
+            kept_queries = [queries[row] for row in rows.tolist()]
+            kept_answers = [answers[row] for row in rows.tolist()]
+            shards = {}
+            for key in np.unique(shard_keys[:size]).tolist():
+                key_rows = np.flatnonzero(shard_keys[:size] == key)
+                shards[key] = _Shard.build(key_rows, signatures[key_rows])
+            df = np.count_nonzero(vectors[:size], axis=0).astype(np.float32)
+
+            with self._lock:
+                tail = slice(end, len(self.answers))
+                added = tail.stop - end
+                for target, source in ((vectors, self.vectors), (signatures, self.signatures), (expires_at, self.expires_at),
+                                       (created_at, self.created_at), (shard_keys, self.shard_keys)):
+                    target[size:size + added] = source[tail]
+                kept_queries.extend(self.queries[tail])
+                kept_answers.extend(self.answers[tail])
+                for row in range(size, size + added):
+                    shards.setdefault(int(shard_keys[row]), _Shard(self.tables)).add(row, signatures[row].tolist())
+                df += np.count_nonzero(vectors[size:size + added], axis=0)
+                self.vectors, self.signatures, self.expires_at = vectors, signatures, expires_at
+                self.created_at, self.shard_keys = created_at, shard_keys
+                self.queries, self.answers, self._shards = kept_queries, kept_answers, shards
+                self.vectorizer.df, self.vectorizer.documents = df, size + added
+                self.compactions += 1
+            logger.info("Answer cache compacted from %d to %d entries in %.2fs",
+                        tail.stop, size + added, time.perf_counter() - started)
+        except Exception:
+            logger.exception("Answer cache compaction failed")
+        finally:
+            with self._lock:
+                self._compaction = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.answers),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "avg_lookup_ms": round(self.lookup_seconds / lookups * 1000, 4) if lookups else 0.0,
+            "compactions": self.compactions,
+            "dropped_stores": self.dropped,
+        }
@@ -0,0 +1,196 @@
+"""Answers a JSONL file of questions through the agent pipeline.
+
+Each input line is a JSON object with the question in "question", "query"
+or "body" and an optional "id" (or "request_id"), or a bare JSON string.
+Answers are appended to the output JSONL as they finish, so an interrupted
+batch resumes by running the same command again:
+
+    python -m batch questions.jsonl --output answers.jsonl --concurrency 4 --deep
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator, TextIO
+from governor import Upstream
+
+logger = logging.getLogger(__name__)
+
+
+def read_questions(lines: Iterable[str]) -> Iterator[dict]:
+    """Question records of a JSONL stream, each with an id and a question"""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            logger.warning("Skipping line %d, it is not JSON", number)
+            continue
+        if isinstance(record, str):
+            record = {"question": record}
+        question = record.get("question") or record.get("query") or record.get("body")
+        if not isinstance(question, str) or not question.strip():
+            logger.warning("Skipping line %d, it has no question", number)
+            continue
+        yield {**record, "id": str(record.get("id") or record.get("request_id") or number), "question": question}
+
+
+def load_results(path: str) -> list[dict]:
+    """Results already written to an output file, the checkpoint of its batch"""
+    if not os.path.exists(path):
+        return []
+    results = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Last line of a batch that was killed mid-write
+                continue
+    return results
+
+
+def completed_ids(results: list[dict]) -> set[str]:
+    """Questions that do not need to run again, failed ones are retried on resume"""
+    return {result["id"] for result in results if result.get("status") != "error"}
+
+
+def open_output(path: str) -> TextIO:
+    file = open(path, "a+", encoding="utf-8")
+    file.seek(0, os.SEEK_END)
+    if file.tell() > 0:
+        file.seek(file.tell() - 1)
+        if file.read(1) != "\n":
+            file.write("\n")
+    return file
+
+
+class BatchRunner:
+    """Answers questions with at most `concurrency` of them in flight.
+
+    Results are yielded in completion order. Questions whose id is in `done`
+    are skipped, which is how a batch resumes from its output file. Searches
+    and extracted pages are shared through the process-wide search cache and
+    document store, so questions on the same topic reuse each other's
+    upstream calls. `upstreams` are the governed upstreams whose call counts
+    are reported per question.
+    """
+
+    def __init__(self, answer: Callable[[dict], Awaitable[dict]], concurrency: int = 4,
+                 upstreams: dict[str, Upstream] | None = None):
+        self.answer = answer
+        self.concurrency = max(1, concurrency)
+        self.upstreams = upstreams or {}
+        self.answered = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+        self._calls_at_start = {name: upstream.calls for name, upstream in self.upstreams.items()}
+
+    async def _answer(self, record: dict) -> dict:
+        started = time.perf_counter()
+        try:
+            result = await self.answer(record)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Batch question %s failed: %s", record["id"], e)
+            result = {"status": "error", "output": f"Error occurred: {str(e)}"}
+        if result["status"] == "error":
+            self.failed += 1
+        else:
+            self.answered += 1
+        return {"id": record["id"], "question": record["question"], **result,
+                "elapsed_seconds": round(time.perf_counter() - started, 2)}
+
+    async def run(self, questions: Iterable[dict], done: set[str] | None = None) -> AsyncIterator[dict]:
+        done = done or set()
+        pending = iter(questions)
+        results: asyncio.Queue[dict | None] = asyncio.Queue()
+
+        async def worker() -> None:
+            # Workers pull from one shared iterator, so the input is read as it is needed
+            for record in pending:
+                if record["id"] in done:
+                    self.skipped += 1
+                    continue
+                await results.put(await self._answer(record))
+
+        workers = asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        workers.add_done_callback(lambda _: results.put_nowait(None))
+        try:
+            while (result := await results.get()) is not None:
+                yield result
+            await workers
+        finally:
+            workers.cancel()
+
+    def report(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        processed = self.answered + self.failed
+        calls = {name: upstream.calls - self._calls_at_start.get(name, 0)
+                 for name, upstream in self.upstreams.items()}
+        return {
+            "answered": self.answered,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "elapsed_seconds": round(elapsed, 2),
+            "questions_per_hour": round(processed / elapsed * 3600, 1) if elapsed > 0 else 0.0,
+            "upstream_calls": calls,
+            "upstream_calls_per_question": {
+                name: round(count / processed, 2) for name, count in calls.items()} if processed else {},
+        }
+
+
+async def run_file(args: argparse.Namespace) -> dict:
+    from main import answer_batch_question, batch_upstreams, search_cache, support_bot, upstream_clients
+
+    results = load_results(args.output)
+    done = completed_ids(results)
+    if done:
+        logger.info("Resuming batch, %d questions already answered in %s", len(done), args.output)
+    batch_id = args.batch_id or os.path.splitext(os.path.basename(args.output))[0]
+    defaults = {"enable_deepsearch": args.deep, "is_doctor": args.doctor, "engine": args.engine}
+
+    async def answer(record: dict) -> dict:
+        return await answer_batch_question(record, batch_id, defaults)
+
+    runner = BatchRunner(answer, args.concurrency, batch_upstreams())
+    try:
+        with open(args.input, encoding="utf-8") as questions, open_output(args.output) as output:
+            async for result in runner.run(read_questions(questions), done):
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+                logger.info("Question %s %s in %.1fs", result["id"], result["status"], result["elapsed_seconds"])
+    finally:
+        # Same shutdown as the app lifespan: flush queued session writes, close the pools
+        await support_bot.sessions.drain()
+        await upstream_clients.close()
+    report = runner.report()
+    report["search_cache"] = search_cache.snapshot()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions")
+    parser.add_argument("input", help="questions, one JSON object per line")
+    parser.add_argument("--output", "-o", required=True, help="answers JSONL, appended to and used to resume")
+    parser.add_argument("--concurrency", type=int, default=4, help="questions answered at the same time")
+    parser.add_argument("--deep", action="store_true", help="enable deep search for every question")
+    parser.add_argument("--doctor", action="store_true", help="answer for a doctor instead of a patient")
+    parser.add_argument("--engine", default=None, choices=["orchestrator", "dag"])
+    parser.add_argument("--batch-id", default=None, help="defaults to the output file name")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_file(args))
+    json.dump(report, sys.stdout, indent=4)
+    print()
+
+
+if __name__ == "__main__":
+    main()
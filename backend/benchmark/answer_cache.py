@@ -0,0 +1,109 @@
+"""Answer cache benchmark: exact repeats must keep hitting as the cache grows.
+
+Fills an AnswerCache with generated questions that share most of their
+vocabulary, which moves the IDF the most, and after every `--check-every`
+stores looks up the first questions again. With `--max-entries` below
+`--entries` the cache compacts in the background while it is being filled.
+At the end rephrased questions must hit and different ones must miss.
+Reports lookup and store latency and exits with status 1 when an exact
+repeat missed or scored below 0.999, or a rephrasing was misjudged:
+
+    python -m benchmark.answer_cache --entries 2000 --check-every 100
+    python -m benchmark.answer_cache --entries 300000 --max-entries 100000 --check-every 10000
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from answer_cache import AnswerCache
+from benchmark.load_test import summarize
+
+WORDS = ("latest treatments therapy diabetes adults children symptoms causes risk insulin metformin "
+         "guidelines prevention hypertension asthma cancer screening diet exercise side effects").split()
+REPEATS = [
+    "What are the latest treatments for type 2 diabetes in adults?",
+    "How has artificial intelligence changed healthcare from 2020 to 2024?",
+    "What are the recommended guidelines for managing hypertension in adults?",
+    "What are the causes and treatment of paralysis?",
+]
+# Rephrasings of REPEATS that must hit, and questions close to them that must miss
+REPHRASED = [
+    "Causes and treatment of paralysis?",
+    "Can you tell me the latest treatments for type 2 diabetes in adults?",
+    "how has artificial intelligence changed healthcare from 2020 to 2024",
+]
+DIFFERENT = [
+    "What are the causes and treatment of diabetes?",
+    "What are the latest treatments for type 1 diabetes in adults?",
+    "How has artificial intelligence changed healthcare from 2010 to 2014?",
+]
+
+
+def run(args: argparse.Namespace) -> dict:
+    cache = AnswerCache(threshold=args.threshold, max_entries=args.max_entries or args.entries + len(REPEATS))
+    rng = random.Random(args.seed)
+    for index, question in enumerate(REPEATS):
+        cache.store(question, f"answer {index}", False, True)
+
+    lowest = 1.0
+    misses = []
+    latencies = []
+    store_latencies = []
+    compactions = 0
+    for stored in range(1, args.entries + 1):
+        question = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 12)))
+        started = time.perf_counter()
+        cache.store(f"{question} case {stored}?", "answer", False, True)
+        store_latencies.append(time.perf_counter() - started)
+        if stored % args.check_every:
+            continue
+        if cache.compactions != compactions:
+            # A compaction dropped the oldest half of the entries, REPEATS among them
+            compactions = cache.compactions
+            for index, question in enumerate(REPEATS):
+                cache.store(question, f"answer {index}", False, True)
+        for question in REPEATS:
+            started = time.perf_counter()
+            hit = cache.lookup(question, False, True)
+            latencies.append(time.perf_counter() - started)
+            if hit is None or hit.query != question or hit.similarity < 0.999:
+                misses.append({"entries": stored, "query": question, "similarity": hit.similarity if hit else None})
+            else:
+                lowest = min(lowest, hit.similarity)
+
+    misjudged = [question for question in REPHRASED if cache.lookup(question, False, True) is None]
+    misjudged += [question for question in DIFFERENT if cache.lookup(question, False, True) is not None]
+    return {
+        "entries": args.entries + len(REPEATS),
+        "repeat_lookups": len(latencies),
+        "repeat_misses": misses,
+        "lowest_repeat_similarity": lowest,
+        "misjudged_rephrasings": misjudged,
+        "lookup_ms": summarize([seconds * 1000 for seconds in latencies]),
+        "store_ms": summarize([seconds * 1000 for seconds in store_latencies]),
+        "cache": cache.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that exact repeats hit the answer cache as it grows")
+    parser.add_argument("--entries", type=int, default=2000, help="generated questions to store")
+    parser.add_argument("--check-every", type=int, default=100, help="stores between repeat lookups")
+    parser.add_argument("--max-entries", type=int, default=0, help="cache capacity, 0 fits every entry")
+    parser.add_argument("--threshold", type=float, default=0.9)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=4))
+    if report["repeat_misses"]:
+        print(f"{len(report['repeat_misses'])} exact repeats missed the answer cache")
+    if report["misjudged_rephrasings"]:
+        print(f"{len(report['misjudged_rephrasings'])} rephrased questions were misjudged")
+    if report["repeat_misses"] or report["misjudged_rephrasings"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
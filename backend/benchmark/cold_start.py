@@ -0,0 +1,140 @@
+"""Cold-start benchmark: import time, time to ready and first request latency.
+
+Starts the fake upstreams, then for each repetition a fresh API server, and
+measures how long `import main` takes, how long the server takes to answer
+its first HTTP request (startup and upstream warm-up included) and the
+latency of the first and second /chatendpoint calls:
+
+    python -m benchmark.cold_start --repeat 3 --target-ready-seconds 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from benchmark.load_test import BACKEND_DIR, free_port, summarize, wait_until_up
+
+
+def server_env(fake_port: int, workdir: str, warm_up: bool) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1/",
+        "TAVILY_BASE_URL": f"http://127.0.0.1:{fake_port}",
+        "GEMINI_API_KEY": "bench", "TAVILY_API_KEY": "bench", "OPENAI_API_KEY": "bench",
+        "OPENAI_AGENTS_DISABLE_TRACING": "1",
+        "USER_DB": os.path.join(workdir, "users.db"),
+        "SESSION_DB": os.path.join(workdir, "sessions.db"),
+        "DOC_STORE_DIR": os.path.join(workdir, "doc_store"),
+        "JOB_DB": os.path.join(workdir, "jobs.db"),
+        "RUN_STATE_DB": os.path.join(workdir, "run_state.db"),
+        "AGENT_MEMO_DB": os.path.join(workdir, "agent_memo.db"),
+        "SEARCH_CACHE_MAX_ENTRIES": "0", "DOC_STORE_TTL_SECONDS": "0", "ANSWER_CACHE_THRESHOLD": "2",
+        "AGENT_MEMO_ENABLED": "0",
+        "UPSTREAM_WARM_UP": "1" if warm_up else "0",
+    })
+    return env
+
+
+def import_seconds(env: dict) -> float:
+    output = subprocess.check_output([
+        sys.executable, "-c",
+        "import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)",
+    ], cwd=BACKEND_DIR, env=env, text=True, stderr=subprocess.DEVNULL)
+    return float(output.strip().splitlines()[-1])
+
+
+async def start_server(env: dict, port: int) -> tuple[subprocess.Popen, float]:
+    """Start an API server and return it with the seconds until it answered a request"""
+    started = time.perf_counter()
+    server = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning",
+    ], cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    async with httpx.AsyncClient() as client:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("API server exited during startup")
+            try:
+                await client.get(f"http://127.0.0.1:{port}/")
+                return server, time.perf_counter() - started
+            except httpx.HTTPError:
+                await asyncio.sleep(0.02)
+
+
+async def first_requests(port: int, run: int) -> list[float]:
+    email = f"cold-start-{run}@example.com"
+    latencies = []
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120) as client:
+        await client.post("/signup", json={"email": email, "password": "bench", "name": "Cold Start"})
+        for question in ("What are the latest treatments for Type 2 Diabetes?",
+                         "How does AI help in diagnosing lung cancer?"):
+            started = time.perf_counter()
+            response = await client.post("/chatendpoint", json={
+                "email": email, "query": question, "enable_deepsearch": False, "is_doctor": False})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def main_async(args: argparse.Namespace) -> dict:
+    workdir = tempfile.mkdtemp(prefix="cold-start-")
+    fake_port = free_port()
+    env = server_env(fake_port, workdir, not args.no_warm_up)
+    fake = subprocess.Popen([
+        sys.executable, "-m", "benchmark.fake_upstreams", "--port", str(fake_port),
+        "--llm-latency-ms", str(args.llm_latency_ms), "--tavily-latency-ms", str(args.tavily_latency_ms),
+    ], cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    imports, ready, first, second = [], [], [], []
+    try:
+        await wait_until_up(f"http://127.0.0.1:{fake_port}/stats")
+        for run in range(args.repeat):
+            imports.append(await asyncio.to_thread(import_seconds, env))
+            port = free_port()
+            server, seconds = await start_server(env, port)
+            ready.append(seconds)
+            try:
+                latencies = await first_requests(port, run)
+                first.append(latencies[0])
+                second.append(latencies[1])
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+    finally:
+        fake.terminate()
+        fake.wait(timeout=10)
+
+    return {
+        "warm_up": not args.no_warm_up,
+        "import_seconds": summarize(imports),
+        "ready_seconds": summarize(ready),
+        "first_request_seconds": summarize(first),
+        "second_request_seconds": summarize(second),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark against fake Gemini and Tavily")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh servers to start")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--tavily-latency-ms", type=float, default=200)
+    parser.add_argument("--no-warm-up", action="store_true", help="start the server with UPSTREAM_WARM_UP=0")
+    parser.add_argument("--target-ready-seconds", type=float, default=None,
+                        help="exit with status 1 when the p95 time to ready is above this")
+    parser.add_argument("--output", default=None, help="optional path of the JSON report")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+    print(json.dumps(report, indent=4))
+    if args.target_ready_seconds is not None and report["ready_seconds"]["p95"] > args.target_ready_seconds:
+        print(f"Time to ready is above the {args.target_ready_seconds}s target")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Local stand-ins for Gemini (OpenAI-compatible chat completions) and Tavily.
+
+The fake model follows a fixed script based on the tools it is offered, so
+every agent in the pipeline makes its usual tool calls without any API cost:
+
+    python -m benchmark.fake_upstreams --port 8900 --llm-latency-ms 300
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from collections import Counter
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+# Queries containing this marker make the requirement agent ask the user a question first
+ASK_MARKER = "[ask]"
+DEEP_STAGES = ["Planning_Agent", "Search_Agent", "Synthesis_Agent", "Reflection_Agent", "Citation_Agent"]
+
+app = FastAPI()
+calls: Counter = Counter()
+settings = {"llm_latency": 0.3, "tavily_latency": 0.2, "tokens_per_second": 400.0, "answer_words": 120}
+
+
+def _text(content) -> str:
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def _next_tool(messages: list[dict], tools: list[str]) -> str | None:
+    system = _text(messages[0].get("content")).lower() if messages and messages[0]["role"] == "system" else ""
+    last_user = max((i for i, m in enumerate(messages) if m["role"] == "user"), default=0)
+    first_user = next((_text(m.get("content")) for m in messages if m["role"] == "user"), "")
+    called_since_user = set()
+    called_ever = set()
+    for i, message in enumerate(messages):
+        for call in message.get("tool_calls") or []:
+            called_ever.add(call["function"]["name"])
+            if i > last_user:
+                called_since_user.add(call["function"]["name"])
+
+    wants_question = ASK_MARKER in first_user and "question_from_user" not in called_ever
+    if "Planning_Agent" in tools:
+        plan = DEEP_STAGES
+    elif "Lead_Research_Agent" in tools and "requirement gathering" in system:
+        plan = (["question_from_user"] if wants_question else []) + ["Lead_Research_Agent"]
+    elif "question_from_user" in tools:
+        plan = (["question_from_user"] if wants_question else []) + ["web_search"]
+    elif "extract_url" in tools:
+        plan = ["web_search", "extract_url"]
+    elif "lookup_evidence" in tools:
+        plan = ["lookup_evidence"]
+    elif "web_search" in tools:
+        plan = ["web_search"]
+    else:
+        plan = []
+    return next((tool for tool in plan if tool not in called_since_user), None)
+
+
+def _arguments(tool: str, messages: list[dict]) -> str:
+    query = next((_text(m.get("content")) for m in reversed(messages) if m["role"] == "user"), "")[:200]
+    if tool == "web_search":
+        return json.dumps({"query": query})
+    if tool == "multi_search":
+        return json.dumps({"queries": [query, f"{query} treatment"]})
+    if tool == "extract_url":
+        return json.dumps({"urls": ["https://www.nih.gov/page-1", "https://www.cdc.gov/page-2"], "query": query})
+    if tool == "lookup_evidence":
+        return json.dumps({"claim": query})
+    if tool == "question_from_user":
+        return json.dumps({"question": "Is this for an adult or a child?"})
+    if tool == "Lead_Research_Agent":
+        return json.dumps({})
+    return json.dumps({"input": query})
+
+
+def _answer_text() -> str:
+    words = ["Clinical", "evidence", "suggests", "that", "early", "treatment", "improves", "outcomes."]
+    return " ".join(words[i % len(words)] for i in range(settings["answer_words"]))
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    tools = [tool["function"]["name"] for tool in body.get("tools") or []]
+    tool = _next_tool(messages, tools)
+    calls["llm"] += 1
+    await asyncio.sleep(settings["llm_latency"])
+
+    prompt_tokens = sum(len(_text(m.get("content")).split()) for m in messages)
+    created = int(time.time())
+    model = body.get("model", "fake")
+    if tool is not None:
+        message = {"role": "assistant", "content": None, "tool_calls": [{
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+            "type": "function",
+            "function": {"name": tool, "arguments": _arguments(tool, messages)},
+        }]}
+        finish_reason, completion_tokens = "tool_calls", 20
+    else:
+        message = {"role": "assistant", "content": _answer_text()}
+        finish_reason, completion_tokens = "stop", settings["answer_words"]
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+             "total_tokens": prompt_tokens + completion_tokens}
+
+    if not body.get("stream"):
+        return JSONResponse({
+            "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": created,
+            "model": model, "usage": usage,
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        })
+
+    async def chunks():
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def frame(delta: dict, finish: str | None = None, **extra) -> str:
+            data = {"id": chunk_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}], **extra}
+            return f"data: {json.dumps(data)}\n\n"
+
+        if message.get("tool_calls"):
+            call = message["tool_calls"][0]
+            yield frame({"role": "assistant", "tool_calls": [{"index": 0, **call}]})
+        else:
+            words = message["content"].split(" ")
+            delay = 1 / settings["tokens_per_second"]
+            for i, word in enumerate(words):
+                yield frame({"role": "assistant", "content": word if i == 0 else f" {word}"})
+                await asyncio.sleep(delay)
+        yield frame({}, finish_reason, usage=usage)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(chunks(), media_type="text/event-stream")
+
+
+@app.post("/search")
+async def search(request: Request):
+    body = await request.json()
+    calls["tavily_search"] += 1
+    await asyncio.sleep(settings["tavily_latency"])
+    query = body.get("query", "")
+    results = [{
+        "title": f"Result {i} for {query[:40]}",
+        "url": f"https://example-{i}.org/{abs(hash(query)) % 1000}",
+        "content": f"Snippet {i} about {query}. " * 5,
+        "score": round(1 - i * 0.1, 2),
+        "raw_content": None,
+    } for i in range(body.get("max_results") or 5)]
+    return {"query": query, "results": results, "response_time": settings["tavily_latency"]}
+
+
+@app.post("/extract")
+async def extract(request: Request):
+    body = await request.json()
+    urls = body.get("urls", [])
+    urls = [urls] if isinstance(urls, str) else urls
+    calls["tavily_extract"] += 1
+    await asyncio.sleep(settings["tavily_latency"])
+    results = [{"url": url, "raw_content": f"Full page text of {url}. " * 200, "images": []} for url in urls]
+    return {"results": results, "failed_results": [], "response_time": settings["tavily_latency"]}
+
+
+@app.get("/stats")
+def stats():
+    return dict(calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Gemini and Tavily servers for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--tavily-latency-ms", type=float, default=200)
+    parser.add_argument("--tokens-per-second", type=float, default=400)
+    parser.add_argument("--answer-words", type=int, default=120)
+    args = parser.parse_args()
+    settings.update(
+        llm_latency=args.llm_latency_ms / 1000,
+        tavily_latency=args.tavily_latency_ms / 1000,
+        tokens_per_second=args.tokens_per_second,
+        answer_words=args.answer_words,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""Offline load test for /chatendpoint, /answer_user, /jobs and /ws/{user_email}.
+
+Starts the fake upstreams and the API server as subprocesses, drives
+simulated users through the chosen scenarios and writes a JSON report:
+
+    python -m benchmark.load_test --users 20 --iterations 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+import websockets
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["quick_http", "deep_http", "ask_http", "quick_ws", "deep_ws", "ask_ws", "deep_job", "ask_job"]
+QUESTIONS = [
+    "How has artificial intelligence changed healthcare from 2020 to 2024?",
+    "What are the reasons of having paralysis attack and treatment?",
+    "What are the latest treatments for Type 2 Diabetes?",
+    "What are the recommended guidelines for managing hypertension in adults?",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss_mb(pid: int) -> float | None:
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return round(ordered[index], 4)
+
+
+def summarize(values: list[float]) -> dict:
+    if not values:
+        return {}
+    return {
+        "count": len(values),
+        "mean": round(statistics.fmean(values), 4),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": round(max(values), 4),
+    }
+
+
+async def wait_until_up(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def http_flow(client: httpx.AsyncClient, email: str, query: str, deep: bool, ask: bool, engine: str) -> dict:
+    if ask:
+        query = f"{query} [ask]"
+    response = await client.post("/chatendpoint", json={
+        "email": email, "query": query, "enable_deepsearch": deep, "is_doctor": False, "engine": engine})
+    result = response.json() or {}
+    if ask and result.get("type") == "ask_user":
+        response = await client.post("/answer_user", json={"email": email, "answer": "An adult."})
+        result = response.json() or {}
+    return {"ok": result.get("type") == "answer", "first_event": None}
+
+
+async def job_flow(client: httpx.AsyncClient, email: str, query: str, deep: bool, ask: bool, engine: str) -> dict:
+    started = time.perf_counter()
+    first_event = None
+    if ask:
+        query = f"{query} [ask]"
+    request = {"email": email, "query": query, "enable_deepsearch": deep, "is_doctor": False, "engine": engine}
+    while True:
+        job_id = (await client.post("/jobs", json=request)).json()["job_id"]
+        after = 0
+        while True:
+            page = (await client.get(f"/jobs/{job_id}/events", params={"after": after})).json()
+            if page["events"] and first_event is None:
+                first_event = time.perf_counter() - started
+            after = page["next_after"]
+            if page["status"] in ("completed", "failed") and not page["events"]:
+                break
+            if not page["events"]:
+                await asyncio.sleep(0.05)
+        job = (await client.get(f"/jobs/{job_id}")).json()
+        result = job["result"] or {}
+        if result.get("type") != "ask_user":
+            return {"ok": result.get("type") == "answer", "first_event": first_event}
+        request = {**request, "kind": "answer", "query": "An adult."}
+
+
+async def ws_flow(ws_url: str, email: str, query: str, deep: bool, ask: bool, engine: str) -> dict:
+    started = time.perf_counter()
+    first_event = None
+    if ask:
+        query = f"{query} [ask]"
+    async with websockets.connect(f"{ws_url}/ws/{email}", max_size=None) as ws:
+        await ws.send(json.dumps({"type": "query", "query": query, "enable_deepsearch": deep,
+                                  "is_doctor": False, "engine": engine, "stream": True}))
+        while True:
+            event = json.loads(await ws.recv())
+            if first_event is None:
+                first_event = time.perf_counter() - started
+            if event["type"] == "ask_user":
+                await ws.send(json.dumps({"type": "answer", "answer": "An adult.",
+                                          "enable_deepsearch": deep, "is_doctor": False, "stream": True}))
+            elif event["type"] in ("answer", "error"):
+                return {"ok": event["type"] == "answer", "first_event": first_event}
+
+
+async def run_user(index: int, args, base_url: str, ws_url: str, results: list[dict]) -> None:
+    email = f"bench-user-{index}@example.com"
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout) as client:
+        await client.post("/signup", json={"email": email, "password": "bench", "name": f"Bench {index}"})
+        for iteration in range(args.iterations):
+            scenario = args.scenarios[(index + iteration) % len(args.scenarios)]
+            # A unique number per run keeps the answer cache from short-circuiting the pipeline
+            query = f"{QUESTIONS[(index + iteration) % len(QUESTIONS)]} (case {index}-{iteration})"
+            deep = scenario.startswith("deep") or scenario.startswith("ask")
+            ask = scenario.startswith("ask")
+            started = time.perf_counter()
+            try:
+                if scenario.endswith("_job"):
+                    outcome = await asyncio.wait_for(
+                        job_flow(client, email, query, deep, ask, args.engine), args.timeout)
+                elif scenario.endswith("_ws"):
+                    outcome = await asyncio.wait_for(
+                        ws_flow(ws_url, email, query, deep, ask, args.engine), args.timeout)
+                else:
+                    outcome = await http_flow(client, email, query, deep, ask, args.engine)
+                error = None if outcome["ok"] else "no answer"
+            except Exception as e:
+                outcome, error = {"ok": False, "first_event": None}, f"{type(e).__name__}: {e}"
+            results.append({
+                "scenario": scenario,
+                "latency": time.perf_counter() - started,
+                "first_event": outcome["first_event"],
+                "error": error,
+            })
+
+
+def compaction_totals(metrics_text: str) -> dict:
+    """Sum the compaction counters from /metrics into bytes and tokens in and out"""
+    totals: dict[str, float] = {}
+    for line in metrics_text.splitlines():
+        for unit in ("bytes", "tokens"):
+            if line.startswith(f"medassistant_compaction_{unit}_total{{"):
+                stage = "in" if 'stage="in"' in line else "out"
+                key = f"{unit}_{stage}"
+                totals[key] = totals.get(key, 0) + float(line.rsplit(" ", 1)[1])
+    return totals
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def main_async(args) -> dict:
+    fake_port, api_port = free_port(), free_port()
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    env = dict(os.environ)
+    env.update({
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1/",
+        "TAVILY_BASE_URL": f"http://127.0.0.1:{fake_port}",
+        "GEMINI_API_KEY": "bench", "TAVILY_API_KEY": "bench", "OPENAI_API_KEY": "bench",
+        "OPENAI_AGENTS_DISABLE_TRACING": "1",
+        "USER_DB": os.path.join(workdir, "users.db"),
+        "SESSION_DB": os.path.join(workdir, "sessions.db"),
+        "DOC_STORE_DIR": os.path.join(workdir, "doc_store"),
+        "JOB_DB": os.path.join(workdir, "jobs.db"),
+        "RUN_STATE_DB": os.path.join(workdir, "run_state.db"),
+        "AGENT_MEMO_DB": os.path.join(workdir, "agent_memo.db"),
+        "GEMINI_RATE_PER_SECOND": "1000", "GEMINI_BURST": "1000", "GEMINI_MAX_CONCURRENCY": "256",
+        "TAVILY_RATE_PER_SECOND": "1000", "TAVILY_BURST": "1000", "TAVILY_MAX_CONCURRENCY": "256",
+    })
+    if args.warm:
+        env["AGENT_MEMO_ENABLED"] = "1"
+    else:
+        env.update({"SEARCH_CACHE_MAX_ENTRIES": "0", "DOC_STORE_TTL_SECONDS": "0", "ANSWER_CACHE_THRESHOLD": "2",
+                    "AGENT_MEMO_ENABLED": "0"})
+    for override in args.env:
+        key, _, value = override.partition("=")
+        env[key] = value
+
+    fake = subprocess.Popen([
+        sys.executable, "-m", "benchmark.fake_upstreams", "--port", str(fake_port),
+        "--llm-latency-ms", str(args.llm_latency_ms), "--tavily-latency-ms", str(args.tavily_latency_ms),
+    ], cwd=BACKEND_DIR, env=env)
+    server = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "main:app", "--port", str(api_port), "--log-level", "warning",
+        "--workers", str(args.workers),
+    ], cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL if args.quiet else None)
+    base_url = f"http://127.0.0.1:{api_port}"
+    try:
+        await wait_until_up(f"http://127.0.0.1:{fake_port}/stats")
+        await wait_until_up(base_url)
+
+        results: list[dict] = []
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            run_user(i, args, base_url, f"ws://127.0.0.1:{api_port}", results) for i in range(args.users)))
+        wall = time.perf_counter() - started
+
+        async with httpx.AsyncClient() as client:
+            upstream_calls = (await client.get(f"http://127.0.0.1:{fake_port}/stats")).json()
+            compaction = compaction_totals((await client.get(f"{base_url}/metrics")).text)
+            prefetch = (await client.get(f"{base_url}/cache/stats")).json().get("prefetch", {})
+        rss = peak_rss_mb(server.pid)
+    finally:
+        server.terminate()
+        fake.terminate()
+        server.wait()
+        fake.wait()
+
+    ok = [r for r in results if not r["error"]]
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "quiet")},
+        "runs": len(results),
+        "errors": len(results) - len(ok),
+        "error_samples": sorted({r["error"] for r in results if r["error"]})[:5],
+        "wall_seconds": round(wall, 3),
+        "runs_per_second": round(len(ok) / wall, 3) if wall else 0.0,
+        "latency": summarize([r["latency"] for r in ok]),
+        "time_to_first_event": summarize([r["first_event"] for r in ok if r["first_event"] is not None]),
+        "by_scenario": {
+            scenario: summarize([r["latency"] for r in ok if r["scenario"] == scenario])
+            for scenario in args.scenarios
+        },
+        "upstream_calls": upstream_calls,
+        "upstream_calls_per_run": {k: round(v / len(results), 2) for k, v in upstream_calls.items()} if results else {},
+        "compaction": compaction,
+        "compaction_saved_per_run": {
+            "bytes": round((compaction.get("bytes_in", 0) - compaction.get("bytes_out", 0)) / len(results)),
+            "tokens": round((compaction.get("tokens_in", 0) - compaction.get("tokens_out", 0)) / len(results)),
+        } if results else {},
+        "prefetch": prefetch,
+        "server_peak_rss_mb": rss,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against fake Gemini and Tavily")
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--iterations", type=int, default=2, help="runs per user")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--engine", default="orchestrator", choices=["orchestrator", "dag"])
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--tavily-latency-ms", type=float, default=200)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--warm", action="store_true", help="keep the search, document, answer and agent tool caches enabled")
+    parser.add_argument("--env", nargs="*", default=[], help="extra KEY=VALUE settings for the server")
+    parser.add_argument("--output", default=None, help="report path, defaults to bench_results/<revision>-<time>.json")
+    parser.add_argument("--quiet", action="store_true", help="hide server output")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench_results", f"{report['revision']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=4)
+    print(json.dumps({k: report[k] for k in ("runs", "errors", "runs_per_second", "latency",
+                                              "time_to_first_event", "compaction_saved_per_run",
+                                              "server_peak_rss_mb")}, indent=4))
+    print(f"Report saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
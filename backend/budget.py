@@ -0,0 +1,65 @@
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+
+class BudgetExhausted(Exception):
+    """Raised before an upstream call once the run is past its deadline or token budget"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Run budget exhausted: {reason}")
+        self.reason = reason
+
+
+@dataclass
+class RunBudget:
+    """Deadline and LLM token budget of one run.
+
+    Past low_fraction of either, optional stages are skipped. Once either is
+    used up no new upstream call is started and the run ends with a partial
+    answer.
+    """
+    deadline_seconds: float
+    max_tokens: int
+    low_fraction: float = 0.8
+    started: float = field(default_factory=time.monotonic)
+    call_tokens: int = 0
+    stream_tokens: int = 0
+    skipped: list[str] = field(default_factory=list)
+
+    @property
+    def tokens(self) -> int:
+        return self.call_tokens + self.stream_tokens
+
+    def add_tokens(self, tokens: int) -> None:
+        self.call_tokens += tokens
+
+    def remaining_seconds(self) -> float:
+        return max(0.0, self.deadline_seconds - (time.monotonic() - self.started))
+
+    def used_fraction(self) -> float:
+        time_used = (time.monotonic() - self.started) / self.deadline_seconds if self.deadline_seconds > 0 else 0.0
+        tokens_used = self.tokens / self.max_tokens if self.max_tokens > 0 else 0.0
+        return max(time_used, tokens_used)
+
+    def low(self) -> bool:
+        return self.used_fraction() >= self.low_fraction
+
+    def stop_reason(self) -> str | None:
+        if self.deadline_seconds > 0 and self.remaining_seconds() <= 0:
+            return "deadline"
+        if self.max_tokens > 0 and self.tokens >= self.max_tokens:
+            return "token_budget"
+        return None
+
+    def check(self) -> None:
+        reason = self.stop_reason()
+        if reason is not None:
+            raise BudgetExhausted(reason)
+
+    def skip(self, stage: str) -> None:
+        if stage not in self.skipped:
+            self.skipped.append(stage)
+
+
+current_budget: ContextVar[RunBudget | None] = ContextVar("current_budget", default=None)
@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Any, Awaitable, Callable
+
+
+def make_cache_key(*parts: Any, **params: Any) -> str:
+    """Stable hash of the given parts and keyword parameters"""
+    payload = json.dumps([parts, params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    errors: int = 0
+    evictions: int = 0
+    fetch_seconds: float = 0.0
+
+    def snapshot(self) -> dict:
+        data = asdict(self)
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses + self.coalesced
+        avg_fetch = self.fetch_seconds / self.misses if self.misses else 0.0
+        data["hits"] = hits
+        data["hit_rate"] = round(hits / lookups, 4) if lookups else 0.0
+        data["avg_fetch_seconds"] = round(avg_fetch, 4)
+        # Every hit or coalesced waiter is one upstream round-trip we did not make
+        data["upstream_calls_saved"] = hits + self.coalesced
+        data["seconds_saved_estimate"] = round(
+            avg_fetch * (hits + self.coalesced), 3)
+        return data
+
+
+class SQLiteCacheTier:
+    """Persistent key/value tier with a per-entry expiry time"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get(self, namespace: str, key: str) -> tuple[Any, float] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= time.time():
+                self._conn.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key = ?",
+                    (namespace, key),
+                )
+                self._conn.commit()
+                return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, namespace: str, key: str, value: Any, expires_at: float) -> None:
+        data = json.dumps(value, default=str)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, data, expires_at),
+            )
+            self._conn.commit()
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+            self._conn.commit()
+            return cursor.rowcount
+
+
+class TieredCache:
+    """Bounded in-memory LRU in front of an optional SQLite tier.
+
+    Concurrent lookups for the same key share a single in-flight fetch.
+    """
+
+    def __init__(self, namespace: str, max_entries: int = 1024, ttl_seconds: float = 3600,
+                 disk: SQLiteCacheTier | None = None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk = disk
+        self.stats = CacheStats()
+        self._memory: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    def _memory_get(self, key: str) -> Any | None:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.time():
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        return value
+
+    def _memory_set(self, key: str, value: Any, expires_at: float) -> None:
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats.evictions += 1
+
+    async def get(self, key: str) -> Any | None:
+        value = self._memory_get(key)
+        if value is not None:
+            return value
+        if self.disk is not None:
+            entry = await asyncio.to_thread(self.disk.get, self.namespace, key)
+            if entry is not None:
+                self._memory_set(key, entry[0], entry[1])
+                return entry[0]
+        return None
+
+    async def set(self, key: str, value: Any, ttl_seconds: float | None = None) -> None:
+        expires_at = time.time() + (ttl_seconds or self.ttl_seconds)
+        self._memory_set(key, value, expires_at)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.set, self.namespace, key, value, expires_at)
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Any]],
+                           ttl_seconds: float | None = None) -> Any:
+        value = self._memory_get(key)
+        if value is not None:
+            self.stats.memory_hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats.coalesced += 1
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(self._load(key, fetch, ttl_seconds))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str, fetch: Callable[[], Awaitable[Any]],
+                    ttl_seconds: float | None) -> Any:
+        if self.disk is not None:
+            entry = await asyncio.to_thread(self.disk.get, self.namespace, key)
+            if entry is not None:
+                self.stats.disk_hits += 1
+                self._memory_set(key, entry[0], entry[1])
+                return entry[0]
+
+        self.stats.misses += 1
+        started = time.perf_counter()
+        try:
+            value = await fetch()
+        except Exception:
+            self.stats.errors += 1
+            raise
+        finally:
+            self.stats.fetch_seconds += time.perf_counter() - started
+        await self.set(key, value, ttl_seconds)
+        return value
+
+    def snapshot(self) -> dict:
+        data = self.stats.snapshot()
+        data["namespace"] = self.namespace
+        data["memory_entries"] = len(self._memory)
+        data["inflight"] = len(self._inflight)
+        data["persistent"] = self.disk is not None
+        return data
@@ -1,25 +1,163 @@
-from tavily import AsyncTavilyClient
+import asyncio
+import importlib.util
+import logging
 import os
+import time
+import httpx
 from agents import OpenAIChatCompletionsModel, AsyncOpenAI
-from dotenv import load_dotenv, find_dotenv 
+from governor import Upstream, GovernedOpenAI, GovernedTavilyClient
+from settings import load_env
 
-__ : bool = load_dotenv(find_dotenv())
+load_env()
+logger = logging.getLogger(__name__)
 
 tavily_api_key: str | None = os.getenv("TAVILY_API_KEY")
 gemini_api_key: str | None = os.getenv("GEMINI_API_KEY")
+# Overridable so benchmarks can point both clients at local fake servers
+gemini_base_url: str = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta/openai/")
+tavily_base_url: str = os.getenv("TAVILY_BASE_URL", "https://api.tavily.com")
 
-
-tavily_client : AsyncTavilyClient = AsyncTavilyClient(
-    api_key=tavily_api_key,
+# Admission control for each upstream, retries are handled here instead of in the SDKs
+gemini_upstream: Upstream = Upstream(
+    name="gemini",
+    rate_per_second=float(os.getenv("GEMINI_RATE_PER_SECOND", "5")),
+    burst=int(os.getenv("GEMINI_BURST", "10")),
+    max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")),
+    max_retries=int(os.getenv("UPSTREAM_MAX_RETRIES", "3")),
+)
+tavily_upstream: Upstream = Upstream(
+    name="tavily",
+    rate_per_second=float(os.getenv("TAVILY_RATE_PER_SECOND", "5")),
+    burst=int(os.getenv("TAVILY_BURST", "10")),
+    max_concurrency=int(os.getenv("TAVILY_MAX_CONCURRENCY", "8")),
+    max_retries=int(os.getenv("UPSTREAM_MAX_RETRIES", "3")),
 )
 
-external_client: AsyncOpenAI = AsyncOpenAI(
-    api_key=gemini_api_key,
-    base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
+
+class TavilyAPI:
+    """Tavily's /search and /extract endpoints called on a shared httpx pool.
+
+    Sends the same JSON bodies as the tavily-python SDK, options left as None
+    are not sent. Failed requests raise httpx.HTTPStatusError, whose status
+    code the governor's retry policy reads.
+    """
+
+    def __init__(self, pool: httpx.AsyncClient):
+        self.pool = pool
+
+    async def _post(self, path: str, data: dict, timeout: float) -> dict:
+        response = await self.pool.post(path, json={key: value for key, value in data.items() if value is not None},
+                                         timeout=min(timeout, 120))
+        response.raise_for_status()
+        return response.json()
+
+    async def search(self, query: str, max_results: int | None = None, timeout: float = 60, **options) -> dict:
+        response = await self._post("/search", {"query": query, "max_results": max_results, **options}, timeout)
+        response.setdefault("results", [])
+        return response
+
+    async def extract(self, urls: list[str] | str, timeout: float = 60, **options) -> dict:
+        return await self._post("/extract", {"urls": urls, **options}, timeout)
+
+
+class UpstreamClients:
+    """Gemini and Tavily clients on shared keep-alive connection pools.
+
+    Nothing is built at import: each client and its pool are created on
+    first use and kept for the life of the process. Tavily is called through
+    its HTTP API on the pool, the SDK opens a new connection per request.
+    HTTP/2 is used when the optional h2 package is installed. warm_up opens
+    connections before the first run needs them, close releases them at
+    shutdown.
+    """
+
+    def __init__(self, max_connections: int = 32, max_keepalive: int = 16,
+                 keepalive_seconds: float = 60, http2: bool = True):
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_seconds)
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        if http2 and not self.http2:
+            logger.info("h2 is not installed, upstream pools use HTTP/1.1")
+        self._gemini: AsyncOpenAI | None = None
+        self._tavily: TavilyAPI | None = None
+        self._pools: dict[str, httpx.AsyncClient] = {}
+        self.warm_up_seconds: dict[str, float] = {}
+
+    def _pool(self, name: str, **kwargs) -> httpx.AsyncClient:
+        pool = httpx.AsyncClient(http2=self.http2, limits=self.limits, **kwargs)
+        self._pools[name] = pool
+        return pool
+
+    def gemini(self) -> AsyncOpenAI:
+        if self._gemini is None:
+            self._gemini = AsyncOpenAI(
+                api_key=gemini_api_key,
+                base_url=gemini_base_url,
+                max_retries=0,
+                http_client=self._pool("gemini", timeout=httpx.Timeout(600, connect=5)),
+            )
+        return self._gemini
+
+    def tavily(self) -> TavilyAPI:
+        if self._tavily is None:
+            proxies = {scheme: os.getenv(variable) for scheme, variable in
+                       (("http://", "TAVILY_HTTP_PROXY"), ("https://", "TAVILY_HTTPS_PROXY"))}
+            pool = self._pool(
+                "tavily",
+                base_url=tavily_base_url,
+                headers={"Authorization": f"Bearer {tavily_api_key}"},
+                mounts={scheme: httpx.AsyncHTTPTransport(proxy=proxy)
+                        for scheme, proxy in proxies.items() if proxy} or None,
+                timeout=httpx.Timeout(60, connect=5),
+            )
+            self._tavily = TavilyAPI(pool)
+        return self._tavily
+
+    async def warm_up(self, timeout: float = 5) -> dict[str, float]:
+        """Open a connection to each upstream, the status of the response does not matter"""
+        targets = {"gemini": (self.gemini, gemini_base_url),
+                   "tavily": (self.tavily, tavily_base_url)}
+
+        async def connect(name: str, client, url: str) -> None:
+            client()
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(self._pools[name].head(url), timeout)
+                self.warm_up_seconds[name] = round(time.perf_counter() - started, 4)
+            except Exception as e:
+                logger.warning("Warm-up of %s failed: %s", name, e)
+
+        await asyncio.gather(*(connect(name, client, url) for name, (client, url) in targets.items()))
+        logger.info("Upstream connections warmed up: %s", self.warm_up_seconds)
+        return self.warm_up_seconds
+
+    async def close(self) -> None:
+        await asyncio.gather(*(pool.aclose() for pool in self._pools.values()), return_exceptions=True)
+        self._pools.clear()
+        self._gemini = None
+        self._tavily = None
+
+    def stats(self) -> dict:
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "open_pools": sorted(self._pools),
+            "warm_up_seconds": self.warm_up_seconds,
+        }
+
+
+upstream_clients: UpstreamClients = UpstreamClients(
+    max_connections=int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "32")),
+    max_keepalive=int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "16")),
+    keepalive_seconds=float(os.getenv("UPSTREAM_KEEPALIVE_SECONDS", "60")),
+    http2=os.getenv("UPSTREAM_HTTP2", "1") == "1",
 )
 
+tavily_client : GovernedTavilyClient = GovernedTavilyClient(upstream_clients.tavily, tavily_upstream)
+
 # defining which llm model to use
 llm_model: OpenAIChatCompletionsModel = OpenAIChatCompletionsModel(
     model="gemini-2.5-flash",
-    openai_client=external_client,
+    openai_client=GovernedOpenAI(upstream_clients.gemini, gemini_upstream),
 )
@@ -0,0 +1,216 @@
+import math
+import re
+import zlib
+from collections import Counter
+from dataclasses import dataclass, field
+import numpy as np
+
+TOKEN = re.compile(r"[a-z0-9]+")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how in is it of on or that the this to was were what "
+    "when which who why will with".split()
+)
+_MERSENNE = (1 << 61) - 1
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for Gemini style tokenizers, about four characters per token"""
+    return (len(text) + 3) // 4
+
+
+def tokenize(text: str) -> list[str]:
+    return [word for word in TOKEN.findall(text.lower()) if word not in STOPWORDS]
+
+
+def split_passages(text: str, max_words: int = 120, min_words: int = 8) -> list[str]:
+    """Split page text into passages of whole sentences, at most max_words each.
+
+    Paragraph breaks always end a passage, fragments shorter than min_words
+    (menus, captions) are dropped from longer texts. A text with no passage
+    of min_words, such as a short search snippet, is kept whole.
+    """
+    passages = []
+    for paragraph in re.split(r"\n\s*\n|\r\n\s*\r\n", text):
+        current: list[str] = []
+        words = 0
+        for sentence in SENTENCE_END.split(" ".join(paragraph.split())):
+            length = len(sentence.split())
+            if current and words + length > max_words:
+                passages.append(" ".join(current))
+                current, words = [], 0
+            if length > max_words:
+                tokens = sentence.split()
+                for i in range(0, len(tokens), max_words):
+                    passages.append(" ".join(tokens[i:i + max_words]))
+                continue
+            current.append(sentence)
+            words += length
+        if current:
+            passages.append(" ".join(current))
+    kept = [passage for passage in passages if len(passage.split()) >= min_words]
+    text_words = text.split()
+    if not kept and text_words:
+        return [" ".join(text_words[:max_words])]
+    return kept
+
+
+class MinHasher:
+    """MinHash signatures over word 3-gram shingles with LSH banding"""
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, seed: int = 11):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self._a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        words = TOKEN.findall(text.lower())
+        shingles = {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+        return ((np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE).min(axis=1)
+
+    def band_keys(self, signature: np.ndarray) -> list[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+
+class BM25:
+    """Okapi BM25 over a small in-memory passage set"""
+
+    def __init__(self, documents: list[list[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(doc) for doc in documents]
+        self.lengths = [len(doc) for doc in documents]
+        self.avg_length = sum(self.lengths) / len(documents) if documents else 0.0
+        df: Counter = Counter()
+        for counts in self.term_counts:
+            df.update(counts.keys())
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - freq + 0.5) / (freq + 0.5)) for term, freq in df.items()}
+
+    def scores(self, query: list[str]) -> list[float]:
+        terms = [term for term in set(query) if term in self.idf]
+        results = []
+        for counts, length in zip(self.term_counts, self.lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / (self.avg_length or 1))
+            for term in terms:
+                tf = counts.get(term, 0)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            results.append(score)
+        return results
+
+
+@dataclass
+class CompactionStats:
+    documents: int = 0
+    passages_in: int = 0
+    duplicates: int = 0
+    passages_out: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    tokens_in: int = 0
+    tokens_out: int = 0
+
+    def add(self, other: "CompactionStats") -> None:
+        for name in self.__dataclass_fields__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def snapshot(self) -> dict:
+        return {
+            **{name: getattr(self, name) for name in self.__dataclass_fields__},
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "tokens_saved": self.tokens_in - self.tokens_out,
+        }
+
+
+@dataclass
+class Passage:
+    url: str
+    title: str
+    content: str
+    score: float = 0.0
+    also_in: list[str] = field(default_factory=list)
+
+    def as_result(self) -> dict:
+        result = {"url": self.url, "title": self.title, "content": self.content, "score": round(self.score, 3)}
+        if self.also_in:
+            result["also_in"] = self.also_in
+        return result
+
+
+class PassageCompactor:
+    """Turns raw search or extract results into the passages worth sending to the model.
+
+    Pages are split into passages, near-duplicates across sources are merged
+    (their URLs stay attached for citations), the rest are ranked against the
+    query with BM25 and kept in score order until token_budget is spent.
+    """
+
+    def __init__(self, passage_words: int = 120, dedup_threshold: float = 0.8,
+                 num_perm: int = 64, bands: int = 16):
+        self.passage_words = passage_words
+        self.dedup_threshold = dedup_threshold
+        self.hasher = MinHasher(num_perm, bands)
+
+    def _deduplicate(self, passages: list[Passage]) -> list[Passage]:
+        kept: list[Passage] = []
+        signatures: list[np.ndarray] = []
+        buckets: dict[bytes, list[int]] = {}
+        for passage in passages:
+            signature = self.hasher.signature(passage.content)
+            keys = self.hasher.band_keys(signature)
+            duplicate_of = None
+            for index in {i for key in keys for i in buckets.get(key, ())}:
+                if np.mean(signatures[index] == signature) >= self.dedup_threshold:
+                    duplicate_of = index
+                    break
+            if duplicate_of is not None:
+                original = kept[duplicate_of]
+                if passage.url != original.url and passage.url not in original.also_in:
+                    original.also_in.append(passage.url)
+                continue
+            for key in keys:
+                buckets.setdefault(key, []).append(len(kept))
+            kept.append(passage)
+            signatures.append(signature)
+        return kept
+
+    def compact(self, query: str, documents: list[dict], token_budget: int,
+                content_key: str = "content") -> tuple[list[dict], CompactionStats]:
+        """Rank the passages of documents (dicts with url, title and content_key) against query"""
+        stats = CompactionStats(documents=len(documents))
+        passages = []
+        for document in documents:
+            text = document.get(content_key) or ""
+            stats.bytes_in += len(text.encode("utf-8"))
+            stats.tokens_in += estimate_tokens(text)
+            for chunk in split_passages(text, self.passage_words):
+                passages.append(Passage(document.get("url", ""), document.get("title") or "", chunk))
+        stats.passages_in = len(passages)
+
+        unique = self._deduplicate(passages)
+        stats.duplicates = len(passages) - len(unique)
+        query_terms = tokenize(query)
+        if unique and query_terms:
+            for passage, score in zip(unique, BM25([tokenize(p.content) for p in unique]).scores(query_terms)):
+                passage.score = score
+        # Stable sort keeps the source order for passages that do not match the query at all
+        ranked = sorted(unique, key=lambda p: p.score, reverse=True)
+
+        selected = []
+        budget = token_budget
+        for passage in ranked:
+            cost = estimate_tokens(passage.content)
+            if cost > budget:
+                continue
+            selected.append(passage)
+            budget -= cost
+            stats.bytes_out += len(passage.content.encode("utf-8"))
+            stats.tokens_out += cost
+        stats.passages_out = len(selected)
+        return [passage.as_result() for passage in selected], stats
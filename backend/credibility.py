@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Marks a trie node that carries a tier, labels can never contain a space
+_TIER = " tier"
+
+
+def url_host(url: str) -> str:
+    """Lowercased host of a URL without scheme, credentials, port or a leading www."""
+    host = url.split("//", 1)[-1]
+    for separator in "/?#":
+        host = host.split(separator, 1)[0]
+    host = host.rsplit("@", 1)[-1].split(":", 1)[0].lower().rstrip(".")
+    return host[4:] if host.startswith("www.") else host
+
+
+class CredibilityScorer:
+    """Domain reputation from a reverse-domain suffix trie.
+
+    Rules map domain suffixes ("gov", "nhs.uk", "nejm.org") to a tier, the
+    longest matching suffix of a host wins and medical overrides are applied
+    on top of the generic rules. Results are memoized per URL authority.
+    """
+
+    def __init__(self, ruleset: dict):
+        self.version: str = ruleset.get("version", "unversioned")
+        self.scores: dict[str, float] = ruleset["scores"]
+        self.default: str = ruleset.get("default", "unrated")
+        self._trie: dict = {}
+        for rules in (ruleset.get("rules", {}), ruleset.get("medical_overrides", {})):
+            for suffix, tier in rules.items():
+                if tier not in self.scores:
+                    raise ValueError(f"Unknown credibility tier {tier!r} for {suffix}")
+                node = self._trie
+                for label in reversed(suffix.lower().split(".")):
+                    node = node.setdefault(label, {})
+                node[_TIER] = tier
+        self._hosts: dict[str, tuple[str, float]] = {}
+
+    @classmethod
+    def from_file(cls, path: str) -> "CredibilityScorer":
+        with open(path, "r") as file:
+            scorer = cls(json.load(file))
+        logger.info("Loaded credibility ruleset %s from %s", scorer.version, path)
+        return scorer
+
+    def _match(self, host: str) -> tuple[str, float]:
+        tier = self.default
+        node = self._trie
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            tier = node.get(_TIER, tier)
+        return tier, self.scores[tier]
+
+    def score(self, url: str) -> tuple[str, float]:
+        # Memoized on the raw authority part, the full host parse only runs on a miss
+        parts = url.split("/", 3)
+        authority = parts[2] if len(parts) > 2 and parts[0].endswith(":") and not parts[1] else url
+        result = self._hosts.get(authority)
+        if result is None:
+            if len(self._hosts) >= 100_000:
+                self._hosts.clear()
+            result = self._hosts[authority] = self._match(url_host(url))
+        return result
+
+    def score_many(self, urls: list[str]) -> list[tuple[str, float]]:
+        return [self.score(url) for url in urls]
+
+    def annotate(self, results: list[dict]) -> list[dict]:
+        """Add credibility and credibility_score to result dicts with a url, in place"""
+        for result in results:
+            result["credibility"], result["credibility_score"] = self.score(result.get("url", ""))
+        return results
+
+
+credibility_scorer: CredibilityScorer = CredibilityScorer.from_file(
+    os.getenv("CREDIBILITY_RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "credibility_rules.json"))
+)
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import AsyncIterator
+from agents import Agent, Runner
+from lead_agent import planning_agent, search_agent, synthesis_agent, reflection_agent, citation_agent, convergence
+from tools import UserInfo
+from telemetry import span
+from budget import BudgetExhausted, current_budget
+from evidence import current_evidence
+from router import current_route
+
+logger = logging.getLogger(__name__)
+PLAN_ITEM = re.compile(r"^\s*(?:\d+[.)]|[-*•])\s+(.*\S)")
+
+
+async def gather_or_cancel(*coroutines) -> list:
+    """Like asyncio.gather, but the first exception cancels the coroutines still running and is raised as is"""
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(coroutine) for coroutine in coroutines]
+    except ExceptionGroup as errors:
+        raise errors.exceptions[0] from None
+    return [task.result() for task in tasks]
+
+
+def parse_plan(plan: str, max_tasks: int) -> list[str]:
+    """Pull the numbered or bulleted research tasks out of the planner output"""
+    tasks = []
+    for line in plan.splitlines():
+        match = PLAN_ITEM.match(line)
+        if match:
+            task = match.group(1).replace("**", "").strip()
+            if len(task) > 10 and task not in tasks:
+                tasks.append(task)
+    return tasks[:max_tasks]
+
+
+class DeepSearchPipeline:
+    """Runs the deep-search stages as a fixed DAG instead of an orchestrator LLM.
+
+    Planning -> Search (one run per sub-task, in parallel) -> Synthesis ->
+    Reflection and Citation (in parallel). Emits the same events as
+    CustomerSupportBot.run_agent. When the run budget is low Reflection and
+    Citation are skipped, when it runs out the answer is whatever was
+    synthesized so far, flagged as partial. On the standard tier at most
+    standard_subtasks sub-tasks are searched and the run ends at synthesis.
+    Sub-tasks still queued once the evidence has converged are not searched.
+    """
+
+    def __init__(self, max_parallel_searches: int = 4, max_subtasks: int = 6, standard_subtasks: int = 3):
+        self.max_parallel_searches = max_parallel_searches
+        self.max_subtasks = max_subtasks
+        self.standard_subtasks = standard_subtasks
+
+    async def _run_stage(self, agent: Agent, prompt: str, user_info: UserInfo, stats: dict) -> str:
+        budget = current_budget.get()
+        with span("stage", agent.name) as stage:
+            try:
+                result = await asyncio.wait_for(
+                    Runner.run(starting_agent=agent, input=prompt, context=user_info),
+                    budget.remaining_seconds() if budget is not None and budget.deadline_seconds > 0 else None)
+            except asyncio.TimeoutError:
+                raise BudgetExhausted("deadline") from None
+            usage = result.context_wrapper.usage
+            stage.tokens_in, stage.tokens_out = usage.input_tokens, usage.output_tokens
+        stats["llm_calls"] += usage.requests
+        return str(result.final_output)
+
+    async def run(self, user_query: str, user_info: UserInfo) -> AsyncIterator[dict]:
+        started = time.perf_counter()
+        stats = {"llm_calls": 0}
+        budget = current_budget.get()
+        research = synthesis = ""
+        try:
+            async for event in self._stages(user_query, user_info, stats):
+                if event["type"] == "stage_output":
+                    research, synthesis = event.get("research", research), event.get("synthesis", synthesis)
+                    continue
+                if event["type"] == "answer":
+                    event.update(llm_calls=stats["llm_calls"], elapsed_seconds=round(time.perf_counter() - started, 2))
+                    if budget is not None and budget.skipped:
+                        event.update(partial=True, skipped=budget.skipped, stop_reason="budget_low")
+                    logger.info("DAG deep search finished in %.1fs with %d LLM calls",
+                                event["elapsed_seconds"], stats["llm_calls"])
+                yield event
+        except BudgetExhausted as e:
+            logger.info("DAG deep search stopped early: %s", e.reason)
+            yield {
+                "type": "answer",
+                "output": synthesis or research or "The research could not be completed within the run budget.",
+                "engine": "dag",
+                "partial": True,
+                "stop_reason": e.reason,
+                "llm_calls": stats["llm_calls"],
+                "elapsed_seconds": round(time.perf_counter() - started, 2),
+            }
+
+    async def _stages(self, user_query: str, user_info: UserInfo, stats: dict) -> AsyncIterator[dict]:
+        budget = current_budget.get()
+        route = current_route.get()
+        standard = user_info.tier == "standard"
+
+        yield {"type": "agent_update", "output": f"Handing over to : {planning_agent.name}", "agent_name": planning_agent.name}
+        plan = await self._run_stage(
+            planning_agent,
+            f"Create a research plan for this question as a numbered list of "
+            f"independent web search tasks, one per line.\n\nQuestion: {user_query}",
+            user_info, stats,
+        )
+        tasks = parse_plan(plan, self.standard_subtasks if standard else self.max_subtasks) or [user_query]
+
+        yield {"type": "agent_update", "output": f"Handing over to : {search_agent.name}", "agent_name": search_agent.name}
+        for task in tasks:
+            yield {"type": "tool_call", "output": f"🔍 Searching for: {task}", "tool_name": "Search_Agent"}
+
+        semaphore = asyncio.Semaphore(self.max_parallel_searches)
+
+        async def search(task: str) -> str:
+            async with semaphore:
+                if route is not None and convergence.converged(current_evidence.get()):
+                    route.stop("converged")
+                    return "Not searched, the earlier sub-tasks already found no new sources."
+                try:
+                    return await self._run_stage(
+                        search_agent, f"Research question: {user_query}\nSub-task: {task}", user_info, stats)
+                except BudgetExhausted:
+                    raise
+                except Exception as e:
+                    logger.warning("Search sub-task failed (%s): %s", task, e)
+                    return f"Search failed: {e}"
+
+        findings = await gather_or_cancel(*(search(task) for task in tasks))
+        research = "\n\n".join(
+            f"### {task}\n{finding}" for task, finding in zip(tasks, findings))
+        yield {"type": "stage_output", "research": research}
+
+        yield {"type": "agent_update", "output": f"Handing over to : {synthesis_agent.name}", "agent_name": synthesis_agent.name}
+        synthesis = await self._run_stage(
+            synthesis_agent, f"Question: {user_query}\n\nResearch findings:\n{research}", user_info, stats)
+        yield {"type": "stage_output", "synthesis": synthesis}
+
+        if standard:
+            yield {"type": "answer", "output": synthesis, "engine": "dag"}
+            return
+
+        if budget is not None and budget.low():
+            budget.skip(reflection_agent.name)
+            budget.skip(citation_agent.name)
+            yield {"type": "answer", "output": synthesis, "engine": "dag"}
+            return
+
+        for agent in (reflection_agent, citation_agent):
+            yield {"type": "agent_update", "output": f"Handing over to : {agent.name}", "agent_name": agent.name}
+        reflection, citations = await gather_or_cancel(
+            self._run_stage(reflection_agent, f"Question: {user_query}\n\n{synthesis}\n\nSources:\n{research}", user_info, stats),
+            self._run_stage(citation_agent, f"Provide citations for:\n{synthesis}\n\nSources:\n{research}", user_info, stats),
+        )
+
+        yield {
+            "type": "answer",
+            "output": f"{synthesis}\n\n## Source Review\n{reflection}\n\n## References\n{citations}",
+            "engine": "dag",
+        }
+
+
+dag_pipeline: DeepSearchPipeline = DeepSearchPipeline(
+    max_parallel_searches=int(os.getenv("DAG_MAX_PARALLEL_SEARCHES", "4")),
+    max_subtasks=int(os.getenv("DAG_MAX_SUBTASKS", "6")),
+    standard_subtasks=int(os.getenv("DAG_STANDARD_SUBTASKS", "3")),
+)
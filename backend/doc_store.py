@@ -0,0 +1,129 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+TRACKING_PARAMS = {"fbclid", "gclid", "mc_cid", "mc_eid", "ref", "_ga"}
+
+
+def canonicalize_url(url: str) -> str:
+    """Normalize a URL so the same page always maps to the same key"""
+    parts = urlsplit(url.strip())
+    scheme = (parts.scheme or "https").lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and not ((scheme == "http" and parts.port == 80) or (scheme == "https" and parts.port == 443)):
+        host = f"{host}:{parts.port}"
+    path = parts.path or "/"
+    if len(path) > 1:
+        path = path.rstrip("/")
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith("utm_") and k.lower() not in TRACKING_PARAMS
+    )
+    return urlunsplit((scheme, host, path, urlencode(query), ""))
+
+
+@dataclass
+class StoredDocument:
+    url: str
+    content: str
+    content_hash: str
+    fetched_at: float
+
+    def as_result(self) -> dict:
+        return {
+            "url": self.url,
+            "raw_content": self.content,
+            "content_hash": self.content_hash,
+            "fetched_at": self.fetched_at,
+        }
+
+
+class DocumentStore:
+    """Extracted page text on disk, keyed by canonical URL.
+
+    Page bodies are zlib-compressed and stored by content hash, so the same
+    text reached through several URLs is written once.
+    """
+
+    def __init__(self, root_dir: str, ttl_seconds: float = 7 * 24 * 3600):
+        self.root_dir = root_dir
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(os.path.join(root_dir, "objects"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root_dir, "index.db"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                url TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def _object_path(self, content_hash: str) -> str:
+        return os.path.join(self.root_dir, "objects", content_hash[:2], f"{content_hash}.zz")
+
+    def get_many(self, urls: list[str]) -> dict[str, StoredDocument]:
+        """Return the fresh documents found for the given canonical URLs"""
+        if not urls:
+            return {}
+        placeholders = ",".join("?" for _ in urls)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT url, content_hash, fetched_at FROM documents WHERE url IN ({placeholders})",
+                urls,
+            ).fetchall()
+
+        found: dict[str, StoredDocument] = {}
+        oldest = time.time() - self.ttl_seconds
+        for url, content_hash, fetched_at in rows:
+            if fetched_at < oldest:
+                continue
+            try:
+                with open(self._object_path(content_hash), "rb") as file:
+                    content = zlib.decompress(file.read()).decode("utf-8")
+            except (OSError, zlib.error):
+                continue
+            found[url] = StoredDocument(url, content, content_hash, fetched_at)
+        return found
+
+    def put_many(self, documents: dict[str, str]) -> dict[str, StoredDocument]:
+        """Store page text for canonical URLs, returns the stored documents"""
+        stored: dict[str, StoredDocument] = {}
+        rows = []
+        now = time.time()
+        for url, content in documents.items():
+            data = content.encode("utf-8")
+            content_hash = hashlib.sha256(data).hexdigest()
+            path = self._object_path(content_hash)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as file:
+                    file.write(zlib.compress(data, 6))
+                os.replace(tmp_path, path)
+            rows.append((url, content_hash, now, len(data)))
+            stored[url] = StoredDocument(url, content, content_hash, now)
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO documents (url, content_hash, fetched_at, size) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+        return stored
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents").fetchone()
+        return {"documents": count, "bytes_uncompressed": total, "root_dir": self.root_dir}
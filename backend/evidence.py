@@ -0,0 +1,142 @@
+import heapq
+import math
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+from compaction import split_passages, tokenize
+
+
+@dataclass
+class EvidencePassage:
+    url: str
+    domain: str
+    title: str
+    content: str
+    retrieved_at: float
+    length: int
+
+    def as_result(self, score: float) -> dict:
+        return {
+            "url": self.url,
+            "domain": self.domain,
+            "title": self.title,
+            "content": self.content,
+            "score": round(score, 3),
+            "retrieved_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.retrieved_at)),
+        }
+
+
+@dataclass
+class BatchNovelty:
+    """What one batch of tool results added to the index"""
+    passages: int
+    new_passages: int
+    new_domains: int
+
+
+class EvidenceIndex:
+    """Inverted index over the passages retrieved during one run.
+
+    Every search snippet and extracted page is split into passages and
+    indexed by term, lookups score only the postings of the claim's terms
+    with BM25. Passages beyond max_passages are not indexed. Each batch of
+    results records how many new passages and domains it added, which is
+    what the convergence check reads.
+    """
+
+    def __init__(self, max_passages: int = 2000, passage_words: int = 120, k1: float = 1.5, b: float = 0.75):
+        self.max_passages = max_passages
+        self.passage_words = passage_words
+        self.k1 = k1
+        self.b = b
+        self.passages: list[EvidencePassage] = []
+        self.postings: dict[str, list[tuple[int, int]]] = {}
+        self._seen: set[int] = set()
+        self._total_length = 0
+        self._norms: list[float] | None = None
+        self.dropped = 0
+        self.chunks = 0
+        self.domains: set[str] = set()
+        self.batches: list[BatchNovelty] = []
+
+    def __len__(self) -> int:
+        return len(self.passages)
+
+    def add(self, url: str, content: str, title: str = "") -> int:
+        """Index one document, returns the number of new passages"""
+        added = 0
+        domain = urlsplit(url).hostname or ""
+        now = time.time()
+        for chunk in split_passages(content, self.passage_words):
+            self.chunks += 1
+            terms = tokenize(chunk)
+            # Case and punctuation changes of a passage seen on another page are not new evidence
+            fingerprint = hash(tuple(terms))
+            if fingerprint in self._seen:
+                continue
+            if len(self.passages) >= self.max_passages:
+                self.dropped += 1
+                continue
+            self._seen.add(fingerprint)
+            passage_id = len(self.passages)
+            self.passages.append(EvidencePassage(url, domain, title, chunk, now, len(terms)))
+            for term, count in Counter(terms).items():
+                self.postings.setdefault(term, []).append((passage_id, count))
+            self._total_length += len(terms)
+            added += 1
+        if added:
+            self._norms = None
+        return added
+
+    def add_results(self, results: list[dict], content_key: str = "content") -> int:
+        chunks = self.chunks
+        domains = len(self.domains)
+        added = sum(self.add(r.get("url", ""), r.get(content_key) or "", r.get("title") or "") for r in results)
+        self.domains.update(urlsplit(r.get("url", "")).hostname or "" for r in results)
+        self.domains.discard("")
+        self.batches.append(BatchNovelty(self.chunks - chunks, added, len(self.domains) - domains))
+        return added
+
+    def lookup(self, claim: str, k: int = 5) -> list[dict]:
+        if not self.passages:
+            return []
+        n = len(self.passages)
+        if self._norms is None:
+            avg_length = self._total_length / n or 1
+            self._norms = [self.k1 * (1 - self.b + self.b * p.length / avg_length) for p in self.passages]
+        norms = self._norms
+        scores: dict[int, float] = {}
+        for term in set(tokenize(claim)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for passage_id, tf in postings:
+                scores[passage_id] = scores.get(passage_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norms[passage_id])
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [self.passages[passage_id].as_result(score) for passage_id, score in best]
+
+    def clear(self) -> None:
+        self.passages.clear()
+        self.postings.clear()
+        self._seen.clear()
+        self._total_length = 0
+        self._norms = None
+        self.domains.clear()
+        self.batches.clear()
+
+    def stats(self) -> dict:
+        return {"passages": len(self.passages), "terms": len(self.postings), "dropped": self.dropped,
+                "domains": len(self.domains), "batches": len(self.batches)}
+
+
+current_evidence: ContextVar[EvidenceIndex | None] = ContextVar("current_evidence", default=None)
+
+
+def record_evidence(results: list[dict], content_key: str = "content") -> None:
+    """Add tool results to the evidence index of the current run, if any"""
+    index = current_evidence.get()
+    if index is not None and results:
+        index.add_results(results, content_key)
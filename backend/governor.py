@@ -0,0 +1,324 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable
+from telemetry import span, payload_size
+from budget import current_budget
+
+logger = logging.getLogger(__name__)
+
+# Who the current upstream call is made for, set once per run by run_agent
+current_user: ContextVar[str] = ContextVar("current_user", default="anonymous")
+# Optional async callback that receives "queued" events for the current user
+queue_listener: ContextVar[Callable[[dict], Awaitable[Any]] | None] = ContextVar(
+    "queue_listener", default=None)
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def is_retryable(error: Exception) -> bool:
+    """True for rate limiting, 5xx responses and connection failures"""
+    status = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    name = type(error).__name__
+    return name in {"APIConnectionError", "APITimeoutError",
+                    "ConnectError", "ReadTimeout", "ConnectTimeout", "RemoteProtocolError"}
+
+
+def retry_after(error: Exception) -> float | None:
+    """Seconds the upstream asked to wait in the Retry-After (or retry-after-ms) header of a failed response"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, burst: int):
+        self.rate = rate_per_second
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def take(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FairSemaphore:
+    """Concurrency limit whose waiters are served round-robin across users"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+
+    @property
+    def depth(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def try_acquire(self) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        return False
+
+    def enqueue(self, user: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user, deque()).append(future)
+        return future
+
+    def cancel(self, user: str, future: asyncio.Future) -> None:
+        waiters = self._waiters.get(user)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiters[user]
+        elif future.done() and not future.cancelled():
+            # The slot was granted while we were being cancelled
+            self.release()
+
+    def release(self) -> None:
+        while self._waiters:
+            user, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            del self._waiters[user]
+            if waiters:
+                # Move the user to the back of the line
+                self._waiters[user] = waiters
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+class HeldStream:
+    """Streamed response that keeps its upstream slot until it is exhausted, fails or is closed"""
+
+    def __init__(self, stream: Any, release: Callable[[], None]):
+        self._stream = stream
+        self._release: Callable[[], None] | None = release
+
+    def _done(self) -> None:
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def __aiter__(self) -> "HeldStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            self._done()
+            raise
+
+    async def close(self) -> None:
+        self._done()
+        await self._stream.close()
+
+    def __del__(self) -> None:
+        # A consumer that stopped reading without closing the stream
+        self._done()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._stream, name)
+
+
+class Upstream:
+    """Rate limit, concurrency limit and retry policy for one upstream API"""
+
+    def __init__(self, name: str, rate_per_second: float, burst: int, max_concurrency: int,
+                 max_retries: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.name = name
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self.slots = FairSemaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.queued = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def _notify(self, event: dict) -> None:
+        listener = queue_listener.get()
+        if listener is None:
+            return
+        try:
+            await listener(event)
+        except Exception as e:
+            logger.warning("Queue listener failed: %s", e)
+
+    async def _acquire(self) -> None:
+        started = time.monotonic()
+        if not self.slots.try_acquire():
+            user = current_user.get()
+            future = self.slots.enqueue(user)
+            self.queued += 1
+            await self._notify({"type": "queued", "upstream": self.name, "state": "waiting",
+                                "queue_depth": self.slots.depth})
+            try:
+                await future
+            except asyncio.CancelledError:
+                self.slots.cancel(user, future)
+                raise
+        try:
+            await self.bucket.take()
+            waited = time.monotonic() - started
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            if waited >= 0.5:
+                await self._notify({"type": "queued", "upstream": self.name, "state": "admitted",
+                                    "queue_depth": self.slots.depth, "waited_ms": int(waited * 1000)})
+        except BaseException:
+            self.slots.release()
+            raise
+
+    async def call(self, fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        budget = current_budget.get()
+        if budget is not None:
+            budget.check()
+        with span(self.name, getattr(fn, "__name__", "call")) as request:
+            result = await self._call_with_retries(fn, *args, **kwargs)
+            usage = getattr(result, "usage", None)
+            if usage is not None:
+                request.tokens_in = getattr(usage, "prompt_tokens", 0) or 0
+                request.tokens_out = getattr(usage, "completion_tokens", 0) or 0
+                if budget is not None:
+                    budget.add_tokens(request.tokens_in + request.tokens_out)
+            elif isinstance(result, dict):
+                request.payload_bytes = payload_size(result)
+            return result
+
+    async def _call_with_retries(self, fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        attempt = 0
+        while True:
+            await self._acquire()
+            self.calls += 1
+            streaming = False
+            try:
+                result = await fn(*args, **kwargs)
+                if kwargs.get("stream") is True:
+                    # The call returns once the headers arrive, the slot is held while the body streams
+                    streaming = True
+                    return HeldStream(result, self.slots.release)
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    self.failures += 1
+                    raise
+                attempt += 1
+                self.retries += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                # Never retry sooner than a 429 or 503 said to
+                delay = max(delay, retry_after(e) or 0.0)
+                logger.warning("%s call failed (%s), retry %d in %.2fs", self.name, e, attempt, delay)
+            finally:
+                if not streaming:
+                    self.slots.release()
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "active": self.slots.active,
+            "queue_depth": self.slots.depth,
+            "queued": self.queued,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+        }
+
+
+class GovernedTavilyClient:
+    """Tavily client whose search and extract calls go through an Upstream.
+
+    `client` returns the underlying client, it is called on every use so the client
+    can be built lazily.
+    """
+
+    def __init__(self, client: Callable[[], Any], upstream: Upstream):
+        self._client = client
+        self.upstream = upstream
+
+    async def search(self, *args: Any, **kwargs: Any) -> dict:
+        return await self.upstream.call(self._client().search, *args, **kwargs)
+
+    async def extract(self, *args: Any, **kwargs: Any) -> dict:
+        return await self.upstream.call(self._client().extract, *args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client(), name)
+
+
+class _GovernedCompletions:
+    def __init__(self, completions: Any, upstream: Upstream):
+        self._completions = completions
+        self._upstream = upstream
+
+    async def create(self, *args: Any, **kwargs: Any) -> Any:
+        return await self._upstream.call(self._completions.create, *args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._completions, name)
+
+
+class _GovernedChat:
+    def __init__(self, chat: Any, upstream: Upstream):
+        self._chat = chat
+        self.completions = _GovernedCompletions(chat.completions, upstream)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._chat, name)
+
+
+class GovernedOpenAI:
+    """AsyncOpenAI whose chat completion requests go through an Upstream.
+
+    `client` returns the SDK client, like for GovernedTavilyClient.
+    """
+
+    def __init__(self, client: Callable[[], Any], upstream: Upstream):
+        self._client = client
+        self.upstream = upstream
+        self._chat: _GovernedChat | None = None
+
+    @property
+    def chat(self) -> _GovernedChat:
+        if self._chat is None:
+            self._chat = _GovernedChat(self._client().chat, self.upstream)
+        return self._chat
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client(), name)
@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import AsyncIterator, Callable
+
+logger = logging.getLogger(__name__)
+
+FINAL_EVENTS = ("answer", "ask_user")
+
+
+class JobStore:
+    """SQLite table of jobs and the events each job emitted"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                email TEXT NOT NULL,
+                request TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS job_events (
+                job_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                event TEXT NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs (finished_at);
+            """
+        )
+        self._conn.commit()
+
+    def _execute(self, sql: str, params: tuple = ()) -> list[tuple]:
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            self._conn.commit()
+        return rows
+
+    def create(self, job_id: str, email: str, request: dict) -> None:
+        self._execute(
+            "INSERT INTO jobs (job_id, email, request, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+            (job_id, email, json.dumps(request), time.time()))
+
+    def claim(self) -> tuple[str, dict] | None:
+        """Atomically move the oldest queued job to running, any worker process can claim it"""
+        rows = self._execute(
+            """
+            UPDATE jobs SET status = 'running', started_at = ?
+            WHERE job_id = (SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1)
+            RETURNING job_id, request
+            """, (time.time(),))
+        return (rows[0][0], json.loads(rows[0][1])) if rows else None
+
+    def queued(self) -> int:
+        return self._execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'")[0][0]
+
+    def add_event(self, job_id: str, seq: int, event: dict) -> None:
+        self._execute("INSERT INTO job_events (job_id, seq, event) VALUES (?, ?, ?)",
+                      (job_id, seq, json.dumps(event)))
+
+    def finish(self, job_id: str, status: str, result: dict | None = None, error: str | None = None) -> None:
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE job_id = ?",
+            (status, json.dumps(result) if result is not None else None, error, time.time(), job_id))
+
+    def get(self, job_id: str) -> dict | None:
+        rows = self._execute(
+            """
+            SELECT job_id, email, status, result, error, created_at, started_at, finished_at,
+                   (SELECT COUNT(*) FROM job_events WHERE job_events.job_id = jobs.job_id)
+            FROM jobs WHERE job_id = ?
+            """, (job_id,))
+        if not rows:
+            return None
+        job_id, email, status, result, error, created_at, started_at, finished_at, events = rows[0]
+        return {
+            "job_id": job_id,
+            "email": email,
+            "status": status,
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+            "events": events,
+        }
+
+    def events(self, job_id: str, after: int = 0, limit: int = 500) -> list[dict]:
+        rows = self._execute(
+            "SELECT seq, event FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (job_id, after, limit))
+        return [{"seq": seq, "event": json.loads(event)} for seq, event in rows]
+
+    def fail_stale(self, started_before: float) -> int:
+        """Fail running jobs whose worker died without finishing them"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Worker stopped before the job finished', "
+                "finished_at = ? WHERE status = 'running' AND started_at < ?", (time.time(), started_before))
+            self._conn.commit()
+        return cursor.rowcount
+
+    def purge(self, older_than: float) -> int:
+        with self._lock:
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT job_id FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (older_than,))]
+            self._conn.executemany("DELETE FROM job_events WHERE job_id = ?", [(j,) for j in expired])
+            self._conn.executemany("DELETE FROM jobs WHERE job_id = ?", [(j,) for j in expired])
+            self._conn.commit()
+        return len(expired)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class JobManager:
+    """Runs queued jobs on a fixed pool of worker tasks.
+
+    Workers claim jobs from the shared table, so with several server
+    processes any of them can run a job submitted to another. `runner` turns
+    a job request into the event stream of one agent run. Every event is
+    persisted as it arrives, the job ends with the first answer or ask_user
+    event. Finished jobs are deleted after retention_seconds, jobs running
+    longer than stale_seconds are assumed lost and failed.
+    """
+
+    def __init__(self, store: JobStore, runner: Callable[[dict], AsyncIterator[dict]],
+                 workers: int = 4, retention_seconds: float = 24 * 3600,
+                 stale_seconds: float = 3600, poll_seconds: float = 1.0):
+        self.store = store
+        self.runner = runner
+        self.workers = workers
+        self.retention_seconds = retention_seconds
+        self.stale_seconds = stale_seconds
+        self.poll_seconds = poll_seconds
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._purge_loop()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, email: str, request: dict) -> str:
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(self.store.create, job_id, email, request)
+        self._wakeup.set()
+        return job_id
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            self._wakeup.clear()
+            claimed = await asyncio.to_thread(self.store.claim)
+            if claimed is None:
+                # Jobs submitted to other processes are only seen on the next poll
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job_id, request = claimed
+            self.running += 1
+            try:
+                await self._run(job_id, request)
+            except asyncio.CancelledError:
+                await asyncio.to_thread(self.store.finish, job_id, "failed", None, "Server shutting down")
+                raise
+            except Exception as e:
+                logger.exception("Job %s failed: %s", job_id, e)
+                self.failed += 1
+                await asyncio.to_thread(self.store.finish, job_id, "failed", None, str(e))
+            finally:
+                self.running -= 1
+
+    async def _run(self, job_id: str, request: dict) -> None:
+        seq = 0
+        result = None
+        error = None
+        async for event in self.runner(request):
+            seq += 1
+            await asyncio.to_thread(self.store.add_event, job_id, seq, event)
+            if event["type"] == "error":
+                error = event["output"]
+            if event["type"] in FINAL_EVENTS:
+                result = event
+                break
+        if result is not None:
+            self.completed += 1
+            await asyncio.to_thread(self.store.finish, job_id, "completed", result)
+        else:
+            self.failed += 1
+            await asyncio.to_thread(self.store.finish, job_id, "failed", None, error or "No response received")
+
+    async def _purge_loop(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.retention_seconds, self.stale_seconds, 300))
+            try:
+                stale = await asyncio.to_thread(self.store.fail_stale, time.time() - self.stale_seconds)
+                purged = await asyncio.to_thread(self.store.purge, time.time() - self.retention_seconds)
+                if stale or purged:
+                    logger.info("Failed %d stale and purged %d expired jobs", stale, purged)
+            except Exception as e:
+                logger.warning("Job purge failed: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self.store.queued(),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
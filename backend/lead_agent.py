@@ -1,22 +1,65 @@
+import dataclasses
+import logging
+import os
 from datetime import datetime
-from agents import Agent ,ModelSettings, RunContextWrapper
-from dotenv import load_dotenv, find_dotenv
-from tools import web_search, extract_url, UserInfo
+from agents import Agent ,ModelSettings, RunContextWrapper, FunctionTool
+from budget import current_budget
+from evidence import current_evidence
+from router import ConvergenceCheck, current_route
+from agent_memo import AgentToolMemo
+from cache import SQLiteCacheTier
+from settings import load_env
+from tools import web_search, multi_search, extract_url, lookup_evidence, UserInfo
 from clients import llm_model
 
-__ : bool = load_dotenv(find_dotenv())
+load_env()
+logger = logging.getLogger(__name__)
 
+# Repeated sub-agent calls with the same configuration and input are answered from here when
+# AGENT_MEMO_ENABLED is "1", the sqlite tier is disabled by setting AGENT_MEMO_DB to an empty string
+agent_memo_enabled: bool = os.getenv("AGENT_MEMO_ENABLED", "0") == "1"
+agent_memo_db: str = os.getenv("AGENT_MEMO_DB", "agent_memo.db")
+agent_memo: AgentToolMemo = AgentToolMemo(
+    max_entries=int(os.getenv("AGENT_MEMO_MAX_ENTRIES", "512")),
+    ttl_seconds=float(os.getenv("AGENT_MEMO_TTL_SECONDS", "21600")),
+    max_temperature=float(os.getenv("AGENT_MEMO_MAX_TEMPERATURE", "0.7")),
+    # Only opened when the memo is on, a disabled memo never reads or writes it
+    disk=SQLiteCacheTier(agent_memo_db) if agent_memo_enabled and agent_memo_db else None,
+    # Tools memoized even though their agent samples above max_temperature
+    pinned={name for name in os.getenv("AGENT_MEMO_PINNED", "").split(",") if name},
+    enabled=agent_memo_enabled,
+)
+
+# Searching stops once the last batches of results added no new domains and few new passages
+convergence: ConvergenceCheck = ConvergenceCheck(
+    window=int(os.getenv("CONVERGENCE_WINDOW", "2")),
+    min_new_fraction=float(os.getenv("CONVERGENCE_MIN_NEW_FRACTION", "0.2")),
+    min_batches=int(os.getenv("CONVERGENCE_MIN_BATCHES", "3")),
+)
 
 
+def stopped_on_convergence(tool: FunctionTool) -> FunctionTool:
+    """Return a note instead of searching again once the evidence of the run has converged"""
+    async def on_invoke_tool(context, arguments: str):
+        route = current_route.get()
+        if route is not None and convergence.converged(current_evidence.get()):
+            route.stop("converged")
+            return (f"{tool.name} was not run: the last searches found no new sources, "
+                    f"the evidence already gathered is enough. Move on to synthesis.")
+        return await tool.on_invoke_tool(context, arguments)
+    return dataclasses.replace(tool, on_invoke_tool=on_invoke_tool)
+
 
 def search_agent_instructions(user_context : RunContextWrapper[UserInfo], agent: Agent[UserInfo]) -> str:
     enable_deepsearch = user_context.context.enable_deepsearch
-    print("Deep search value => ", enable_deepsearch)
+    logger.debug("Deep search value => %s", enable_deepsearch)
     if enable_deepsearch:
         return f"""You are a DeepSearch Agent that searches for medical information online.
             Provides detailed responses if deepsearch is enabled. You have to provide a minimum 400 words response.
             Always use use web search tool and then extract those urls which granted access
             to retrieve content from the url, provide a summary of the content extracted from the urls.
+            When you need to explore several angles, send all of the queries in one multi_search call.
+            When you call extract_url, pass the question you are researching as the query.
             Use simpler language if the user is a patient, and more technical terms if the user is a doctor.
             Currently, the user is a { 'doctor' if user_context.context.doctor else 'patient' }.
             Currently deepsearch is enabled. When you find conflicting information, 
@@ -35,7 +78,7 @@ search_agent: Agent = Agent(
     name="Search Agent",
     model=llm_model,
     instructions=search_agent_instructions,
-    tools=[web_search, extract_url],
+    tools=[stopped_on_convergence(web_search), stopped_on_convergence(multi_search), extract_url],
     model_settings=ModelSettings(
         temperature=1.5,
         tool_choice="required", 
@@ -55,8 +98,10 @@ synthesis_agent: Agent = Agent(
 citation_agent: Agent = Agent(
     name="Citation Agent",
     model=llm_model,
-    instructions="You are a Citation Agent that provides citations for the information",
-    tools=[web_search],
+    instructions="""You are a Citation Agent that provides citations for the information.
+    Look up each claim with lookup_evidence first, it searches the pages already retrieved in this run.
+    Only use web_search for claims it has no matches for.""",
+    tools=[lookup_evidence, web_search],
        model_settings=ModelSettings(
             max_tokens=4000
         )    
@@ -65,9 +110,11 @@ citation_agent: Agent = Agent(
 reflection_agent: Agent = Agent(
     name="Reflection Agent",
     model=llm_model,
-    instructions="""Reflect the given information to check is it the correct info or not.Rates sources as: 
-    High (.edu, .gov, major news), Medium (Wikipedia, industry sites), or Low (blogs, forums) and warns users about questionable information.""",
-    tools=[web_search],
+    instructions="""Reflect the given information to check is it the correct info or not and warn users about questionable information.
+    Every source already carries a credibility tier (high, medium, low or unrated) computed from its domain,
+    report that tier instead of rating sources yourself and spend your effort on checking the facts.
+    Check claims with lookup_evidence first and only use web_search when it has no matches.""",
+    tools=[lookup_evidence, web_search],
     model_settings=ModelSettings(
         max_tokens=4000
     )
@@ -85,9 +132,45 @@ planning_agent: Agent = Agent(
     )
 )
 
+def budget_note() -> str:
+    budget = current_budget.get()
+    if budget is None or not budget.low():
+        return ""
+    return ("\n    The run is almost out of time and tokens: do not call Reflection_Agent or Citation_Agent,"
+            "\n    give the final answer from the synthesis you already have.")
+
+
+def optional_stage(tool: FunctionTool, skip_when_budget_low: bool = True) -> FunctionTool:
+    """Return a note instead of running a stage the run's tier leaves out, or an optional one once the budget is low"""
+    async def on_invoke_tool(context, arguments: str):
+        route = current_route.get()
+        if route is not None and route.tier != "deep":
+            logger.info("Skipping %s on the %s tier", tool.name, route.tier)
+            return f"{tool.name} is not part of {route.tier} research. Continue with the search and synthesis."
+        budget = current_budget.get()
+        if skip_when_budget_low and budget is not None and budget.low():
+            budget.skip(tool.name)
+            logger.info("Skipping %s, run budget is low", tool.name)
+            return f"{tool.name} was skipped because the run is low on time or tokens. Give the final answer now."
+        return await tool.on_invoke_tool(context, arguments)
+    return dataclasses.replace(tool, on_invoke_tool=on_invoke_tool)
+
+
 def dynamic_instructions(user_context: RunContextWrapper[UserInfo], agent: Agent[UserInfo]) -> str:
-    print("Doctor => ", user_context.context.doctor)
+    logger.debug("Doctor => %s", user_context.context.doctor)
     current_time = datetime.now().strftime("%Y-%m-%d")
+    if user_context.context.enable_deepsearch and user_context.context.tier == "standard":
+        return f"""
+    You are an Orchestration Agent for medical related queries.
+    This query needs a focused answer, not a full deep search:
+    1. Use search agent to search for multiple web pages, in as few calls as possible.
+    2. Use synthesis agent to compile the findings into a coherent answer.
+
+    Do not use the planning, reflection or citation agents.
+    Use simpler language if the user is a patient, and more technical terms if the user is a doctor.
+    Currently, the user is a { 'doctor' if user_context.context.doctor else 'patient' }.
+    Allways use the latest information available as of {current_time} for your responses.
+    .{budget_note()}"""
     if user_context.context.enable_deepsearch:
         return f"""
     You are an Orchestration Agent that orchestrates the workflow of agents for medical related queries.
@@ -103,7 +186,7 @@ def dynamic_instructions(user_context: RunContextWrapper[UserInfo], agent: Agent
     Use simpler language if the user is a patient, and more technical terms if the user is a doctor.
     Currently, the user is a { 'doctor' if user_context.context.doctor else 'patient' }.
     Allways use the latest information available as of {current_time} for your responses.
-    ."""
+    .{budget_note()}"""
     else: 
         return f"""You are simple medical agent. Answer the user query in minimum 5 bullet points.
         Do not use any other agent.Use only searcch agent to search the web for information to answer the user's query."""
@@ -113,26 +196,29 @@ lead_research_agent: Agent = Agent(
     model=llm_model,
     instructions=dynamic_instructions,
     tools=[
-        planning_agent.as_tool(
+        optional_stage(agent_memo.tool(
+            planning_agent,
             tool_name="Planning_Agent",
             tool_description="This agent will plane the next steps for searching of the medical related information."
-        ),
-        search_agent.as_tool(
+        ), skip_when_budget_low=False),
+        stopped_on_convergence(search_agent.as_tool(
             tool_name="Search_Agent",
             tool_description="Useful for when you need to search the web for information to answer the user's query."
-        ),
-        synthesis_agent.as_tool(
+        )),
+        agent_memo.tool(
+            synthesis_agent,
             tool_name="Synthesis_Agent",
             tool_description="A synthesis agent that takes all research findings and organizes them into clear sections with themes, trends, and key insights."
         ),
-        reflection_agent.as_tool(
+        optional_stage(reflection_agent.as_tool(
             tool_name="Reflection_Agent",
             tool_description="A reflective agent that reflects on the best approach to take."
-        ),
-        citation_agent.as_tool(
+        )),
+        # Not memoized: the citations depend on the evidence this run indexed, not only on the input
+        optional_stage(citation_agent.as_tool(
             tool_name="Citation_Agent",
             tool_description="A citation agent to provide citations for the information."
-        ),
+        )),
         ],
     model_settings=ModelSettings(
         temperature=1.5,
@@ -1,20 +1,87 @@
-from agents import Agent, Runner, ItemHelpers, RunContextWrapper, handoff, SQLiteSession
+from agents import Agent, Runner, ItemHelpers, RunContextWrapper, StopAtTools, handoff
 import os
-from dotenv import load_dotenv, find_dotenv
+from contextlib import asynccontextmanager
 from openai.types.responses import ResponseTextDeltaEvent
 import json
-import sys
-from lead_agent import lead_research_agent
-from tools import UserInfo, question_from_user, web_search
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from lead_agent import lead_research_agent, agent_memo
+from dag_pipeline import dag_pipeline
+from tools import UserInfo, question_from_user, web_search, search_cache, doc_store, prefetcher
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import StreamingResponse
-from tools import UserQuerie, Login_Class, Signup_Class, UserAnswer
-from clients import llm_model
+from tools import UserQuerie, Login_Class, Signup_Class, UserAnswer, JobRequest
+from clients import llm_model, gemini_upstream, tavily_upstream, upstream_clients
+from settings import load_env
+from governor import current_user
+from user_store import UserStore
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict
+from streaming import DeltaCoalescer
+from answer_cache import AnswerCache
+from sessions import SessionManager, HistoryPolicy
+from jobs import JobStore, JobManager
+from run_state import make_run_state
+from evidence import EvidenceIndex, current_evidence
+from prefetch import current_prefetch
+from budget import BudgetExhausted, RunBudget, current_budget
+from router import QueryRouter, RunRoute, current_route
+from run_streams import RunRegistry, RunStream
+from batch import BatchRunner, read_questions, load_results, completed_ids, open_output
+from telemetry import TracingHooks, start_trace, finish_trace, render_metrics, gauge_collectors
+from fastapi.responses import PlainTextResponse
 import asyncio
+import logging
+import re
+import time
+
+load_env()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+# httpx and openai log every request at INFO
+for noisy in ("httpx", "openai"):
+    logging.getLogger(noisy).setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENGINE = os.getenv("DEEPSEARCH_ENGINE", "orchestrator")
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "160"))
+STREAM_FLUSH_MS = int(os.getenv("STREAM_FLUSH_MS", "50"))
+EVIDENCE_MAX_PASSAGES = int(os.getenv("EVIDENCE_MAX_PASSAGES", "2000"))
+# Per-run limits, 0 disables either. Past BUDGET_LOW_FRACTION optional stages are skipped
+RUN_DEADLINE_SECONDS = float(os.getenv("RUN_DEADLINE_SECONDS", "240"))
+RUN_TOKEN_BUDGET = int(os.getenv("RUN_TOKEN_BUDGET", "200000"))
+BUDGET_LOW_FRACTION = float(os.getenv("BUDGET_LOW_FRACTION", "0.8"))
+# Opens upstream connections before the server reports ready
+UPSTREAM_WARM_UP = os.getenv("UPSTREAM_WARM_UP", "1") == "1"
+UPSTREAM_WARM_UP_TIMEOUT = float(os.getenv("UPSTREAM_WARM_UP_TIMEOUT", "5"))
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "1.0"))
+# Output of each /batch run, also its checkpoint
+BATCH_DIR = os.getenv("BATCH_DIR", "batches")
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+# Depth of a deep-search question is picked per query, with the router off the client's flag decides alone
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "1") == "1"
+
+query_router = QueryRouter(
+    standard_threshold=float(os.getenv("ROUTER_STANDARD_THRESHOLD", "1.0")),
+    deep_threshold=float(os.getenv("ROUTER_DEEP_THRESHOLD", "3.0")),
+)
+
+# Near-duplicate questions are answered from here without running the agents
+answer_cache = AnswerCache(
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.9")),
+    ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400")),
+    max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000000")),
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_manager.start()
+    if UPSTREAM_WARM_UP:
+        await upstream_clients.warm_up(UPSTREAM_WARM_UP_TIMEOUT)
+    yield
+    await job_manager.stop()
+    await support_bot.sessions.drain()
+    await upstream_clients.close()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 origins = [
     "http://localhost:3000",   # React/Next.js local dev
     "http://127.0.0.1:3000",
@@ -29,33 +96,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-__: bool = load_dotenv(find_dotenv())
 os.environ['OPENAI_API_KEY'] = os.getenv("OPENAI_API_KEY")
 
 
-def load_users():
-    if os.path.exists("user_settings.json"):
-        with open("user_settings.json", "r") as file:
-            return json.load(file)
-    return []
-
-
-def save_users(users):
-    with open("user_settings.json", "w") as file:
-        json.dump(users, file, indent=4)
+user_store = UserStore(
+    os.getenv("USER_DB", "users.db"),
+    legacy_json_path="user_settings.json",
+)
 
 
 def match_user_by_email(email: str):
-    users = load_users()
-    for user in users:
-        try:
-            if user["email"].strip().lower() == email.strip().lower():
-                return user
-        except KeyError as e:
-            print(f"Key error: {e}. Please check the user settings file.")
-            sys.exit(1)
-            break
-    return None
+    return user_store.get(email)
 
 
 @app.get("/")
@@ -63,27 +114,42 @@ def read_root():
     return {"Hello": "World"}
 
 
+@app.get("/cache/stats")
+def cache_stats():
+    return {
+        "web_search": search_cache.snapshot(),
+        "documents": doc_store.stats(),
+        "answers": answer_cache.stats(),
+        "prefetch": prefetcher.stats(),
+        "agent_tools": agent_memo.stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return render_metrics()
+
+
+@app.get("/upstreams/stats")
+def upstream_stats():
+    return {"gemini": gemini_upstream.stats(), "tavily": tavily_upstream.stats(), "pools": upstream_clients.stats()}
+
+
+@app.get("/sessions/stats")
+def session_stats():
+    return support_bot.sessions.stats()
+
+
 @app.post("/signup")
 def save_user(user_data: Signup_Class):
-    print(user_data.name, user_data.isDoctor,
-          user_data.email, user_data.password)
+    logger.info("Signup request for %s (doctor=%s)", user_data.email, user_data.isDoctor)
     if not user_data.email or not user_data.password:
         raise HTTPException(
             status_code=400, detail="Email and password required")
-    users = load_users()
 
-    for user in users:
-        try:
-            if user["email"].strip().lower() == user_data.email:
-                return {"message": "User already exists!"}
-        except KeyError as e:
-            print(f"Key error: {e}. Please check the user settings file.")
-            sys.exit(1)
-            break
-
-    users.append(user_data.dict())
-    save_users(users)
-    print("User saved successfully.")
+    if not user_store.add(user_data.dict()):
+        return {"message": "User already exists!"}
+    logger.info("User saved successfully.")
     return {"message": "User saved successfully!", "status": 200}
 
 
@@ -94,23 +160,16 @@ def login_user(user_data: Login_Class):
         raise HTTPException(
             status_code=400, detail="Email and password required")
 
-    users = load_users()
+    user = user_store.get(user_data.email)
+    if user and user.get("password") == user_data.password:
+        logger.info("User logged in successfully.")
+        return {"message": "User logged in successfully!", "user_found": True, "status": 200}
 
-    for user in users:
-        try:
-            if user["email"].strip().lower() == user_data.email and user["password"] == user_data.password:
-                return {"message": "User logged in successfully!", "user_found": True, "status": 200}
-        except KeyError as e:
-            print(f"Key error: {e}. Please check the user settings file.")
-            sys.exit(1)
-            break
-
-    print("User logged in successfully.")
     return {"message": "No user found with that email.", "user_found": False}
 
 
 def instructions_for_requirement_agent(userContext: RunContextWrapper[UserInfo], agent: Agent[UserInfo]) -> str:
-    print(f"user search settings {userContext.context}")
+    logger.debug("user search settings %s", userContext.context)
     if userContext.context.enable_deepsearch:
         return f""""You are requirement gathering agent for medical industry, Your job is to collect clear,
     complete, and structured requirements from the user for their querie,
@@ -129,51 +188,161 @@ class CustomerSupportBot:
             model=llm_model,
             instructions=instructions_for_requirement_agent,
             tools=[question_from_user, web_search],
+            # A question ends the run, the SDK saves it to the session before the stream ends
+            tool_use_behavior=StopAtTools(stop_at_tool_names=[question_from_user.name]),
             handoffs=[handoff(
                 agent=lead_research_agent,
                 tool_name_override="Lead_Research_Agent",
                 tool_description_override="This agent will take the requirements gathered by the Requirement Gathering Agent and will deep search for the information."
             )]
         )
-        self.user_sessions: Dict[str, SQLiteSession] = {}
-        # Store pending questions per user
-        self.pending_questions: Dict[str, str] = {}
+        self.sessions = SessionManager(
+            os.getenv("SESSION_DB", "test.db"),
+            max_sessions=int(os.getenv("MAX_LIVE_SESSIONS", "1000")),
+            idle_seconds=float(os.getenv("SESSION_IDLE_SECONDS", "1800")),
+            pool_size=int(os.getenv("SESSION_DB_POOL_SIZE", "4")),
+            # Replayed history is bounded to a window of turns and a token budget, 0 turns replays everything
+            history=HistoryPolicy(
+                window_turns=int(os.getenv("SESSION_WINDOW_TURNS", "4")),
+                token_budget=int(os.getenv("SESSION_TOKEN_BUDGET", "6000")),
+                tool_output_tokens=int(os.getenv("SESSION_TOOL_OUTPUT_TOKENS", "400")),
+                summary_tokens=int(os.getenv("SESSION_SUMMARY_TOKENS", "800")),
+            ) if int(os.getenv("SESSION_WINDOW_TURNS", "4")) > 0 else None,
+        )
+        # Pending questions, run flags and session ids live outside the process so any worker can continue a run
+        self.run_state = make_run_state(
+            os.getenv("RUN_STATE_BACKEND", "sqlite"),
+            os.getenv("RUN_STATE_DB", "run_state.db"),
+        )
 
-    def get_customer_session(self, user_email: str):
+    def start_conversation(self, user_email: str, enable_deepsearch: bool, is_doctor: bool,
+                           engine: str | None = None, query: str | None = None):
+        """Drop the previous conversation and record the flags of a new question.
+
+        With a query the router picks its tier, the quick tier runs without deep search.
+        """
+        self.clear_user_session(user_email)
+        prefetcher.cancel(user_email)
+        if ROUTER_ENABLED and query:
+            route = query_router.route(query, enable_deepsearch, is_doctor)
+            tier = route.tier
+            logger.info("Query from %s routed to %s (%.1f: %s)", user_email, tier, route.score,
+                        ", ".join(route.reasons) or "no signals")
+        else:
+            tier = "deep" if enable_deepsearch else "quick"
+        return self.run_state.start(user_email, tier != "quick", is_doctor, engine, tier, query)
+
+    def continue_conversation(self, user_email: str):
+        """Run state of the conversation an answer belongs to, marking its question as answered"""
+        state = self.run_state.get(user_email)
+        if state is not None and state.pending_question is not None:
+            self.run_state.set_pending_question(user_email, None)
+        return state
+
+    async def get_customer_session(self, user_email: str):
         """Get or create a unique session for a specific customer"""
-        if user_email not in self.user_sessions:
-            # Create unique session ID for each user
-            session_id = f"user_{user_email.replace('@', '_').replace('.', '_')}"
-            # session_id = user_email
-            self.user_sessions[user_email] = SQLiteSession(
-                session_id, "test.db")
-        return self.user_sessions[user_email]
+        state = self.run_state.get(user_email)
+        return await self.sessions.open(user_email, state.session_id if state else None)
 
     def clear_user_session(self, user_email: str):
         """Completely clear and recreate session for user"""
-        if user_email in self.user_sessions:
+        state = self.run_state.get(user_email)
+        self.sessions.clear(user_email, state.session_id if state else None)
+        logger.debug("Session cleared and removed for user: %s", user_email)
+
+    async def run_agent(self, user_query: str, enable_deepsearch: bool, is_doctor: bool, name: str, user_email: str,
+                        engine: str | None = None, stream: bool = False, use_cache: bool = True):
+        """Run the agents for one message, recording a trace of the run"""
+        mode = "deep" if enable_deepsearch else "quick"
+        trace = start_trace(mode, user_email)
+        # Tier of the conversation this message belongs to, picked when its question arrived
+        state = self.run_state.get(user_email)
+        route = RunRoute(state.tier if state is not None and state.tier else mode)
+        current_route.set(route)
+        hooks = TracingHooks()
+        # Everything the tools retrieve in this run, queried by lookup_evidence
+        evidence = EvidenceIndex(max_passages=EVIDENCE_MAX_PASSAGES)
+        current_evidence.set(evidence)
+        # Searches prefetched while the user was answering a question, None for a new question
+        warm = prefetcher.claim(user_email)
+        current_prefetch.set(warm)
+        budget = RunBudget(RUN_DEADLINE_SECONDS, RUN_TOKEN_BUDGET, BUDGET_LOW_FRACTION)
+        current_budget.set(budget)
+        error = None
+        try:
+            async for event in self._run_agent(user_query, enable_deepsearch, is_doctor, name, user_email,
+                                               engine, stream, use_cache, hooks):
+                if event["type"] == "error":
+                    error = event["output"]
+                elif event["type"] == "answer":
+                    event.setdefault("tier", route.tier)
+                yield event
+        finally:
+            logger.debug("Evidence index for run %s: %s", trace.trace_id, evidence.stats())
+            current_evidence.set(None)
+            evidence.clear()
+            current_prefetch.set(None)
+            current_budget.set(None)
+            current_route.set(None)
+            trace.tier = route.tier
+            trace.stop_reason = route.stop_reason or budget.stop_reason() or ("budget_low" if budget.skipped else None)
+            if budget.skipped or budget.stop_reason():
+                logger.info("Run %s ended with budget %s, %d tokens, skipped %s", trace.trace_id,
+                            budget.stop_reason() or "low", budget.tokens, budget.skipped)
+            if warm is not None:
+                prefetcher.finish(warm)
+            finish_trace(trace, error)
+
+    async def _run_agent(self, user_query: str, enable_deepsearch: bool, is_doctor: bool, name: str, user_email: str,
+                         engine: str | None, stream: bool, use_cache: bool, hooks: TracingHooks):
+
+        route = current_route.get()
+        user_info = UserInfo(name=name, doctor=is_doctor,
+                             enable_deepsearch=enable_deepsearch, tier=route.tier if route is not None else "deep")
+        # Upstream calls made during this run are queued fairly under this user
+        current_user.set(user_email)
+
+        if use_cache:
+            cached = answer_cache.lookup(user_query, is_doctor, enable_deepsearch)
+            if cached:
+                logger.info("Answer cache hit (%s) for: %s", cached.similarity, user_query)
+                yield {"type": "answer", "output": cached.answer, "cached": True, "similarity": cached.similarity}
+                return
+
+        if enable_deepsearch and (engine or DEFAULT_ENGINE) == "dag":
             try:
-                # Clear the session
-                session = self.user_sessions[user_email]
-                asyncio.create_task(session.clear_session())
-                # Remove from our tracking
-                del self.user_sessions[user_email]
-                print(f"Session cleared and removed for user: {user_email}")
+                async for event in dag_pipeline.run(user_query, user_info):
+                    if event["type"] == "answer" and use_cache and not event.get("partial"):
+                        answer_cache.store(user_query, event["output"], is_doctor, enable_deepsearch)
+                    yield event
             except Exception as e:
-                print(f"Error clearing session for {user_email}: {e}")
-
-    async def run_agent(self, user_query: str, enable_deepsearch: bool, is_doctor: bool, name: str, user_email: str):
-
-        session = self.get_customer_session(user_email)
-        user_info = UserInfo(name=name, doctor=is_doctor,
-                             enable_deepsearch=enable_deepsearch)
+                logger.exception("Error in DAG pipeline: %s", e)
+                yield {"type": "error", "output": f"Error occurred: {str(e)}"}
+            finally:
+                self.clear_user_session(user_email)
+            return
+
+        session = await self.get_customer_session(user_email)
+        started = time.perf_counter()
+        budget = current_budget.get()
+        # Loop time the run is stopped at, None without a deadline
+        deadline = (asyncio.get_running_loop().time() + budget.remaining_seconds()
+                    if budget is not None and budget.deadline_seconds > 0 else None)
+        # Latest output of each sub-agent, the answer is built from them if the budget runs out
+        tool_calls: dict[str, str] = {}
+        stage_outputs: dict[str, str] = {}
+        question = None
+        # Token deltas are only forwarded when the client asks for streaming
+        coalescer = DeltaCoalescer(
+            STREAM_FLUSH_CHARS, STREAM_FLUSH_MS / 1000) if stream else None
         try:
             result = Runner.run_streamed(
                 starting_agent=self.agent,
                 input=user_query,
                 context=user_info,
                 max_turns=20,
-                session=session
+                session=session,
+                hooks=hooks
             )
 
             if result.final_output:
@@ -182,16 +351,28 @@ class CustomerSupportBot:
                 yield {"type": "answer", "output": result.final_output}
                 return
 
-            print("Agent Streaming Started...")
-            print(f"Searching Started for {name} on topic: {user_query}\n\n")
-            async for event in result.stream_events():
+            logger.info("Searching started for %s on topic: %s", name, user_query)
+            async for event in events_until(result, deadline):
+                if budget is not None:
+                    budget.stream_tokens = result.context_wrapper.usage.total_tokens
                 # print(f"\n\nEvent Type: {event}\n\n")
                 # # We'll ignore the raw responses event deltas
                 if event.type == "raw_response_event":
+                    if coalescer is None:
+                        continue
+                    segment = coalescer.segment
+                    if event.data.type == "response.created":
+                        pending = coalescer.new_segment()
+                    elif isinstance(event.data, ResponseTextDeltaEvent):
+                        pending = coalescer.add(event.data.delta)
+                    else:
+                        continue
+                    if pending:
+                        yield {"type": "delta", "output": pending, "segment": segment}
                     continue
 
                 elif event.type == "agent_updated_stream_event":
-                    print(f"Agent updated: {event.new_agent.name}")
+                    logger.debug("Agent updated: %s", event.new_agent.name)
                     yield {
                         "type": "agent_update",
                         "output": f"Handing over to : {event.new_agent.name}",
@@ -206,13 +387,15 @@ class CustomerSupportBot:
 
                             tool_name = event.item.raw_item.name
                             tool_args = event.item.raw_item.arguments
-                            print(f"-- Tool was called: {tool_name}")
-                            print(f"-- Tool arguments: {tool_args}")
+                            tool_calls[event.item.raw_item.call_id] = tool_name
+                            logger.debug("Tool was called: %s %s", tool_name, tool_args)
 
                             try:
                                 parsed_args = json.loads(tool_args)
                                 if tool_name == "web_search" and "query" in parsed_args:
                                     output_message = f"🔍 Searching for: {parsed_args['query']}"
+                                elif tool_name == "multi_search" and "queries" in parsed_args:
+                                    output_message = f"🔍 Searching for: {', '.join(parsed_args['queries'])}"
                                 elif tool_name == "question_from_user" and "question" in parsed_args:
                                     output_message = f"❓ Asking: {parsed_args['question']}"
                                 else:
@@ -220,14 +403,14 @@ class CustomerSupportBot:
                             except json.JSONDecodeError:
                                 output_message = f"🔧 Using tool: {tool_name}"
                         # print(event.item, '/n/n')
-                            print(f"-- {output_message}")
+                            logger.debug(output_message)
                             yield {
                                 "type": "tool_call",
                                 "output": output_message,
                                 "tool_name": tool_name
                             }
                         except AttributeError as e:
-                            print(f"Error accessing tool info: {e}")
+                            logger.warning("Error accessing tool info: %s", e)
                             yield {
                                 "type": "tool_call",
                                 "output": "Tool is being used",
@@ -246,11 +429,18 @@ class CustomerSupportBot:
                             except json.JSONDecodeError:
                                 pass
 
+                        tool_name = tool_calls.get(event.item.raw_item.get("call_id", ""))
+                        if tool_name:
+                            stage_outputs[tool_name] = str(event.item.output)
+
                         if output_data and output_data.get("type") == "ask_user":
                             question = output_data.get('question', '')
-                            self.pending_questions[user_email] = question
-                            yield {"type": "ask_user", "question": question}
-                            return
+                            # In an answer flow user_query is the user's reply, searches come from the question
+                            state = self.run_state.get(user_email)
+                            original = state.query if state is not None and state.query else user_query
+                            prefetcher.start(user_email, original)
+                            # The run stops at the question, the stream ends once the SDK has saved it
+                            continue
                         # else:
                         #     # Send intermediate tool output
                         #     print(str(event.item.output))
@@ -262,29 +452,187 @@ class CustomerSupportBot:
                     elif event.item.type == "message_output_item":
                         output_text = ItemHelpers.text_message_output(
                             event.item)
-                        print(f"\n-- Agent output:\n {output_text}")
+                        logger.debug("Agent output: %s", output_text)
+                        logger.info("Orchestrator run finished in %.1fs", time.perf_counter() - started)
+                        hooks.close(result.context_wrapper)
                         self.clear_user_session(user_email)
-                        yield {"type": "answer", "output": output_text}
+                        skipped = budget.skipped if budget is not None else []
+                        if use_cache and not skipped:
+                            answer_cache.store(user_query, output_text, is_doctor, enable_deepsearch)
+                        if coalescer is not None:
+                            pending = coalescer.flush()
+                            if pending:
+                                yield {"type": "delta", "output": pending, "segment": coalescer.segment}
+                        answer = {"type": "answer", "output": output_text}
+                        if skipped:
+                            answer.update(partial=True, skipped=skipped, stop_reason="budget_low")
+                        yield answer
                         return
                     else:
                         pass  # Ignore other event types
-            print("Stream Completed")
-            print(f"last agent: {result.last_agent.name}")
+            logger.info("Stream completed, last agent: %s", result.last_agent.name)
+            if asyncio.current_task().cancelling():
+                # stream_events() ends quietly when the consumer is cancelled, keep the cancellation going
+                raise asyncio.CancelledError
+            if question is not None:
+                self.run_state.set_pending_question(user_email, question)
+                yield {"type": "ask_user", "question": question}
+                return
+            reason = budget.stop_reason() if budget is not None else None
+            if reason is not None:
+                raise BudgetExhausted(reason)
+
+        except BudgetExhausted as e:
+            logger.info("Run for %s stopped early (%s) after %.1fs", user_email, e.reason, time.perf_counter() - started)
+            self.clear_user_session(user_email)
+            yield self._partial_answer(stage_outputs, e.reason)
+
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client went away or the run was superseded, stop the background run and its model calls
+            result.cancel()
+            raise
 
         except Exception as e:
-            print(f"Error in agent stream: {e}")
+            logger.exception("Error in agent stream: %s", e)
             # Clear session on error too
             self.clear_user_session(user_email)
             yield {"type": "error", "output": f"Error occurred: {str(e)}"}
 
+    @staticmethod
+    def _partial_answer(stage_outputs: dict[str, str], reason: str) -> dict:
+        output = (stage_outputs.get("Synthesis_Agent") or stage_outputs.get("Search_Agent")
+                  or "The research could not be completed within the run budget. Please try a narrower question.")
+        return {"type": "answer", "output": output, "partial": True, "stop_reason": reason}
+
+
+async def events_until(result, deadline: float | None):
+    """stream_events() of a streamed run, cancelling the run at a loop-time deadline.
+
+    The timeout covers each wait for the next event, never the consumer's
+    own code between events, so it also stops a run waiting on a slow model
+    call. stream_events() ends quietly when its wait is cancelled, the
+    expired timer tells the deadline apart from the end of the run.
+    """
+    events = result.stream_events()
+    while True:
+        try:
+            async with asyncio.timeout_at(deadline) as timer:
+                event = await anext(events)
+        except StopAsyncIteration:
+            if timer.expired():
+                result.cancel()
+                raise BudgetExhausted("deadline") from None
+            return
+        yield event
+
 
 # Example usage
 support_bot = CustomerSupportBot()
 
 
+def _collect_gauges() -> dict[str, float]:
+    search = search_cache.snapshot()
+    sessions = support_bot.sessions.stats()
+    answers = answer_cache.stats()
+    gauges = {
+        "medassistant_search_cache_hits": search["hits"],
+        "medassistant_search_cache_misses": search["misses"],
+        "medassistant_answer_cache_hits": answers["hits"],
+        "medassistant_answer_cache_misses": answers["misses"],
+        "medassistant_live_sessions": sessions["live_sessions"],
+        "medassistant_session_db_wait_seconds": sessions["db_wait_seconds"],
+    }
+    for upstream in (gemini_upstream, tavily_upstream):
+        stats = upstream.stats()
+        gauges[f"medassistant_{upstream.name}_queue_depth"] = stats["queue_depth"]
+        gauges[f"medassistant_{upstream.name}_retries"] = stats["retries"]
+    jobs = job_manager.stats()
+    gauges["medassistant_jobs_queued"] = jobs["queued"]
+    gauges["medassistant_jobs_running"] = jobs["running"]
+    return gauges
+
+
+gauge_collectors.append(_collect_gauges)
+
+
+async def run_job(request: dict):
+    """Event stream of one job, the same flow as /chatendpoint and /answer_user"""
+    email = request["email"]
+    user = match_user_by_email(email)
+    if request["kind"] == "query":
+        state = support_bot.start_conversation(
+            email, request["enable_deepsearch"], request["is_doctor"], request.get("engine"), request["query"])
+    else:
+        state = support_bot.continue_conversation(email)
+        if state is None:
+            yield {"type": "error", "output": "No active session for this user"}
+            return
+    async for event in support_bot.run_agent(
+        request["query"], state.enable_deepsearch, state.is_doctor, user["name"], email,
+        state.engine, use_cache=request["kind"] == "query"
+    ):
+        yield event
+
+
+# Long runs go through the job queue so no HTTP request is held open for the whole run
+job_manager = JobManager(
+    JobStore(os.getenv("JOB_DB", "jobs.db")),
+    run_job,
+    workers=int(os.getenv("JOB_WORKERS", "4")),
+    retention_seconds=float(os.getenv("JOB_RETENTION_SECONDS", "86400")),
+    stale_seconds=float(os.getenv("JOB_STALE_SECONDS", "3600")),
+)
+
+
+def expire_run(run: RunStream):
+    """A detached run was not resumed within the grace period"""
+    logger.info("Run for %s expired without a reconnect", run.email)
+    state = support_bot.run_state.get(run.email)
+    # Leave a conversation the user has started since, e.g. over HTTP, alone
+    if state is None or run.session_id is None or state.session_id == run.session_id:
+        support_bot.clear_user_session(run.email)
+        prefetcher.cancel(run.email)
+
+
+# WebSocket runs keep going for a grace period after a disconnect and can be resumed from their event log
+run_registry = RunRegistry(
+    expire_run,
+    grace_seconds=float(os.getenv("RUN_GRACE_SECONDS", "120")),
+    max_events=int(os.getenv("RUN_LOG_MAX_EVENTS", "2000")),
+)
+
+
+@app.get("/runs/stats")
+def run_stats():
+    return run_registry.stats()
+
+
 @app.websocket("/ws/{user_email}")
 async def websocket_endpoint(websocket: WebSocket, user_email: str):
     await websocket.accept()
+    attached: RunStream | None = None
+    sending: asyncio.Task | None = None
+
+    async def send_run(run: RunStream, after: int = 0):
+        try:
+            async for seq, event in run.follow(after):
+                await websocket.send_text(json.dumps({**event, "seq": seq, "run_id": run.run_id}))
+        except Exception as e:
+            # A closed socket is handled by the receive loop
+            logger.debug("Stopped sending run %s: %s", run.run_id, e)
+
+    def follow(run: RunStream, after: int = 0):
+        """Send a run's events from a task of its own, so a new query is read while the run is going"""
+        nonlocal sending
+        if sending is not None:
+            sending.cancel()
+        sending = asyncio.create_task(send_run(run, after))
+
+    def attach(run: RunStream | None):
+        nonlocal attached
+        if attached is not None:
+            run_registry.detach(attached)
+        attached = run
 
     try:
         while True:
@@ -298,15 +646,19 @@ async def websocket_endpoint(websocket: WebSocket, user_email: str):
                 enable_deepsearch = message_data.get(
                     "enable_deepsearch", False)
                 is_doctor = message_data.get("is_doctor", False)
+                engine = message_data.get("engine")
+                stream = message_data.get("stream", False)
 
                 user = match_user_by_email(user_email)
                 name = user["name"]
+                state = support_bot.start_conversation(user_email, enable_deepsearch, is_doctor, engine, query)
 
-                # Stream the agent response
-                async for chunk in support_bot.run_agent(
-                    query, enable_deepsearch, is_doctor, name, user_email
-                ):
-                    await websocket.send_text(json.dumps(chunk))
+                # The run writes to its own log, this socket only follows it
+                run = run_registry.start(user_email, support_bot.run_agent(
+                    query, state.enable_deepsearch, is_doctor, name, user_email, engine, stream
+                ), state.session_id)
+                attach(run_registry.attach(user_email, run.run_id))
+                follow(run)
 
             elif message_data["type"] == "answer":
                 # User answering a question
@@ -315,74 +667,246 @@ async def websocket_endpoint(websocket: WebSocket, user_email: str):
                 user = match_user_by_email(user_email)
                 name = user["name"]
 
-                # Get previous context from pending questions if needed
-                enable_deepsearch = message_data.get(
-                    "enable_deepsearch", False)
-                is_doctor = message_data.get("is_doctor", False)
+                # The flags of the question being answered win over what the client sends
+                state = support_bot.continue_conversation(user_email)
+                if state is not None:
+                    enable_deepsearch, is_doctor, engine = state.enable_deepsearch, state.is_doctor, state.engine
+                else:
+                    enable_deepsearch = message_data.get("enable_deepsearch", False)
+                    is_doctor = message_data.get("is_doctor", False)
+                    engine = message_data.get("engine")
+                stream = message_data.get("stream", False)
 
                 # Continue with the answer
-                async for chunk in support_bot.run_agent(
-                    answer, enable_deepsearch, is_doctor, name, user_email
-                ):
-                    await websocket.send_text(json.dumps(chunk))
+                run = run_registry.start(user_email, support_bot.run_agent(
+                    answer, enable_deepsearch, is_doctor, name, user_email, engine, stream=stream, use_cache=False
+                ), state.session_id if state else None)
+                attach(run_registry.attach(user_email, run.run_id))
+                follow(run)
+
+            elif message_data["type"] == "resume":
+                # Reconnected client, replay what it missed and follow the run live
+                last_seq = int(message_data.get("last_seq", 0))
+                run = run_registry.resume(user_email, message_data.get("run_id"))
+                if run is None:
+                    await websocket.send_text(json.dumps(
+                        {"type": "resume_failed", "output": "No run to resume, please send the query again"}))
+                    continue
+                attach(run)
+                await websocket.send_text(json.dumps({
+                    "type": "resumed",
+                    "run_id": run.run_id,
+                    "last_seq": run.last_seq,
+                    "truncated": run.truncated(last_seq),
+                }))
+                follow(run, last_seq)
 
     except WebSocketDisconnect:
-        print(f"WebSocket disconnected for user: {user_email}")
-        # Clean up session when user disconnects
-        support_bot.clear_user_session(user_email)
+        logger.info("WebSocket disconnected for user: %s", user_email)
+        # Without a run to resume, clean up the session right away
+        if attached is None:
+            support_bot.clear_user_session(user_email)
+            prefetcher.cancel(user_email)
     except Exception as e:
-        print(f"WebSocket error: {e}")
+        logger.exception("WebSocket error: %s", e)
         await websocket.close()
+    finally:
+        if sending is not None:
+            sending.cancel()
+        attach(None)
+
+
+# In-flight HTTP run of each user, cancelled when the same user sends a new message
+http_runs: dict[str, asyncio.Task] = {}
+
+
+async def final_event(email: str, events, request: Request) -> dict:
+    """First answer or ask_user event of a run, cancelling the run if the client disconnects"""
+    async def consume():
+        async for chunk in events:
+            if chunk["type"] in ["answer", "ask_user"]:
+                return chunk
+        return None
+
+    previous = http_runs.get(email)
+    if previous is not None and not previous.done():
+        logger.info("Cancelling superseded HTTP run for %s", email)
+        previous.cancel()
+    task = asyncio.create_task(consume())
+    http_runs[email] = task
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if not task.done() and await request.is_disconnected():
+                logger.info("Client of %s disconnected, cancelling its run", email)
+                task.cancel()
+        if task.cancelled():
+            return {"type": "error", "output": "Run cancelled"}
+        return task.result() or {"type": "error", "output": "No response received"}
+    finally:
+        if not task.done():
+            task.cancel()
+        if http_runs.get(email) is task:
+            del http_runs[email]
 
 
 @app.post("/chatendpoint")  # should be POST
-async def getting_user_query(user_query: UserQuerie):
+async def getting_user_query(user_query: UserQuerie, request: Request):
     # return {"type": "intermediate", "output": "Agent still running..."}
-    support_bot.clear_user_session(user_query.email)
-    print("User Query Received:", user_query)
+    logger.info("User query received from %s", user_query.email)
     user = match_user_by_email(user_query.email)
-    query = user_query.query
-    global enable_deepsearch, is_doctor, name
-    enable_deepsearch = user_query.enable_deepsearch
-    is_doctor = user_query.is_doctor
-    name = user["name"]   # remove the quotes
-
-    final_result = None
-    async for chunk in support_bot.run_agent(
-        query,
-        enable_deepsearch,
-        is_doctor,
-        name,
-        user_query.email
-    ):
-        if chunk["type"] in ["answer", "ask_user"]:
-            final_result = chunk
-            break
+    state = support_bot.start_conversation(
+        user_query.email, user_query.enable_deepsearch, user_query.is_doctor, user_query.engine, user_query.query)
 
-    return final_result or {"type": "error", "output": "No response received"}
+    return await final_event(user_query.email, support_bot.run_agent(
+        user_query.query,
+        state.enable_deepsearch,
+        state.is_doctor,
+        user["name"],
+        user_query.email,
+        state.engine
+    ), request)
 
 
 @app.post("/answer_user")
-async def answer_user(data: UserAnswer):
+async def answer_user(data: UserAnswer, request: Request):
     answer = data.answer
     email = data.email
-    if not data:
+    state = support_bot.continue_conversation(email)
+    if state is None:
         raise HTTPException(
             status_code=400, detail="No active session for this user")
 
     user = match_user_by_email(email)
     name = user["name"]
 
-    final_result = None
-    async for chunk in support_bot.run_agent(
+    return await final_event(email, support_bot.run_agent(
         answer,
-        False,  # You might want to pass these from the request
-        False,
+        state.enable_deepsearch,
+        state.is_doctor,
         name,
-        email
-    ):
-        if chunk["type"] in ["answer", "ask_user"]:
-            final_result = chunk
-            break
-
-    return final_result or {"type": "error", "output": "No response received"}
+        email,
+        state.engine,
+        use_cache=False
+    ), request)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(job: JobRequest):
+    if match_user_by_email(job.email) is None:
+        raise HTTPException(status_code=404, detail="No user found with that email")
+    job_id = await job_manager.submit(job.email, job.model_dump())
+    return {"job_id": job_id, "status": "queued"}
+
+
+@app.get("/jobs/stats")
+def job_stats():
+    return job_manager.stats()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_manager.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str, after: int = 0, limit: int = 500):
+    job = await asyncio.to_thread(job_manager.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    events = await asyncio.to_thread(job_manager.store.events, job_id, after, min(limit, 500))
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "events": events,
+        "next_after": events[-1]["seq"] if events else after,
+    }
+
+
+def batch_upstreams() -> dict:
+    return {"gemini": gemini_upstream, "tavily": tavily_upstream}
+
+
+async def answer_batch_question(record: dict, batch_id: str, defaults: dict) -> dict:
+    """Answer one batch question as a conversation of its own.
+
+    A question the agents answer with a question of their own has no one to
+    reply, it is recorded with status needs_input.
+    """
+    email = f"batch:{batch_id}:{record['id']}"
+    enable_deepsearch = bool(record.get("enable_deepsearch", defaults["enable_deepsearch"]))
+    is_doctor = bool(record.get("is_doctor", defaults["is_doctor"]))
+    engine = record.get("engine", defaults["engine"])
+    state = support_bot.start_conversation(email, enable_deepsearch, is_doctor, engine, record["question"])
+    final = None
+    try:
+        async for event in support_bot.run_agent(record["question"], state.enable_deepsearch, is_doctor, "Batch", email,
+                                                 engine):
+            if event["type"] in ["answer", "ask_user", "error"]:
+                final = event
+                break
+    finally:
+        support_bot.clear_user_session(email)
+        support_bot.run_state.delete(email)
+
+    if final is None:
+        return {"status": "error", "output": "No response received"}
+    if final["type"] == "error":
+        return {"status": "error", "output": final["output"]}
+    if final["type"] == "ask_user":
+        return {"status": "needs_input", "output": final["question"]}
+    result = {"status": "partial" if final.get("partial") else "answered", "output": final["output"]}
+    for key in ("cached", "stop_reason", "skipped", "tier"):
+        if key in final:
+            result[key] = final[key]
+    return result
+
+
+active_batches: set[str] = set()
+
+
+@app.post("/batch")
+async def run_batch(request: Request, email: str, batch_id: str | None = None, enable_deepsearch: bool = False,
+                    is_doctor: bool = False, engine: str | None = None, concurrency: int = 4):
+    """Answer a JSONL body of questions, streaming results as JSONL in completion order.
+
+    Posting again with the same batch_id replays the answers already written
+    and only runs the questions that are missing or failed.
+    """
+    if match_user_by_email(email) is None:
+        raise HTTPException(status_code=404, detail="No user found with that email")
+    batch_id = batch_id or time.strftime("%Y%m%d-%H%M%S-") + os.urandom(4).hex()
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", batch_id):
+        raise HTTPException(status_code=400, detail="batch_id may only contain letters, digits, - and _")
+    if batch_id in active_batches:
+        raise HTTPException(status_code=409, detail="This batch is already running")
+    questions = list(read_questions((await request.body()).decode("utf-8").splitlines()))
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    path = os.path.join(BATCH_DIR, f"{batch_id}.jsonl")
+    previous = [result for result in load_results(path) if result.get("status") != "error"]
+    defaults = {"enable_deepsearch": enable_deepsearch, "is_doctor": is_doctor, "engine": engine}
+    runner = BatchRunner(lambda record: answer_batch_question(record, batch_id, defaults),
+                         min(max(1, concurrency), BATCH_MAX_CONCURRENCY), batch_upstreams())
+    logger.info("Batch %s from %s: %d questions, %d already answered", batch_id, email, len(questions), len(previous))
+    active_batches.add(batch_id)
+
+    async def results():
+        try:
+            for result in previous:
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+            with open_output(path) as output:
+                async for result in runner.run(questions, completed_ids(previous)):
+                    line = json.dumps(result, ensure_ascii=False) + "\n"
+                    output.write(line)
+                    output.flush()
+                    yield line
+            report = runner.report()
+            logger.info("Batch %s finished: %s", batch_id, report)
+            yield json.dumps({"report": report}) + "\n"
+        finally:
+            active_batches.discard(batch_id)
+
+    return StreamingResponse(results(), media_type="application/x-ndjson", headers={"X-Batch-Id": batch_id})
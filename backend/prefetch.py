@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+from compaction import tokenize
+from doc_store import canonicalize_url
+from governor import queue_listener
+from budget import current_budget
+from telemetry import Counter, current_trace, metrics
+
+logger = logging.getLogger(__name__)
+
+prefetch_items = Counter("medassistant_prefetch_items_total", "Searches and pages fetched speculatively")
+prefetch_hits = Counter("medassistant_prefetch_hits_total", "Speculatively fetched items used by the resumed run")
+metrics.extend([prefetch_items, prefetch_hits])
+
+
+def candidate_queries(query: str, limit: int) -> list[str]:
+    """Searches the resumed run is likely to make, derived from the question alone"""
+    text = " ".join(query.split())
+    keywords = " ".join(tokenize(text))
+    candidates = [text, keywords, f"{keywords} latest research"]
+    unique: dict[str, str] = {}
+    for candidate in candidates:
+        key = " ".join(candidate.lower().split())
+        if key and key not in unique:
+            unique[key] = candidate
+    return list(unique.values())[:limit]
+
+
+@dataclass
+class PrefetchEntry:
+    email: str
+    query: str
+    expires_at: float
+    searches: dict[str, asyncio.Task] = field(default_factory=dict)
+    documents: dict[str, dict] = field(default_factory=dict)
+    used_searches: set[str] = field(default_factory=set)
+    used_documents: set[str] = field(default_factory=set)
+    task: asyncio.Task | None = None
+
+    def search(self, key: str) -> asyncio.Task | None:
+        task = self.searches.get(key)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            return None
+        self.used_searches.add(key)
+        return task
+
+    def take_documents(self, urls: list[str]) -> dict[str, dict]:
+        found = {url: self.documents[url] for url in urls if url in self.documents}
+        self.used_documents.update(found)
+        return found
+
+    def cancel(self) -> None:
+        for task in [self.task, *self.searches.values()]:
+            if task is not None and not task.done():
+                task.cancel()
+
+
+# The warm entry of the run being resumed, read by the search and extract tools
+current_prefetch: ContextVar[PrefetchEntry | None] = ContextVar("current_prefetch", default=None)
+
+
+class SpeculativePrefetcher:
+    """Uses the time a user spends answering a question to run likely searches.
+
+    While a question is pending, candidate queries derived from the original
+    question are searched and the top pages extracted into a per-user warm
+    cache. The resumed run reads it through current_prefetch. Entries are
+    cancelled when the user starts over or leaves, and expire after
+    ttl_seconds.
+    """
+
+    def __init__(self, search: Callable[[str], Awaitable[dict]], extract: Callable[[list[str]], Awaitable[dict]],
+                 key: Callable[[str], str], max_queries: int = 3, max_urls: int = 4,
+                 ttl_seconds: float = 300, max_users: int = 100):
+        self.search = search
+        self.extract = extract
+        self.key = key
+        self.max_queries = max_queries
+        self.max_urls = max_urls
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max_users
+        self._entries: dict[str, PrefetchEntry] = {}
+        self.started = 0
+        self.skipped = 0
+        self.expired = 0
+        self.searches = 0
+        self.documents = 0
+        self.search_hits = 0
+        self.document_hits = 0
+
+    def _expire(self) -> None:
+        now = time.time()
+        for email, entry in list(self._entries.items()):
+            if entry.expires_at <= now:
+                entry.cancel()
+                del self._entries[email]
+                self.expired += 1
+
+    def start(self, email: str, query: str) -> None:
+        self.cancel(email)
+        self._expire()
+        if self.max_queries <= 0 or len(self._entries) >= self.max_users:
+            self.skipped += 1
+            return
+        entry = PrefetchEntry(email, query, time.time() + self.ttl_seconds)
+        self._entries[email] = entry
+        entry.task = asyncio.create_task(self._prefetch(entry))
+        self.started += 1
+
+    async def _prefetch(self, entry: PrefetchEntry) -> None:
+        # Upstream calls stay attributed to the user but are not reported to or limited by the finished run
+        queue_listener.set(None)
+        current_trace.set(None)
+        current_budget.set(None)
+        current_prefetch.set(None)
+        try:
+            for query in candidate_queries(entry.query, self.max_queries):
+                entry.searches[self.key(query)] = asyncio.create_task(self.search(query))
+            self.searches += len(entry.searches)
+            prefetch_items.inc(len(entry.searches), kind="search")
+            responses = await asyncio.gather(*entry.searches.values(), return_exceptions=True)
+
+            ranked: dict[str, float] = {}
+            for response in responses:
+                if isinstance(response, BaseException):
+                    continue
+                for result in response.get("results", []):
+                    url = result.get("url")
+                    if url:
+                        ranked[url] = max(ranked.get(url, 0.0), result.get("score") or 0.0)
+            urls = sorted(ranked, key=ranked.get, reverse=True)[:self.max_urls]
+            if urls:
+                extracted = await self.extract(urls)
+                for result in extracted.get("results", []):
+                    entry.documents[canonicalize_url(result["url"])] = result
+                self.documents += len(entry.documents)
+                prefetch_items.inc(len(entry.documents), kind="extract")
+            logger.debug("Prefetched %d searches and %d pages for %s",
+                         len(entry.searches), len(entry.documents), entry.email)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Prefetch for %s failed: %s", entry.email, e)
+
+    def claim(self, email: str) -> PrefetchEntry | None:
+        """Hand the user's warm entry to the run that resumes the conversation"""
+        self._expire()
+        return self._entries.pop(email, None)
+
+    def finish(self, entry: PrefetchEntry) -> None:
+        """Record what the resumed run used and drop the rest"""
+        entry.cancel()
+        self.search_hits += len(entry.used_searches)
+        self.document_hits += len(entry.used_documents)
+        prefetch_hits.inc(len(entry.used_searches), kind="search")
+        prefetch_hits.inc(len(entry.used_documents), kind="extract")
+
+    def cancel(self, email: str) -> None:
+        entry = self._entries.pop(email, None)
+        if entry is not None:
+            entry.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._entries),
+            "started": self.started,
+            "skipped": self.skipped,
+            "expired": self.expired,
+            "searches": self.searches,
+            "documents": self.documents,
+            "search_hits": self.search_hits,
+            "document_hits": self.document_hits,
+            "search_hit_rate": round(self.search_hits / self.searches, 4) if self.searches else 0.0,
+            "document_hit_rate": round(self.document_hits / self.documents, 4) if self.documents else 0.0,
+        }
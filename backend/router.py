@@ -0,0 +1,120 @@
+import logging
+import re
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from compaction import tokenize
+from evidence import EvidenceIndex
+
+logger = logging.getLogger(__name__)
+
+TIERS = ("quick", "standard", "deep")
+
+FACTUAL = re.compile(r"^\s*(what is|what's|define|who is|how much|how many)\b"
+                     r"|\b(meaning of|definition of|normal range|dosage of|stands? for)\b", re.I)
+COMPARISON = re.compile(r"\b(compare|comparison|compared|versus|vs\.?|difference between|differences between|"
+                        r"better than|pros and cons)\b", re.I)
+RESEARCH = re.compile(r"\b(evidence|research|trials?|studies|study|meta-analys[ie]s|systematic review|latest|"
+                      r"guidelines?|recommendations?|efficacy|effectiveness|outcomes?|mechanisms?|prognosis|"
+                      r"benefits and (risks|concerns)|concerns|controvers\w*)\b", re.I)
+YEARS = re.compile(r"\b(19|20)\d{2}\b")
+
+
+@dataclass
+class Route:
+    tier: str
+    score: float
+    reasons: list[str] = field(default_factory=list)
+
+
+class QueryRouter:
+    """Picks the pipeline depth of a question from its wording, without an LLM call.
+
+    A deep-search question starts at the standard tier (search and
+    synthesis only). Short definitional questions drop to the quick tier,
+    comparisons, multi-part questions and questions asking for research,
+    guidelines or a time span climb to the deep tier. A client that did not
+    ask for deep search always gets the quick tier.
+    """
+
+    def __init__(self, standard_threshold: float = 1.0, deep_threshold: float = 3.0):
+        self.standard_threshold = standard_threshold
+        self.deep_threshold = deep_threshold
+
+    def score(self, query: str, is_doctor: bool = False) -> tuple[float, list[str]]:
+        score = 1.0
+        reasons = []
+        words = len(tokenize(query))
+        if words >= 14:
+            score += 1.5
+            reasons.append("long")
+        elif words >= 7:
+            score += 0.5
+            reasons.append("medium")
+        if FACTUAL.search(query) and words < 10:
+            score -= 1.5
+            reasons.append("factual")
+        if COMPARISON.search(query):
+            score += 2.0
+            reasons.append("comparison")
+        research = len(set(match.group(0).lower() for match in RESEARCH.finditer(query)))
+        if research:
+            score += min(research, 2)
+            reasons.append("research")
+        if YEARS.search(query):
+            score += 1.0
+            reasons.append("time span")
+        if query.count("?") > 1 or len(re.findall(r"\b(and|including|as well as)\b", query, re.I)) > 1:
+            score += 1.0
+            reasons.append("multi-part")
+        if is_doctor:
+            score += 0.5
+            reasons.append("doctor")
+        return score, reasons
+
+    def route(self, query: str, enable_deepsearch: bool, is_doctor: bool = False) -> Route:
+        if not enable_deepsearch:
+            return Route("quick", 0.0, ["client"])
+        score, reasons = self.score(query, is_doctor)
+        if score >= self.deep_threshold:
+            tier = "deep"
+        elif score >= self.standard_threshold:
+            tier = "standard"
+        else:
+            tier = "quick"
+        logger.debug("Routed to %s (%.1f, %s): %s", tier, score, ", ".join(reasons), query)
+        return Route(tier, score, reasons)
+
+
+class ConvergenceCheck:
+    """Decides when searching stopped adding evidence.
+
+    The search phase has converged once at least min_batches result batches
+    were indexed and each of the last `window` batches added no new domain
+    and fewer than min_new_fraction new passages.
+    """
+
+    def __init__(self, window: int = 2, min_new_fraction: float = 0.2, min_batches: int = 3):
+        self.window = window
+        self.min_new_fraction = min_new_fraction
+        self.min_batches = min_batches
+
+    def converged(self, index: EvidenceIndex | None) -> bool:
+        if index is None or self.window <= 0 or len(index.batches) < max(self.min_batches, self.window):
+            return False
+        return all(batch.new_domains == 0 and batch.new_passages < self.min_new_fraction * max(batch.passages, 1)
+                   for batch in index.batches[-self.window:])
+
+
+@dataclass
+class RunRoute:
+    """Tier of the current run and why it stopped early, if it did"""
+    tier: str
+    stop_reason: str | None = None
+
+    def stop(self, reason: str) -> None:
+        if self.stop_reason is None:
+            self.stop_reason = reason
+            logger.info("Run stopping early: %s", reason)
+
+
+current_route: ContextVar[RunRoute | None] = ContextVar("current_route", default=None)
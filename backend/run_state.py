@@ -0,0 +1,147 @@
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, replace
+from sessions import session_id_for
+
+
+@dataclass
+class UserRunState:
+    """What a worker needs to continue a user's conversation"""
+    email: str
+    session_id: str
+    enable_deepsearch: bool = False
+    is_doctor: bool = False
+    engine: str | None = None
+    pending_question: str | None = None
+    updated_at: float = 0.0
+    tier: str | None = None
+    # The question that started the conversation, later messages are answers to follow-up questions
+    query: str | None = None
+
+
+class RunStateBackend(ABC):
+    """Per-user run state shared by every worker process.
+
+    A new question starts a conversation with a fresh session id, so a
+    cleanup of the previous conversation on another worker can never delete
+    the new one's history.
+    """
+
+    @abstractmethod
+    def get(self, email: str) -> UserRunState | None: ...
+
+    @abstractmethod
+    def put(self, state: UserRunState) -> None: ...
+
+    @abstractmethod
+    def delete(self, email: str) -> None: ...
+
+    def start(self, email: str, enable_deepsearch: bool, is_doctor: bool,
+              engine: str | None = None, tier: str | None = None, query: str | None = None) -> UserRunState:
+        state = UserRunState(
+            email=email,
+            session_id=f"{session_id_for(email)}_{uuid.uuid4().hex[:12]}",
+            enable_deepsearch=enable_deepsearch,
+            is_doctor=is_doctor,
+            engine=engine,
+            updated_at=time.time(),
+            tier=tier,
+            query=query,
+        )
+        self.put(state)
+        return state
+
+    def set_pending_question(self, email: str, question: str | None) -> None:
+        state = self.get(email)
+        if state is not None:
+            self.put(replace(state, pending_question=question, updated_at=time.time()))
+
+
+class MemoryRunState(RunStateBackend):
+    """Process-local backend, only correct with a single worker"""
+
+    def __init__(self):
+        self._states: dict[str, UserRunState] = {}
+
+    def get(self, email: str) -> UserRunState | None:
+        return self._states.get(email)
+
+    def put(self, state: UserRunState) -> None:
+        self._states[state.email] = state
+
+    def delete(self, email: str) -> None:
+        self._states.pop(email, None)
+
+
+class SQLiteRunState(RunStateBackend):
+    """Backend on a SQLite file that all workers on a host open"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS run_state (
+                email TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                enable_deepsearch INTEGER NOT NULL,
+                is_doctor INTEGER NOT NULL,
+                engine TEXT,
+                pending_question TEXT,
+                updated_at REAL NOT NULL,
+                tier TEXT,
+                query TEXT
+            )
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(run_state)")}
+        for column in ("tier", "query"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE run_state ADD COLUMN {column} TEXT")
+        self._conn.commit()
+
+    def get(self, email: str) -> UserRunState | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT email, session_id, enable_deepsearch, is_doctor, engine, pending_question, updated_at, tier, query "
+                "FROM run_state WHERE email = ?", (email,)).fetchone()
+        if row is None:
+            return None
+        email, session_id, enable_deepsearch, is_doctor, engine, pending_question, updated_at, tier, query = row
+        return UserRunState(email, session_id, bool(enable_deepsearch), bool(is_doctor), engine,
+                            pending_question, updated_at, tier, query)
+
+    def put(self, state: UserRunState) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO run_state "
+                "(email, session_id, enable_deepsearch, is_doctor, engine, pending_question, updated_at, tier, query) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (state.email, state.session_id, int(state.enable_deepsearch), int(state.is_doctor),
+                 state.engine, state.pending_question, state.updated_at or time.time(), state.tier, state.query))
+            self._conn.commit()
+
+    def set_pending_question(self, email: str, question: str | None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE run_state SET pending_question = ?, updated_at = ? WHERE email = ?",
+                (question, time.time(), email))
+            self._conn.commit()
+
+    def delete(self, email: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM run_state WHERE email = ?", (email,))
+            self._conn.commit()
+
+
+def make_run_state(backend: str, db_path: str) -> RunStateBackend:
+    if backend == "memory":
+        return MemoryRunState()
+    if backend == "sqlite":
+        return SQLiteRunState(db_path)
+    raise ValueError(f"Unknown run state backend: {backend}")
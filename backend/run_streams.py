@@ -0,0 +1,158 @@
+import asyncio
+import itertools
+import logging
+import uuid
+from collections import deque
+from typing import AsyncIterator, Callable
+from governor import queue_listener
+
+logger = logging.getLogger(__name__)
+
+
+class RunStream:
+    """Bounded, sequence-numbered log of the events of one run"""
+
+    def __init__(self, email: str, max_events: int = 2000, session_id: str | None = None):
+        self.email = email
+        self.session_id = session_id
+        self.run_id = uuid.uuid4().hex
+        self.events: deque[tuple[int, dict]] = deque(maxlen=max_events)
+        self.last_seq = 0
+        self.done = False
+        self.subscribers = 0
+        self.task: asyncio.Task | None = None
+        self.expiry: asyncio.TimerHandle | None = None
+        self._signal = asyncio.Event()
+
+    def _wake(self) -> None:
+        signal, self._signal = self._signal, asyncio.Event()
+        signal.set()
+
+    def append(self, event: dict) -> int:
+        self.last_seq += 1
+        self.events.append((self.last_seq, event))
+        self._wake()
+        return self.last_seq
+
+    def close(self) -> None:
+        self.done = True
+        self._wake()
+
+    @property
+    def first_seq(self) -> int:
+        return self.events[0][0] if self.events else self.last_seq + 1
+
+    def truncated(self, after: int) -> bool:
+        """True when events after `after` were already dropped from the log"""
+        return after + 1 < self.first_seq
+
+    async def follow(self, after: int = 0) -> AsyncIterator[tuple[int, dict]]:
+        """Events with a sequence number above `after`, then live events until the run ends"""
+        while True:
+            signal = self._signal
+            start = max(0, after + 1 - self.first_seq)
+            batch = list(itertools.islice(self.events, start, None))
+            for seq, event in batch:
+                yield seq, event
+                after = seq
+            if self.done and after >= self.last_seq:
+                return
+            if not batch:
+                await signal.wait()
+
+
+class RunRegistry:
+    """Runs detached from the socket that started them.
+
+    Each user has at most one run. It keeps producing into its log while no
+    client is attached, and once the last subscriber detaches the run is
+    cancelled and forgotten after grace_seconds unless a client resumes it.
+    `on_expire` is called with the expired stream when that happens.
+    """
+
+    def __init__(self, on_expire: Callable[[RunStream], None], grace_seconds: float = 120, max_events: int = 2000):
+        self.on_expire = on_expire
+        self.grace_seconds = grace_seconds
+        self.max_events = max_events
+        self._runs: dict[str, RunStream] = {}
+        self.started = 0
+        self.resumed = 0
+        self.expired = 0
+        self.superseded = 0
+
+    def start(self, email: str, events: AsyncIterator[dict], session_id: str | None = None) -> RunStream:
+        previous = self._runs.pop(email, None)
+        if previous is not None:
+            self._discard(previous)
+            if not previous.done:
+                self.superseded += 1
+        stream = RunStream(email, self.max_events, session_id)
+        self._runs[email] = stream
+        stream.task = asyncio.create_task(self._produce(stream, events))
+        self.started += 1
+        return stream
+
+    async def _produce(self, stream: RunStream, events: AsyncIterator[dict]) -> None:
+        async def log_queued(event: dict) -> None:
+            stream.append(event)
+
+        # Queue position updates go to the log as well, not to whichever socket started the run
+        queue_listener.set(log_queued)
+        try:
+            async for event in events:
+                stream.append(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Run for %s failed: %s", stream.email, e)
+            stream.append({"type": "error", "output": f"Error occurred: {str(e)}"})
+        finally:
+            stream.close()
+
+    def attach(self, email: str, run_id: str | None = None) -> RunStream | None:
+        stream = self._runs.get(email)
+        if stream is None or (run_id and stream.run_id != run_id):
+            return None
+        if stream.expiry is not None:
+            stream.expiry.cancel()
+            stream.expiry = None
+        stream.subscribers += 1
+        return stream
+
+    def resume(self, email: str, run_id: str | None = None) -> RunStream | None:
+        stream = self.attach(email, run_id)
+        if stream is not None:
+            self.resumed += 1
+        return stream
+
+    def detach(self, stream: RunStream) -> None:
+        stream.subscribers = max(0, stream.subscribers - 1)
+        if stream.subscribers == 0 and self._runs.get(stream.email) is stream and stream.expiry is None:
+            stream.expiry = asyncio.get_running_loop().call_later(self.grace_seconds, self._expire, stream)
+
+    def _expire(self, stream: RunStream) -> None:
+        stream.expiry = None
+        if self._runs.get(stream.email) is not stream or stream.subscribers:
+            return
+        del self._runs[stream.email]
+        self._discard(stream)
+        self.expired += 1
+        self.on_expire(stream)
+
+    def _discard(self, stream: RunStream) -> None:
+        if stream.expiry is not None:
+            stream.expiry.cancel()
+            stream.expiry = None
+        if stream.task is not None and not stream.task.done():
+            stream.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "runs": len(self._runs),
+            "producing": sum(1 for stream in self._runs.values() if not stream.done),
+            "detached": sum(1 for stream in self._runs.values() if not stream.subscribers),
+            "started": self.started,
+            "resumed": self.resumed,
+            "expired": self.expired,
+            "superseded": self.superseded,
+        }
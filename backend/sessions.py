@@ -0,0 +1,553 @@
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Any, Iterator
+from compaction import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """Small pool of WAL-mode SQLite connections shared by every session"""
+
+    def __init__(self, db_path: str, size: int = 4):
+        self.db_path = db_path
+        self.size = size
+        self.acquisitions = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._pool: queue.Queue[sqlite3.Connection] = queue.Queue(maxsize=size)
+        for _ in range(size):
+            conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._pool.put(conn)
+        with self.connection() as conn:
+            self._init_schema(conn)
+
+    def _init_schema(self, conn: sqlite3.Connection) -> None:
+        # Same schema as agents.SQLiteSession so existing databases keep working
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS agent_sessions (
+                session_id TEXT PRIMARY KEY,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS agent_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                message_data TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES agent_sessions (session_id)
+                    ON DELETE CASCADE
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_agent_messages_session_id
+            ON agent_messages (session_id, created_at)
+            """
+        )
+        # Windowed sessions: where each turn starts, and the summary of the turns before the window
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_agent_messages_session_message
+            ON agent_messages (session_id, id)
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS session_turns (
+                session_id TEXT NOT NULL,
+                first_message_id INTEGER NOT NULL,
+                PRIMARY KEY (session_id, first_message_id)
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS session_summaries (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                through_message_id INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        conn.commit()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        started = time.perf_counter()
+        conn = self._pool.get()
+        waited = time.perf_counter() - started
+        self.acquisitions += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def close(self) -> None:
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+    def stats(self) -> dict:
+        return {
+            "pool_size": self.size,
+            "pool_idle": self._pool.qsize(),
+            "db_acquisitions": self.acquisitions,
+            "db_wait_seconds": round(self.wait_seconds, 4),
+            "db_max_wait_seconds": round(self.max_wait_seconds, 4),
+        }
+
+
+class PooledSession:
+    """Agents SDK session backed by a shared ConnectionPool instead of its own connections"""
+
+    def __init__(self, session_id: str, pool: ConnectionPool):
+        self.session_id = session_id
+        self.pool = pool
+
+    async def get_items(self, limit: int | None = None) -> list[Any]:
+        def _get_items_sync():
+            with self.pool.connection() as conn:
+                if limit is None:
+                    rows = conn.execute(
+                        "SELECT message_data FROM agent_messages WHERE session_id = ? ORDER BY id ASC",
+                        (self.session_id,),
+                    ).fetchall()
+                else:
+                    rows = conn.execute(
+                        "SELECT message_data FROM agent_messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                        (self.session_id, limit),
+                    ).fetchall()
+                    rows.reverse()
+            items = []
+            for (message_data,) in rows:
+                try:
+                    items.append(json.loads(message_data))
+                except json.JSONDecodeError:
+                    continue
+            return items
+
+        return await asyncio.to_thread(_get_items_sync)
+
+    async def add_items(self, items: list[Any]) -> None:
+        if not items:
+            return
+
+        def _add_items_sync():
+            with self.pool.connection() as conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO agent_sessions (session_id) VALUES (?)", (self.session_id,))
+                conn.executemany(
+                    "INSERT INTO agent_messages (session_id, message_data) VALUES (?, ?)",
+                    [(self.session_id, json.dumps(item)) for item in items],
+                )
+                conn.execute(
+                    "UPDATE agent_sessions SET updated_at = CURRENT_TIMESTAMP WHERE session_id = ?",
+                    (self.session_id,),
+                )
+                conn.commit()
+
+        await asyncio.to_thread(_add_items_sync)
+
+    async def pop_item(self) -> Any | None:
+        def _pop_item_sync():
+            with self.pool.connection() as conn:
+                row = conn.execute(
+                    """
+                    DELETE FROM agent_messages
+                    WHERE id = (SELECT id FROM agent_messages WHERE session_id = ? ORDER BY id DESC LIMIT 1)
+                    RETURNING message_data
+                    """,
+                    (self.session_id,),
+                ).fetchone()
+                conn.commit()
+            if row is None:
+                return None
+            try:
+                return json.loads(row[0])
+            except json.JSONDecodeError:
+                return None
+
+        return await asyncio.to_thread(_pop_item_sync)
+
+    async def clear_session(self) -> None:
+        def _clear_session_sync():
+            with self.pool.connection() as conn:
+                conn.execute("DELETE FROM agent_messages WHERE session_id = ?", (self.session_id,))
+                conn.execute("DELETE FROM agent_sessions WHERE session_id = ?", (self.session_id,))
+                conn.commit()
+
+        await asyncio.to_thread(_clear_session_sync)
+
+
+@dataclass
+class HistoryPolicy:
+    """How much conversation history a windowed session replays into the model"""
+    window_turns: int = 4
+    token_budget: int = 6000
+    tool_output_tokens: int = 400
+    summary_tokens: int = 800
+
+
+@dataclass
+class HistoryStats:
+    reads: int = 0
+    tokens: int = 0
+    max_tokens: int = 0
+    tool_outputs_compacted: int = 0
+    turns_folded: int = 0
+    turns_dropped: int = 0
+
+    def record_read(self, tokens: int) -> None:
+        self.reads += 1
+        self.tokens += tokens
+        self.max_tokens = max(self.max_tokens, tokens)
+
+    def snapshot(self) -> dict:
+        data = asdict(self)
+        data["avg_tokens_per_read"] = round(self.tokens / self.reads) if self.reads else 0
+        return data
+
+
+def is_user_message(item: dict) -> bool:
+    return item.get("role") == "user" and item.get("type", "message") == "message"
+
+
+def item_text(item: dict) -> str:
+    content = item.get("content", "")
+    if isinstance(content, str):
+        return content
+    return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+
+
+def clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit].rstrip() + "..."
+
+
+def split_turns(rows: list[tuple[int, dict]]) -> list[list[tuple[int, dict]]]:
+    """Group (message id, item) rows into turns, each starting at a user message"""
+    turns: list[list[tuple[int, dict]]] = []
+    for row in rows:
+        if not turns or is_user_message(row[1]):
+            turns.append([])
+        turns[-1].append(row)
+    return turns
+
+
+def summarize_turn(turn: list[tuple[int, dict]]) -> str:
+    """One summary line per turn: the user message, the tools called and the final reply"""
+    user = next((item_text(item) for _, item in turn if is_user_message(item)), "")
+    tools = [f"{item.get('name')}({clip(item.get('arguments', ''), 80)})"
+             for _, item in turn if item.get("type") == "function_call"]
+    replies = [item_text(item) for _, item in turn if item.get("role") == "assistant"]
+    line = f"- User: {clip(user, 200)}"
+    if tools:
+        line += f"\n  Tools: {', '.join(tools)}"
+    if replies and replies[-1]:
+        line += f"\n  Assistant: {clip(replies[-1], 300)}"
+    return line
+
+
+def trim_summary(lines: list[str], max_tokens: int) -> str:
+    """Most recent summary lines that fit in max_tokens"""
+    kept: list[str] = []
+    used = 0
+    for line in reversed(lines):
+        used += estimate_tokens(line) + 1
+        if used > max_tokens and kept:
+            kept.append("- (earlier turns omitted)")
+            break
+        kept.append(line)
+    return "\n".join(reversed(kept))
+
+
+class WindowedSession(PooledSession):
+    """Session that replays a bounded window of its history.
+
+    The last window_turns turns are replayed verbatim, except that tool
+    outputs above tool_output_tokens in all but the latest turn are replaced
+    by a reference to the message that stores them. Turns that leave the
+    window are folded into a stored rolling summary. If the result is still
+    above token_budget, the oldest turns of the window are summarized too.
+    Reads go through session_turns, so they cost O(window) rather than
+    O(history).
+    """
+
+    def __init__(self, session_id: str, pool: ConnectionPool, policy: HistoryPolicy, stats: HistoryStats):
+        super().__init__(session_id, pool)
+        self.policy = policy
+        self.stats = stats
+
+    def _window_start(self, conn: sqlite3.Connection) -> int | None:
+        row = conn.execute(
+            "SELECT first_message_id FROM session_turns WHERE session_id = ? "
+            "ORDER BY first_message_id DESC LIMIT 1 OFFSET ?",
+            (self.session_id, max(0, self.policy.window_turns - 1)),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _summary(self, conn: sqlite3.Connection) -> tuple[str, int]:
+        row = conn.execute(
+            "SELECT summary, through_message_id FROM session_summaries WHERE session_id = ?",
+            (self.session_id,),
+        ).fetchone()
+        return (row[0], row[1]) if row else ("", 0)
+
+    def _fold(self, conn: sqlite3.Connection) -> None:
+        """Move the turns before the window into the rolling summary"""
+        start = self._window_start(conn)
+        summary, through = self._summary(conn)
+        if start is None or start - 1 <= through:
+            return
+        rows = conn.execute(
+            "SELECT id, message_data FROM agent_messages WHERE session_id = ? AND id > ? AND id < ? ORDER BY id",
+            (self.session_id, through, start),
+        ).fetchall()
+        turns = split_turns(self._decode(rows))
+        lines = ([summary] if summary else []) + [summarize_turn(turn) for turn in turns]
+        conn.execute(
+            "INSERT OR REPLACE INTO session_summaries (session_id, summary, through_message_id, updated_at) "
+            "VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+            (self.session_id, trim_summary(lines, self.policy.summary_tokens), start - 1),
+        )
+        conn.execute("DELETE FROM session_turns WHERE session_id = ? AND first_message_id < ?",
+                     (self.session_id, start))
+        self.stats.turns_folded += len(turns)
+
+    @staticmethod
+    def _decode(rows: list[tuple[int, str]]) -> list[tuple[int, dict]]:
+        items = []
+        for message_id, message_data in rows:
+            try:
+                items.append((message_id, json.loads(message_data)))
+            except json.JSONDecodeError:
+                continue
+        return items
+
+    def _compact_tool_output(self, message_id: int, item: dict) -> dict:
+        output = item.get("output")
+        text = output if isinstance(output, str) else json.dumps(output)
+        if estimate_tokens(text) <= self.policy.tool_output_tokens:
+            return item
+        self.stats.tool_outputs_compacted += 1
+        return {**item, "output": f"[{len(text)} characters of tool output omitted, "
+                                  f"stored as message {message_id}] {clip(text, 300)}"}
+
+    async def get_items(self, limit: int | None = None) -> list[Any]:
+        if limit is not None:
+            return await super().get_items(limit)
+
+        def _get_items_sync():
+            with self.pool.connection() as conn:
+                summary, through = self._summary(conn)
+                start = self._window_start(conn)
+                rows = conn.execute(
+                    "SELECT id, message_data FROM agent_messages WHERE session_id = ? AND id >= ? ORDER BY id",
+                    (self.session_id, start if start is not None else through + 1),
+                ).fetchall()
+            return summary, self._decode(rows)
+
+        summary, rows = await asyncio.to_thread(_get_items_sync)
+        turns = split_turns(rows)
+        for turn in turns[:-1]:
+            turn[:] = [(message_id, self._compact_tool_output(message_id, item))
+                       if item.get("type") == "function_call_output" else (message_id, item)
+                       for message_id, item in turn]
+
+        summary_lines = [summary] if summary else []
+        while True:
+            items = [item for turn in turns for _, item in turn]
+            summary_text = trim_summary(summary_lines, self.policy.summary_tokens) if summary_lines else ""
+            tokens = estimate_tokens(summary_text) + sum(estimate_tokens(json.dumps(item)) for item in items)
+            if tokens <= self.policy.token_budget or len(turns) <= 1:
+                break
+            # The latest turn is always kept whole, older ones give way to the budget
+            summary_lines.append(summarize_turn(turns.pop(0)))
+            self.stats.turns_dropped += 1
+
+        self.stats.record_read(tokens)
+        if summary_text:
+            items.insert(0, {"role": "user", "content": f"Summary of the earlier conversation:\n{summary_text}"})
+        return items
+
+    async def add_items(self, items: list[Any]) -> None:
+        if not items:
+            return
+
+        def _add_items_sync():
+            with self.pool.connection() as conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO agent_sessions (session_id) VALUES (?)", (self.session_id,))
+                for item in items:
+                    cursor = conn.execute(
+                        "INSERT INTO agent_messages (session_id, message_data) VALUES (?, ?)",
+                        (self.session_id, json.dumps(item)),
+                    )
+                    if isinstance(item, dict) and is_user_message(item):
+                        conn.execute("INSERT INTO session_turns (session_id, first_message_id) VALUES (?, ?)",
+                                     (self.session_id, cursor.lastrowid))
+                self._fold(conn)
+                conn.execute(
+                    "UPDATE agent_sessions SET updated_at = CURRENT_TIMESTAMP WHERE session_id = ?",
+                    (self.session_id,),
+                )
+                conn.commit()
+
+        await asyncio.to_thread(_add_items_sync)
+
+    async def pop_item(self) -> Any | None:
+        item = await super().pop_item()
+
+        def _drop_stale_turns_sync():
+            with self.pool.connection() as conn:
+                conn.execute(
+                    "DELETE FROM session_turns WHERE session_id = ? AND first_message_id > "
+                    "(SELECT COALESCE(MAX(id), 0) FROM agent_messages WHERE session_id = ?)",
+                    (self.session_id, self.session_id),
+                )
+                conn.commit()
+
+        await asyncio.to_thread(_drop_stale_turns_sync)
+        return item
+
+    async def clear_session(self) -> None:
+        await super().clear_session()
+
+        def _clear_window_sync():
+            with self.pool.connection() as conn:
+                conn.execute("DELETE FROM session_turns WHERE session_id = ?", (self.session_id,))
+                conn.execute("DELETE FROM session_summaries WHERE session_id = ?", (self.session_id,))
+                conn.commit()
+
+        await asyncio.to_thread(_clear_window_sync)
+
+
+def session_id_for(user_email: str) -> str:
+    return f"user_{user_email.replace('@', '_').replace('.', '_')}"
+
+
+class SessionManager:
+    """Keeps at most max_sessions live sessions, evicting the least recently used
+    and any idle longer than idle_seconds.
+
+    Evicting only drops the in-memory object, the history stays in the database.
+    Clearing a session deletes its history in a tracked background task. With
+    a history policy sessions replay a bounded window of their history.
+    """
+
+    def __init__(self, db_path: str, max_sessions: int = 1000, idle_seconds: float = 1800,
+                 pool_size: int = 4, history: HistoryPolicy | None = None):
+        self.pool = ConnectionPool(db_path, pool_size)
+        self.history = history
+        self.history_stats = HistoryStats()
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.lru_evictions = 0
+        self.idle_evictions = 0
+        self.cleared = 0
+        self.cleanup_errors = 0
+        self._sessions: OrderedDict[str, tuple[PooledSession, float]] = OrderedDict()
+        self._cleanup_tasks: dict[str, asyncio.Task] = {}
+
+    def _evict(self) -> None:
+        oldest_allowed = time.monotonic() - self.idle_seconds
+        while self._sessions:
+            email, (_, last_used) = next(iter(self._sessions.items()))
+            if last_used >= oldest_allowed:
+                break
+            del self._sessions[email]
+            self.idle_evictions += 1
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.lru_evictions += 1
+
+    def get(self, user_email: str, session_id: str | None = None) -> PooledSession:
+        """Get or create the session for a user and mark it as recently used"""
+        session_id = session_id or session_id_for(user_email)
+        entry = self._sessions.pop(user_email, None)
+        session = entry[0] if entry and entry[0].session_id == session_id else self._new_session(session_id)
+        self._sessions[user_email] = (session, time.monotonic())
+        self._evict()
+        return session
+
+    def _new_session(self, session_id: str) -> PooledSession:
+        if self.history is None:
+            return PooledSession(session_id, self.pool)
+        return WindowedSession(session_id, self.pool, self.history, self.history_stats)
+
+    async def open(self, user_email: str, session_id: str | None = None) -> PooledSession:
+        """Like get, but waits for a pending cleanup of the same user first"""
+        pending = self._cleanup_tasks.get(user_email)
+        if pending is not None:
+            await asyncio.gather(pending, return_exceptions=True)
+        return self.get(user_email, session_id)
+
+    def __contains__(self, user_email: str) -> bool:
+        return user_email in self._sessions
+
+    def clear(self, user_email: str, session_id: str | None = None) -> asyncio.Task:
+        """Forget the user's session and delete its history in the background"""
+        entry = self._sessions.pop(user_email, None)
+        if session_id is None:
+            session = entry[0] if entry else self._new_session(session_id_for(user_email))
+        else:
+            session = self._new_session(session_id)
+        previous = self._cleanup_tasks.get(user_email)
+        task = asyncio.create_task(self._clear_after(previous, session))
+        self._cleanup_tasks[user_email] = task
+        task.add_done_callback(lambda done: self._cleanup_done(user_email, done))
+        return task
+
+    async def _clear_after(self, previous: asyncio.Task | None, session: PooledSession) -> None:
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        await session.clear_session()
+
+    def _cleanup_done(self, user_email: str, task: asyncio.Task) -> None:
+        if self._cleanup_tasks.get(user_email) is task:
+            del self._cleanup_tasks[user_email]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.cleanup_errors += 1
+            logger.warning("Session cleanup failed: %s", task.exception())
+        else:
+            self.cleared += 1
+
+    async def drain(self) -> None:
+        """Wait for every scheduled cleanup to finish"""
+        if self._cleanup_tasks:
+            await asyncio.gather(*self._cleanup_tasks.values(), return_exceptions=True)
+
+    def stats(self) -> dict:
+        data = {
+            "live_sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "lru_evictions": self.lru_evictions,
+            "idle_evictions": self.idle_evictions,
+            "cleared": self.cleared,
+            "cleanup_errors": self.cleanup_errors,
+            "pending_cleanups": len(self._cleanup_tasks),
+        }
+        data.update(self.pool.stats())
+        if self.history is not None:
+            data["history"] = self.history_stats.snapshot()
+        return data
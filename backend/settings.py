@@ -0,0 +1,8 @@
+import functools
+from dotenv import load_dotenv, find_dotenv
+
+
+@functools.cache
+def load_env() -> bool:
+    """Load .env into the environment once per process, variables already set win"""
+    return load_dotenv(find_dotenv())
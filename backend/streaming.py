@@ -0,0 +1,45 @@
+import time
+
+
+class DeltaCoalescer:
+    """Groups token deltas into larger websocket frames.
+
+    A frame is released once it holds max_chars characters or max_interval
+    seconds have passed since the previous frame.
+    """
+
+    def __init__(self, max_chars: int = 160, max_interval: float = 0.05):
+        self.max_chars = max_chars
+        self.max_interval = max_interval
+        self.segment = 0
+        self.frames = 0
+        self.deltas = 0
+        self._parts: list[str] = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+
+    def new_segment(self) -> str | None:
+        """Start a new model response, returns any text left from the previous one"""
+        pending = self.flush()
+        self.segment += 1
+        return pending
+
+    def add(self, delta: str) -> str | None:
+        if not delta:
+            return None
+        self.deltas += 1
+        self._parts.append(delta)
+        self._size += len(delta)
+        if self._size >= self.max_chars or time.monotonic() - self._last_flush >= self.max_interval:
+            return self.flush()
+        return None
+
+    def flush(self) -> str | None:
+        self._last_flush = time.monotonic()
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        self.frames += 1
+        return text
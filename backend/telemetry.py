@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator
+from agents import RunHooks
+from compaction import CompactionStats
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in self._series.items():
+                labels = ",".join(f'{k}="{v}"' for k, v in key)
+                prefix = f"{labels}," if labels else ""
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{{{labels}}} {total}")
+                lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                labels = ",".join(f'{k}="{v}"' for k, v in key)
+                lines.append(f"{self.name}{{{labels}}} {value}")
+        return lines
+
+
+span_seconds = Histogram("medassistant_span_seconds", "Latency of pipeline spans by kind and name")
+span_payload_bytes = Histogram("medassistant_span_payload_bytes", "Response payload size of spans", SIZE_BUCKETS)
+span_tokens = Counter("medassistant_span_tokens_total", "LLM tokens by span kind, name and direction")
+span_errors = Counter("medassistant_span_errors_total", "Failed spans by kind and name")
+run_seconds = Histogram("medassistant_run_seconds", "End-to-end latency of run_agent by mode")
+compaction_bytes = Counter("medassistant_compaction_bytes_total", "Tool output bytes before and after compaction")
+compaction_tokens = Counter("medassistant_compaction_tokens_total", "Estimated tool output tokens before and after compaction")
+evidence_lookups = Counter("medassistant_evidence_lookups_total", "lookup_evidence calls by hit or miss")
+routed_runs = Counter("medassistant_routed_runs_total", "Runs by routed tier and stop reason")
+handoffs = Counter("medassistant_handoffs_total", "Agent handoffs by source and target agent")
+metrics = [span_seconds, span_payload_bytes, span_tokens, span_errors, run_seconds, compaction_bytes, compaction_tokens,
+           evidence_lookups, routed_runs, handoffs]
+# Extra gauges collected at scrape time, each callable returns {metric_name: value}
+gauge_collectors: list[Callable[[], dict[str, float]]] = []
+
+
+def render_metrics() -> str:
+    lines: list[str] = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    for collect in gauge_collectors:
+        try:
+            for name, value in collect().items():
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        except Exception as e:
+            logger.warning("Metrics collector failed: %s", e)
+    return "\n".join(lines) + "\n"
+
+
+@dataclass
+class Span:
+    kind: str
+    name: str
+    started: float = field(default_factory=time.perf_counter)
+    seconds: float = 0.0
+    tokens_in: int = 0
+    tokens_out: int = 0
+    payload_bytes: int = 0
+    error: str | None = None
+
+    def finish(self) -> None:
+        self.seconds = time.perf_counter() - self.started
+        span_seconds.observe(self.seconds, kind=self.kind, name=self.name)
+        if self.payload_bytes:
+            span_payload_bytes.observe(self.payload_bytes, kind=self.kind, name=self.name)
+        if self.tokens_in:
+            span_tokens.inc(self.tokens_in, kind=self.kind, name=self.name, direction="in")
+        if self.tokens_out:
+            span_tokens.inc(self.tokens_out, kind=self.kind, name=self.name, direction="out")
+        if self.error:
+            span_errors.inc(kind=self.kind, name=self.name)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.spans.append(self)
+
+
+@dataclass
+class Trace:
+    mode: str
+    user: str
+    trace_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    started: float = field(default_factory=time.perf_counter)
+    spans: list[Span] = field(default_factory=list)
+    compaction: CompactionStats = field(default_factory=CompactionStats)
+    # Tier the query router picked and why the run ended early, if it did
+    tier: str | None = None
+    stop_reason: str | None = None
+
+    def upstream_calls(self) -> dict[str, int]:
+        calls = {"gemini": 0, "tavily": 0}
+        for s in self.spans:
+            if s.kind in calls:
+                calls[s.kind] += 1
+        return calls
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+trace_sink_path: str | None = os.getenv("TRACE_JSONL_PATH")
+_sink_lock = threading.Lock()
+
+
+def start_trace(mode: str, user: str) -> Trace:
+    trace = Trace(mode=mode, user=user)
+    current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace: Trace, error: str | None = None) -> None:
+    seconds = time.perf_counter() - trace.started
+    run_seconds.observe(seconds, mode=trace.mode)
+    if trace.compaction.bytes_in:
+        saved = trace.compaction.snapshot()
+        logger.info("Run %s compaction saved %d bytes, ~%d tokens", trace.trace_id,
+                    saved["bytes_saved"], saved["tokens_saved"])
+    calls = trace.upstream_calls()
+    if trace.tier is not None:
+        routed_runs.inc(tier=trace.tier, stop_reason=trace.stop_reason or "completed")
+        logger.info("Run %s tier=%s stop=%s in %.1fs, %d gemini and %d tavily calls", trace.trace_id, trace.tier,
+                    trace.stop_reason or "completed", seconds, calls["gemini"], calls["tavily"])
+    if not trace_sink_path:
+        return
+    record = {
+        "trace_id": trace.trace_id,
+        "mode": trace.mode,
+        "user": trace.user,
+        "seconds": round(seconds, 4),
+        "error": error,
+        "tier": trace.tier,
+        "stop_reason": trace.stop_reason,
+        "upstream_calls": calls,
+        "compaction": trace.compaction.snapshot(),
+        "spans": [
+            {"kind": s.kind, "name": s.name, "offset": round(s.started - trace.started, 4),
+             "seconds": round(s.seconds, 4), "tokens_in": s.tokens_in, "tokens_out": s.tokens_out,
+             "payload_bytes": s.payload_bytes, "error": s.error}
+            for s in trace.spans
+        ],
+    }
+    with _sink_lock, open(trace_sink_path, "a") as file:
+        file.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def span(kind: str, name: str) -> Iterator[Span]:
+    current = Span(kind, name)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.finish()
+
+
+def record_compaction(tool: str, stats: CompactionStats) -> None:
+    compaction_bytes.inc(stats.bytes_in, tool=tool, stage="in")
+    compaction_bytes.inc(stats.bytes_out, tool=tool, stage="out")
+    compaction_tokens.inc(stats.tokens_in, tool=tool, stage="in")
+    compaction_tokens.inc(stats.tokens_out, tool=tool, stage="out")
+    trace = current_trace.get()
+    if trace is not None:
+        trace.compaction.add(stats)
+
+
+def payload_size(value: Any) -> int:
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+class TracingHooks(RunHooks):
+    """Records a span per agent turn (closed on handoff) and per tool call"""
+
+    def __init__(self):
+        self._agent_span: Span | None = None
+        self._agent_usage = (0, 0)
+        self._tool_spans: dict[str, list[Span]] = {}
+
+    def _close_agent(self, context) -> None:
+        if self._agent_span is None:
+            return
+        self._agent_span.tokens_in = context.usage.input_tokens - self._agent_usage[0]
+        self._agent_span.tokens_out = context.usage.output_tokens - self._agent_usage[1]
+        self._agent_span.finish()
+        self._agent_span = None
+
+    async def on_agent_start(self, context, agent) -> None:
+        self._close_agent(context)
+        self._agent_span = Span("agent", agent.name)
+        self._agent_usage = (context.usage.input_tokens, context.usage.output_tokens)
+
+    async def on_agent_end(self, context, agent, output) -> None:
+        self._close_agent(context)
+
+    async def on_handoff(self, context, from_agent, to_agent) -> None:
+        self._close_agent(context)
+        handoffs.inc(source=from_agent.name, target=to_agent.name)
+
+    async def on_tool_start(self, context, agent, tool) -> None:
+        self._tool_spans.setdefault(tool.name, []).append(Span("tool", tool.name))
+
+    async def on_tool_end(self, context, agent, tool, result) -> None:
+        spans = self._tool_spans.get(tool.name)
+        if spans:
+            current = spans.pop(0)
+            current.payload_bytes = payload_size(result)
+            current.finish()
+
+    def close(self, context) -> None:
+        self._close_agent(context)
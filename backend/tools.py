@@ -1,19 +1,61 @@
 from agents import function_tool, RunContextWrapper
 from dataclasses import dataclass
 from clients import tavily_client
+from cache import TieredCache, SQLiteCacheTier, make_cache_key
+from doc_store import DocumentStore, canonicalize_url
+from compaction import PassageCompactor
+from telemetry import span, record_compaction, evidence_lookups
+from evidence import current_evidence, record_evidence
+from credibility import credibility_scorer
+from prefetch import SpeculativePrefetcher, current_prefetch
 from pydantic import BaseModel
+from typing import Literal
+import asyncio
+import logging
+import os
+
+# Shared cache for Tavily searches, the sqlite tier is enabled by SEARCH_CACHE_DB
+search_cache_db: str | None = os.getenv("SEARCH_CACHE_DB")
+search_cache: TieredCache = TieredCache(
+    namespace="web_search",
+    max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "2048")),
+    ttl_seconds=float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "21600")),
+    disk=SQLiteCacheTier(search_cache_db) if search_cache_db else None,
+)
+
+# Extracted pages are kept on disk, only cache misses are sent to Tavily
+doc_store: DocumentStore = DocumentStore(
+    root_dir=os.getenv("DOC_STORE_DIR", "doc_store"),
+    ttl_seconds=float(os.getenv("DOC_STORE_TTL_SECONDS", str(7 * 24 * 3600))),
+)
+EXTRACT_BATCH_SIZE: int = int(os.getenv("EXTRACT_BATCH_SIZE", "10"))
+EXTRACT_CONCURRENCY: int = int(os.getenv("EXTRACT_CONCURRENCY", "4"))
+extract_semaphore = asyncio.Semaphore(EXTRACT_CONCURRENCY)
+
+# Tool outputs are cut down to the best passages for the query, a budget of 0 returns raw Tavily results
+SEARCH_TOKEN_BUDGET: int = int(os.getenv("SEARCH_TOKEN_BUDGET", "1200"))
+EXTRACT_TOKEN_BUDGET: int = int(os.getenv("EXTRACT_TOKEN_BUDGET", "3000"))
+compactor: PassageCompactor = PassageCompactor(
+    passage_words=int(os.getenv("PASSAGE_WORDS", "120")),
+    dedup_threshold=float(os.getenv("PASSAGE_DEDUP_THRESHOLD", "0.8")),
+)
+logger = logging.getLogger(__name__)
 
 class UserQuerie(BaseModel):
     email: str
     query: str
     enable_deepsearch: bool
     is_doctor: bool
+    # "orchestrator" (LLM driven) or "dag" (code driven deep search)
+    engine: str | None = None
 
 @dataclass
 class UserInfo:
     name: str
     doctor: bool
     enable_deepsearch: bool
+    # Depth the query router picked: "quick", "standard" or "deep"
+    tier: str = "deep"
     
     
 class Login_Class(BaseModel):
@@ -27,11 +69,20 @@ class Signup_Class(Login_Class):
 class UserAnswer(BaseModel):
     email: str
     answer: str
+
+class JobRequest(BaseModel):
+    email: str
+    query: str
+    # "query" starts a new question, "answer" replies to an ask_user question
+    kind: Literal["query", "answer"] = "query"
+    enable_deepsearch: bool = False
+    is_doctor: bool = False
+    engine: str | None = None
     
     
 @function_tool
 def get_premium_user(userContext: RunContextWrapper[UserInfo]) -> str:
-    print(f"User context: {userContext.context}")
+    logger.debug("User context: %s", userContext.context)
     if userContext.context.location == "Pakistan":
         return "You are a premium user from Pakistan"
     elif userContext.context.location == "India":
@@ -39,23 +90,242 @@ def get_premium_user(userContext: RunContextWrapper[UserInfo]) -> str:
     else:
         return "You are a free user"
 
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split()).strip(" ?.!")
+
+
+async def cached_search(query: str, max_results: int = 5) -> dict:
+    """Tavily search through the shared cache, identical queries share one request"""
+    key = make_cache_key(normalize_query(query), max_results=max_results)
+    warm = current_prefetch.get()
+    prefetched = warm.search(key) if warm is not None else None
+    if prefetched is not None:
+        try:
+            return await asyncio.shield(prefetched)
+        except Exception:
+            pass
+    return await search_cache.get_or_fetch(
+        key, lambda: tavily_client.search(query=query, max_results=max_results)
+    )
+
+
+async def compact_results(tool: str, query: str, documents: list[dict], token_budget: int,
+                          content_key: str = "content") -> list[dict]:
+    """Top passages of documents for query within token_budget, with their source URLs and credibility"""
+    with span("compaction", tool):
+        passages, stats = await asyncio.to_thread(
+            compactor.compact, query, documents, token_budget, content_key)
+    record_compaction(tool, stats)
+    return credibility_scorer.annotate(passages)
+
+
 @function_tool
 async def web_search(query: str) -> str:
-    print(f"Searching the web for: {query}")
-    response = await tavily_client.search(query=query, max_results=5)
-    return response 
+    logger.debug("Searching the web for: %s", query)
+    response = await cached_search(query, max_results=5)
+    record_evidence(response.get("results", []))
+    if SEARCH_TOKEN_BUDGET <= 0:
+        credibility_scorer.annotate(response.get("results", []))
+        return response
+    results = await compact_results("web_search", query, response.get("results", []), SEARCH_TOKEN_BUDGET)
+    return {"query": query, "results": results}
+
+
+MULTI_SEARCH_CONCURRENCY: int = int(os.getenv("MULTI_SEARCH_CONCURRENCY", "4"))
+MULTI_SEARCH_TIMEOUT_SECONDS: float = float(os.getenv("MULTI_SEARCH_TIMEOUT_SECONDS", "20"))
+MULTI_SEARCH_MAX_RESULTS: int = int(os.getenv("MULTI_SEARCH_MAX_RESULTS", "15"))
+MULTI_SEARCH_MAX_CHARS: int = int(os.getenv("MULTI_SEARCH_MAX_CHARS", "12000"))
+
+
+async def run_multi_search(queries: list[str], max_results_per_query: int = 5,
+                           concurrency: int = MULTI_SEARCH_CONCURRENCY,
+                           timeout: float = MULTI_SEARCH_TIMEOUT_SECONDS,
+                           max_results: int = MULTI_SEARCH_MAX_RESULTS,
+                           max_chars: int = MULTI_SEARCH_MAX_CHARS) -> dict:
+    """Run several searches concurrently and merge the results by URL.
+
+    Results found by more queries rank higher, the payload is capped at
+    max_results entries and max_chars characters of content.
+    """
+    queries = list(dict.fromkeys(q.strip() for q in queries if q and q.strip()))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def search_one(query: str) -> tuple[str, dict | None, str | None]:
+        async with semaphore:
+            try:
+                response = await asyncio.wait_for(cached_search(query, max_results_per_query), timeout)
+                return query, response, None
+            except asyncio.TimeoutError:
+                return query, None, f"timed out after {timeout}s"
+            except Exception as e:
+                return query, None, str(e)
+
+    merged: dict[str, dict] = {}
+    failed_queries = []
+    for query, response, error in await asyncio.gather(*(search_one(q) for q in queries)):
+        if error:
+            failed_queries.append({"query": query, "error": error})
+            continue
+        for result in response.get("results", []):
+            url = canonicalize_url(result.get("url", ""))
+            entry = merged.get(url)
+            if entry is None:
+                merged[url] = {
+                    "url": result.get("url", ""),
+                    "title": result.get("title", ""),
+                    "content": result.get("content", ""),
+                    "score": result.get("score", 0.0),
+                    "queries": [query],
+                }
+            else:
+                entry["score"] = max(entry["score"], result.get("score", 0.0))
+                entry["queries"].append(query)
+                if len(result.get("content", "")) > len(entry["content"]):
+                    entry["content"] = result["content"]
+
+    ranked = sorted(merged.values(), key=lambda r: (len(r["queries"]), r["score"]), reverse=True)
+    results = []
+    budget = max_chars
+    for result in ranked[:max_results]:
+        if budget <= 0:
+            break
+        result["content"] = result["content"][:budget]
+        budget -= len(result["content"])
+        results.append(result)
+    return {"queries": queries, "results": results, "failed_queries": failed_queries}
 
 
 @function_tool
-async def extract_url(urls: list) -> dict:
-    print(f"Extracting URLs from: {urls}")
-    response = await tavily_client.extract(urls)
-    return response 
+async def multi_search(queries: list[str]) -> dict:
+    """Search the web for several queries at once and get merged, deduplicated results.
+
+    Args:
+        queries: Different search queries covering separate angles of the topic.
+    """
+    logger.debug("Searching the web for %d queries: %s", len(queries), queries)
+    response = await run_multi_search(queries)
+    record_evidence(response["results"])
+    if SEARCH_TOKEN_BUDGET <= 0:
+        credibility_scorer.annotate(response.get("results", []))
+        return response
+    response["results"] = await compact_results(
+        "multi_search", " ".join(response["queries"]), response["results"], SEARCH_TOKEN_BUDGET)
+    return response
+
+
+async def _extract_batch(batch: list[str]) -> tuple[dict[str, str], dict[str, str]]:
+    async with extract_semaphore:
+        try:
+            response = await tavily_client.extract(batch)
+        except Exception as e:
+            logger.warning("Extract batch failed: %s", e)
+            return {}, {url: str(e) for url in batch}
+
+    extracted: dict[str, str] = {}
+    failed: dict[str, str] = {}
+    for result in response.get("results", []):
+        url = canonicalize_url(result.get("url", ""))
+        if result.get("raw_content"):
+            extracted[url] = result["raw_content"]
+    for result in response.get("failed_results", []):
+        failed[canonicalize_url(result.get("url", ""))] = result.get("error", "")
+    for url in batch:
+        if url not in extracted and url not in failed:
+            failed[url] = "No content returned"
+    return extracted, failed
+
+
+async def extract_documents(urls: list[str]) -> dict:
+    """Extract page text using the document store first and Tavily for the misses.
+
+    Misses are sent in batches of EXTRACT_BATCH_SIZE with at most
+    EXTRACT_CONCURRENCY batches in flight, results follow the caller's URL order.
+    """
+    canonical = [canonicalize_url(url) for url in urls]
+    unique = list(dict.fromkeys(canonical))
+    warm = current_prefetch.get()
+    prefetched = warm.take_documents(unique) if warm is not None else {}
+    documents = await asyncio.to_thread(doc_store.get_many, [url for url in unique if url not in prefetched])
+
+    misses = [url for url in unique if url not in documents and url not in prefetched]
+    failed: dict[str, str] = {}
+    if misses:
+        batches = [misses[i:i + EXTRACT_BATCH_SIZE]
+                   for i in range(0, len(misses), EXTRACT_BATCH_SIZE)]
+        extracted: dict[str, str] = {}
+        for batch_extracted, batch_failed in await asyncio.gather(*(_extract_batch(batch) for batch in batches)):
+            extracted.update(batch_extracted)
+            failed.update(batch_failed)
+        if extracted:
+            documents.update(await asyncio.to_thread(doc_store.put_many, extracted))
+
+    results = []
+    failed_results = []
+    for original, url in zip(urls, canonical):
+        if url in prefetched:
+            result = dict(prefetched[url])
+            result["url"] = original
+            result["cached"] = True
+            results.append(result)
+        elif url in documents:
+            result = documents[url].as_result()
+            result["url"] = original
+            result["cached"] = url not in misses
+            results.append(result)
+        else:
+            failed_results.append({"url": original, "error": failed.get(url, "Not extracted")})
+    return {"results": results, "failed_results": failed_results}
+
+
+# Searches and page extracts run while the user answers a question_from_user question
+prefetcher: SpeculativePrefetcher = SpeculativePrefetcher(
+    search=lambda query: cached_search(query, max_results=5),
+    extract=extract_documents,
+    key=lambda query: make_cache_key(normalize_query(query), max_results=5),
+    max_queries=int(os.getenv("PREFETCH_MAX_QUERIES", "3")),
+    max_urls=int(os.getenv("PREFETCH_MAX_URLS", "4")),
+    ttl_seconds=float(os.getenv("PREFETCH_TTL_SECONDS", "300")),
+    max_users=int(os.getenv("PREFETCH_MAX_USERS", "100")),
+)
+
+
+@function_tool
+async def extract_url(urls: list, query: str = "") -> dict:
+    """Read the full text of web pages and get the passages most relevant to the query.
+
+    Args:
+        urls: Page URLs to read, usually taken from web_search results.
+        query: The question you are researching, used to pick the relevant passages.
+    """
+    logger.debug("Extracting URLs from: %s", urls)
+    response = await extract_documents(urls)
+    record_evidence(response["results"], content_key="raw_content")
+    if EXTRACT_TOKEN_BUDGET <= 0:
+        credibility_scorer.annotate(response["results"])
+        return response
+    results = await compact_results(
+        "extract_url", query, response["results"], EXTRACT_TOKEN_BUDGET, content_key="raw_content")
+    return {"query": query, "results": results, "failed_results": response["failed_results"]}
+
+
+@function_tool
+def lookup_evidence(claim: str) -> dict:
+    """Find sources for a claim among the pages already retrieved in this conversation turn.
+    No web request is made, use web_search only when this returns no matches.
+
+    Args:
+        claim: The statement or topic you need a source for.
+    """
+    index = current_evidence.get()
+    matches = credibility_scorer.annotate(index.lookup(claim)) if index is not None else []
+    evidence_lookups.inc(result="hit" if matches else "miss")
+    logger.debug("Evidence lookup for %r: %d matches", claim, len(matches))
+    return {"claim": claim, "matches": matches}
 
 
 @function_tool(description_override="This tool is  used for asking questions from the user.")
 def question_from_user(question: str) -> str:
-    print(f"Question for user: {question}")
+    logger.debug("Question for user: %s", question)
     # answer = input(f"{question}\t")
     return {    
         "type": "ask_user",
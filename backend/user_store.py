@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+class UserStore:
+    """SQLite backed user repository with an in-memory index by email.
+
+    The index is loaded once on first use and misses fall back to the
+    table. Every signup is a single-row insert, so concurrent handlers never
+    rewrite the whole store.
+    """
+
+    def __init__(self, db_path: str, legacy_json_path: str | None = None):
+        self.db_path = db_path
+        self.legacy_json_path = legacy_json_path
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._index: dict[str, dict] | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                email TEXT PRIMARY KEY,
+                record TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        conn.commit()
+        return conn
+
+    def _load(self) -> dict[str, dict]:
+        if self._index is not None:
+            return self._index
+        with self._lock:
+            if self._index is None:
+                self._conn = self._connect()
+                (count,) = self._conn.execute("SELECT COUNT(*) FROM users").fetchone()
+                if count == 0 and self.legacy_json_path and os.path.exists(self.legacy_json_path):
+                    self._import_json_locked(self.legacy_json_path)
+                self._index = {
+                    email: json.loads(record)
+                    for email, record in self._conn.execute("SELECT email, record FROM users")
+                }
+        return self._index
+
+    def _import_json_locked(self, path: str) -> int:
+        with open(path, "r") as file:
+            users = json.load(file)
+        rows = []
+        for user in users:
+            if "email" not in user:
+                logger.warning("Skipping user without email: %s", user.get("name", ""))
+                continue
+            rows.append((normalize_email(user["email"]), json.dumps(user)))
+        cursor = self._conn.executemany(
+            "INSERT OR IGNORE INTO users (email, record) VALUES (?, ?)", rows)
+        self._conn.commit()
+        return cursor.rowcount
+
+    def import_json(self, path: str) -> int:
+        """One-shot import of a legacy user_settings.json file, returns the rows added"""
+        self._load()
+        with self._lock:
+            added = self._import_json_locked(path)
+            self._index = {
+                email: json.loads(record)
+                for email, record in self._conn.execute("SELECT email, record FROM users")
+            }
+        return added
+
+    def get(self, email: str) -> dict | None:
+        email = normalize_email(email)
+        index = self._load()
+        user = index.get(email)
+        if user is None:
+            # Another worker process may have added the user after our index was loaded
+            with self._lock:
+                row = self._conn.execute("SELECT record FROM users WHERE email = ?", (email,)).fetchone()
+            if row is not None:
+                user = index[email] = json.loads(row[0])
+        return user
+
+    def add(self, user: dict) -> bool:
+        """Insert a new user, returns False when the email is already taken"""
+        index = self._load()
+        email = normalize_email(user["email"])
+        with self._lock:
+            if email in index:
+                return False
+            try:
+                self._conn.execute(
+                    "INSERT INTO users (email, record) VALUES (?, ?)", (email, json.dumps(user)))
+                self._conn.commit()
+            except sqlite3.IntegrityError:
+                return False
+            index[email] = user
+        return True
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+
+if __name__ == "__main__":
+    # python user_store.py import user_settings.json [users.db]
+    if len(sys.argv) < 3 or sys.argv[1] != "import":
+        print("Usage: python user_store.py import <user_settings.json> [users.db]")
+        sys.exit(1)
+    store = UserStore(sys.argv[3] if len(sys.argv) > 3 else os.getenv("USER_DB", "users.db"))
+    print(f"Imported {store.import_json(sys.argv[2])} users, {len(store)} total.")